@@ -0,0 +1,214 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Progress journal for checkpointed, resumable georeference
+# runs.  Output is committed one stream group (consecutive survey rows with
+# the same LLID) at a time.  The journal records a hash identifying the
+# run's inputs and output options, and a "begin" line before and a "done"
+# line after each group is committed, so a later run with unchanged inputs
+# and options can skip finished groups and clean up the one group that was
+# being written when the run stopped.
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): https://docs.python.org/2/library/hashlib.html
+#            https://docs.python.org/2/library/os.html#os.fsync
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import logging
+import hashlib
+from RBA_georef_util import arcpy  # imported on first use
+from RBA_georef_util import log  # logger of the calling session
+import RBA_stream_network as rgnet
+
+
+# ********** GLOBAL CONSTANTS **********
+
+JOURNAL_SUFFIX = "_journal.txt"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+INPUTS_ENTRY = "inputs"
+BEGIN_ENTRY = "begin"
+DONE_ENTRY = "done"
+
+
+# ********** CLASSES **********
+
+class RunJournal(object):
+    """
+    Append-only record of the stream groups committed to a run's output.
+    Each line is an entry: the inputs hash first, then "begin <group>
+    <llid>" and "done <group> <llid>" entries.  Every entry is flushed to
+    disk before the run continues.
+    """
+
+    def __init__(self, journal_filepath, inputs_hash):
+        self.journal_filepath = journal_filepath
+        self.inputs_hash = inputs_hash
+        self._journal_file = None
+
+    def __repr__(self):
+        return "RunJournal {}, inputs {}".format(self.journal_filepath,
+                                                 self.inputs_hash)
+
+    def load(self):
+        """
+        Reads the journal left by a previous run.
+        :return: tuple of (completed, partial_llid), where completed is a
+            dictionary of LLID keyed on group number for every committed
+            group, and partial_llid is the LLID of a group that was begun
+            but not committed, or None.  None is returned instead if there
+            is no journal or it was written for different inputs.
+        """
+        if not os.path.exists(self.journal_filepath):
+            return None
+        completed = {}
+        begun = None
+        with open(self.journal_filepath, 'r') as journal_file:
+            lines = journal_file.read().split("\n")
+        # The last piece is empty unless the final entry was cut short
+        entries = [line.split(" ", 2) for line in lines[:-1]]
+        if not entries or entries[0] != [INPUTS_ENTRY, self.inputs_hash]:
+            return None
+        for entry in entries[1:]:
+            if entry[0] == BEGIN_ENTRY:
+                begun = (int(entry[1]), entry[2])
+            elif entry[0] == DONE_ENTRY:
+                completed[int(entry[1])] = entry[2]
+                begun = None
+        partial_llid = None
+        if begun is not None and begun[0] not in completed:
+            partial_llid = begun[1]
+        return completed, partial_llid
+
+    def start(self):
+        """
+        Starts a new journal, discarding any previous one.
+        """
+        self.close()
+        self._journal_file = open(self.journal_filepath, 'w')
+        self._write(INPUTS_ENTRY, self.inputs_hash)
+
+    def resume(self):
+        """
+        Reopens an existing journal, to append entries for remaining groups.
+        """
+        self.close()
+        self._journal_file = open(self.journal_filepath, 'a')
+
+    def begin_group(self, group, llid):
+        self._write(BEGIN_ENTRY, group, llid)
+
+    def complete_group(self, group, llid):
+        self._write(DONE_ENTRY, group, llid)
+
+    def close(self):
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+
+    def _write(self, *fields):
+        self._journal_file.write(" ".join(str(f) for f in fields) + "\n")
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+
+
+# ********** FUNCTIONS **********
+
+def default_journal_filepath(gdb_path, survey_data_fc_name):
+    """
+    Names the journal for an output feature class, next to its geodatabase.
+    """
+    return os.path.splitext(gdb_path)[0] + "_" + survey_data_fc_name + \
+        JOURNAL_SUFFIX
+
+
+def hash_file(filepath, digest=None):
+    """
+    Adds the contents of a file to a hash, a block at a time.
+    :param filepath: full path to file
+    :param digest: hashlib object to update, or None for a new sha1
+    :return: the updated hashlib object
+    """
+    digest = digest or hashlib.sha1()
+    with open(filepath, 'rb') as in_file:
+        block = in_file.read(HASH_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = in_file.read(HASH_BLOCK_SIZE)
+    return digest
+
+
+def file_key(filepath):
+    """
+    Identifies a version of a file cheaply, by its full path, size and
+    modification time, without reading it.
+    :return: key string
+    """
+    file_stat = os.stat(filepath)
+    return "{}|{}|{!r}".format(os.path.abspath(filepath), file_stat.st_size,
+                               file_stat.st_mtime)
+
+
+def hash_inputs(survey_data_filename, sdi_filepath, streams_pathname,
+                other_filepaths=(), options=()):
+    """
+    Computes a hash identifying the inputs of a georeference run: the
+    survey data, SDI and other input files by file_key, the streams
+    signature, and the options that decide the output's fields and values.
+    A run resumed with any of these changed would add rows that do not
+    match the rows already written.
+    :param other_filepaths: other input files, e.g. scenario SDI files and
+        the survey data template
+    :param options: sequence of (name, value) tuples of run options
+    :return: hex digest string
+    """
+    digest = hashlib.sha1()
+    for filepath in [survey_data_filename, sdi_filepath] + \
+            list(other_filepaths):
+        digest.update((file_key(filepath) + ";").encode('utf-8'))
+    for name, value in options:
+        digest.update("{}={!r};".format(name, value).encode('utf-8'))
+    digest.update(rgnet.streams_signature(streams_pathname).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def delete_llid_rows(survey_data_fc, llid_field, llid):
+    """
+    Deletes the rows for one stream from the output feature class.
+    :param survey_data_fc: output feature class
+    :param llid_field: name of the field holding the LLID
+    :param llid: Location ID of stream whose rows are deleted
+    :return: number of rows deleted
+    """
+    where_clause = """{} = '{}'""".\
+        format(arcpy.AddFieldDelimiters(survey_data_fc, llid_field), llid)
+    num_deleted = 0
+    with arcpy.da.UpdateCursor(survey_data_fc, [llid_field],
+                               where_clause) as cursor:
+        for row in cursor:
+            cursor.deleteRow()
+            num_deleted += 1
+    log.info(" deleted {} uncommitted rows for {} {}".
+             format(num_deleted, llid_field, llid))
+    return num_deleted
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -19,6 +19,9 @@
 #            http://stackoverflow.com/questions/2937114/python-is-not-sequence
 #            http://stackoverflow.com/questions/10564801/how-to-unpack-multiple-tuples-in-function-call
 #            http://stackoverflow.com/questions/15008758/parsing-boolean-values-with-argparse
+#            https://docs.python.org/2/library/importlib.html
+#            https://docs.python.org/2/library/gzip.html
+#            https://pypi.python.org/pypi/backports.lzma
 #
 # **********************************************************************
 
@@ -28,8 +31,19 @@ import os
 import logging
 import argparse
 import csv
-from collections import namedtuple
-import arcpy
+import io
+import gzip
+import threading
+import importlib
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma  # Python 2
+    except ImportError:
+        lzma = None  # xz files not supported
 
 
 # ********** GLOBAL CONSTANTS **********
@@ -45,6 +59,7 @@ XY_NOTE = "XY_Note"
 SURVEY_CUM_DISTANCE = "Survey_Cum_Dist"
 STREAMLINE_CUM_DISTANCE = "Streamline_Cum_Dist"
 SURVEY_COMMENT = "Comment"
+SNAP_OFFSET = "Snap_Offset"
 ADJ_FACTOR = "Adj_Factor"
 
 STREAMS_FC_NAME = "streams"
@@ -53,14 +68,167 @@ DEFAULT_ADJ_FACTOR = 1.0  # use when adjustment factor cannot be computed
 DEFAULT_BEGIN_DIST = 0  # min cummulative distance for stream survey data
 DEFAULT_END_DIST = 999999  # max cummulative distance for stream survey data
 
-LAT_LONG_CRS = arcpy.SpatialReference(4326)
+DEFAULT_GEOM_CACHE_MB = 256  # memory budget for cached stream geometries
+GEOM_BYTES_PER_VERTEX = 32  # estimated size of one x,y(,z,m) vertex
+GEOM_BYTES_OVERHEAD = 1024  # estimated size of a geometry without vertices
+PRELOAD_BATCH_SIZE = 500  # LLIDs per query when preloading geometries
+
+LAT_LONG_WKID = 4326  # WGS 1984, for x,y coordinates in lat/long
 
-#LOG_LEVEL = logging.DEBUG
-LOG_LEVEL = logging.INFO  # may be overwritten by importing module
+# Survey data fish counts; blank counts are written as 0
+ZERO_FILL_FIELDS = ["COHO", "Zero_plus", "STHD", "CUT", "CHIN", "RES_RB"]
+SHAPEFILE_FIELD_NAME_LEN = 10  # shapefile field names are cut to this
+TRUNCATION_MARK = ".."  # ends text cut to a field's length
+INTEGER_FIELD_TYPES = ["SmallInteger", "Integer", "OID"]
+FLOAT_FIELD_TYPES = ["Single", "Double"]
+
+# Compressed csv files, recognized by their first bytes
+GZIP = "gzip"
+XZ = "xz"
+COMPRESSION_MAGIC = [(GZIP, b"\x1f\x8b"), (XZ, b"\xfd7zXZ\x00")]
+COMPRESSIONS = [GZIP, XZ]
 
 
 # ********** CLASSES **********
 
+class LazyModule(object):
+    """
+    Stand-in for a module that is imported the first time one of its
+    attributes is used, so scripts can start, show help and do dry runs
+    without paying for a slow import such as arcpy.
+    """
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __repr__(self):
+        return "LazyModule {}, {}".format(self._module_name,
+                                          "loaded" if self.is_loaded()
+                                          else "not loaded")
+
+    def __getattr__(self, attr_name):
+        if self._module is None:
+            log.debug(" importing {}".format(self._module_name))
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, attr_name)
+
+    def is_loaded(self):
+        return self._module is not None
+
+
+arcpy = LazyModule("arcpy")
+
+
+class SessionLog(object):
+    """
+    Logger used by the RBA modules.  Messages go to the logger bound to the
+    calling thread (see bind), such as a GeorefSession's own logger, or to
+    the root logger when none is bound, as for the command-line scripts.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __repr__(self):
+        return "SessionLog, {}".format(self.current().name)
+
+    def current(self):
+        """
+        :return: logger bound to the calling thread, or the root logger
+        """
+        return getattr(self._local, 'logger', None) or logging.getLogger()
+
+    @contextmanager
+    def bind(self, logger):
+        """
+        Context manager that sends the calling thread's messages to logger
+        until it exits.  Bindings may be nested.
+        :param logger: logging.Logger, or None for the root logger
+        """
+        previous = getattr(self._local, 'logger', None)
+        self._local.logger = logger
+        try:
+            yield logger
+        finally:
+            self._local.logger = previous
+
+    def debug(self, msg, *args, **kwargs):
+        self.current().debug(msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.current().info(msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.current().warning(msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.current().error(msg, *args, **kwargs)
+
+    def exception(self, msg, *args, **kwargs):
+        self.current().exception(msg, *args, **kwargs)
+
+
+log = SessionLog()
+
+
+class DescribeCache(object):
+    """
+    arcpy Describe objects of datasets, each described once, and the
+    lat/long spatial reference, created on first use.  describe and
+    lat_long_crs use the cache bound to the calling thread (see bind), such
+    as a GeorefSession's own, or else the cache of the script's run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._describes = {}
+        self._lat_long_crs = None
+
+    def __repr__(self):
+        return "DescribeCache, {} datasets described".\
+            format(len(self._describes))
+
+    def describe(self, dataset):
+        key = os.path.normcase(os.path.normpath(str(dataset)))
+        with self._lock:
+            if key not in self._describes:
+                self._describes[key] = arcpy.Describe(dataset)
+            return self._describes[key]
+
+    def lat_long_crs(self):
+        with self._lock:
+            if self._lat_long_crs is None:
+                self._lat_long_crs = arcpy.SpatialReference(LAT_LONG_WKID)
+            return self._lat_long_crs
+
+    def clear(self):
+        """
+        Forgets all Describe objects, e.g. when datasets may have been
+        replaced.
+        """
+        with self._lock:
+            self._describes.clear()
+            self._lat_long_crs = None
+
+    @contextmanager
+    def bind(self):
+        """
+        Context manager that makes this the calling thread's cache until it
+        exits.  Bindings may be nested.
+        """
+        previous = getattr(_bound_describe_caches, 'cache', None)
+        _bound_describe_caches.cache = self
+        try:
+            yield self
+        finally:
+            _bound_describe_caches.cache = previous
+
+
+_bound_describe_caches = threading.local()  # cache bound to each thread
+_run_describe_cache = DescribeCache()  # cache of a script's run
+
+
 class SyncPoint(object):
     """
     x,y and distance information for a synchronization point along a stream.
@@ -99,9 +267,243 @@ class StreamDistanceInfo(object):
             format(self.llid, self.name, self.trib_to, len(self.adj_factors))
 
 
+class StreamGeometryCache(object):
+    """
+    Least-recently-used cache of stream geometry objects, keyed on LLID,
+    with a memory budget in bytes.  Each geometry's size is estimated from
+    its vertex count; when the budget is exceeded, the least recently used
+    geometries are evicted.  Counts of hits, misses and evictions are kept
+    for reporting.  The cache may be shared between threads.
+    """
+
+    def __init__(self, streams_pathname, max_bytes=None):
+        self.streams_pathname = streams_pathname
+        if max_bytes is None:
+            max_bytes = DEFAULT_GEOM_CACHE_MB * 1024 * 1024
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # llid -> (geometry, size in bytes)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "StreamGeometryCache {} geometries, {} of {} bytes, ".\
+            format(len(self._entries), self.current_bytes, self.max_bytes) + \
+            "{} hits, {} misses, {} evictions".\
+            format(self.hits, self.misses, self.evictions)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, llid):
+        """
+        Finds the geometry object for the stream with the given LLID,
+        fetching it from the streams feature class if it is not cached.
+        :param llid: Location ID for stream
+        :return: stream geometry object
+        """
+        with self._lock:
+            entry = self._entries.pop(llid, None)
+            if entry is not None:
+                # Re-insert as most recently used
+                self._entries[llid] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        stream_geom = get_stream_geom(self.streams_pathname, llid)
+        self.put(llid, stream_geom)
+        return stream_geom
+
+    def put(self, llid, stream_geom):
+        """
+        Adds a geometry to the cache, evicting least recently used
+        geometries as needed to stay within the memory budget.  Geometries
+        larger than the whole budget are not cached.
+        :param llid: Location ID for stream
+        :param stream_geom: stream geometry object
+        """
+        size = estimate_geom_bytes(stream_geom)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(llid, None)
+            if old_entry is not None:
+                self.current_bytes -= old_entry[1]
+            while self._entries and \
+                    self.current_bytes + size > self.max_bytes:
+                evicted_llid, (evicted_geom, evicted_size) = \
+                    self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+                log.debug(" evicted geometry for {} {}".
+                          format(LLID, evicted_llid))
+            self._entries[llid] = (stream_geom, size)
+            self.current_bytes += size
+
+    def preload(self, llids):
+        """
+        Fetches the geometries of many streams with a few queries of up to
+        PRELOAD_BATCH_SIZE LLIDs each, instead of one query per stream.
+        Stops when the memory budget is full; streams not preloaded are
+        fetched by get as usual.
+        :param llids: Location IDs of streams, in order of expected use
+        :return: number of geometries loaded
+        """
+        with self._lock:
+            llids = [llid for llid in OrderedDict.fromkeys(llids)
+                     if llid not in self._entries]
+        llid_field = arcpy.AddFieldDelimiters(self.streams_pathname, LLID)
+        num_loaded = 0
+        for first in range(0, len(llids), PRELOAD_BATCH_SIZE):
+            batch = llids[first:first + PRELOAD_BATCH_SIZE]
+            where_clause = "{} IN ({})".\
+                format(llid_field, ", ".join("'{}'".format(llid)
+                                             for llid in batch))
+            geoms = {}
+            with arcpy.da.SearchCursor(self.streams_pathname,
+                                       [LLID, "SHAPE@"],
+                                       where_clause) as cursor:
+                for llid, stream_geom in cursor:
+                    # Keep the first match, as get_stream_geom does
+                    geoms.setdefault(str(llid), stream_geom)
+            for llid in batch:
+                if llid not in geoms:
+                    continue
+                size = estimate_geom_bytes(geoms[llid])
+                with self._lock:
+                    if llid in self._entries:
+                        continue  # fetched by get meanwhile
+                    cache_full = self.current_bytes + size > self.max_bytes
+                    if not cache_full:
+                        self._entries[llid] = (geoms[llid], size)
+                        self.current_bytes += size
+                if cache_full:
+                    log.info(" preloaded {} stream geometries; cache full".
+                             format(num_loaded))
+                    return num_loaded
+                num_loaded += 1
+        log.info(" preloaded {} stream geometries".format(num_loaded))
+        return num_loaded
+
+
+class SurveyRowTransformer(object):
+    """
+    Converts survey csv records into rows for the survey data feature class.
+    Built once from the template fields and the csv header: each output
+    field is matched to its csv column by name (including shapefile names
+    cut to 10 characters), with a conversion for the field's type, a default
+    for blank values, and the field's length limit for text.
+    """
+
+    def __init__(self, template_fields, csv_headings):
+        """
+        :param template_fields: arcpy Field objects for the survey data
+            fields of the output feature class, in output order
+        :param csv_headings: column names from the survey data csv header
+        """
+        self.field_names = [field.name for field in template_fields]
+        self._columns = []
+        for field in template_fields:
+            index = match_csv_column(field.name, csv_headings)
+            if index is None:
+                log.warning(" No survey data column for field {}; " .
+                            format(field.name) + "values will be null")
+            self._columns.append((index, field_conversion(field)))
+
+    def __repr__(self):
+        return "SurveyRowTransformer {} fields, {} unmatched".\
+            format(len(self._columns),
+                   sum(1 for index, convert in self._columns
+                       if index is None))
+
+    def transform(self, record, pt_geom, extra_values=()):
+        """
+        :param record: sequence of csv values for one survey data row
+        :param pt_geom: point geometry for the row
+        :param extra_values: values for fields following the survey data
+            fields in the output feature class
+        :return: row for an InsertCursor: pt_geom, the converted survey
+            data field values, then extra_values
+        """
+        out_row = [pt_geom]
+        for index, convert in self._columns:
+            out_row.append(None if index is None else convert(record[index]))
+        out_row.extend(extra_values)
+        return out_row
+
+
 # ********** FUNCTIONS **********
 
 
+def current_describe_cache():
+    """
+    :return: DescribeCache bound to the calling thread, or the cache of the
+        script's run
+    """
+    return getattr(_bound_describe_caches, 'cache', None) or \
+        _run_describe_cache
+
+
+def describe(dataset):
+    """
+    Returns the arcpy Describe object for a dataset, describing each dataset
+    only once per run or session.  Intended for inputs, whose properties do
+    not change during the run.
+    :param dataset: full path to dataset
+    :return: arcpy Describe object
+    """
+    return current_describe_cache().describe(dataset)
+
+
+def lat_long_crs():
+    """
+    Returns the spatial reference for lat/long decimal degree coordinates,
+    created on first use.
+    """
+    return current_describe_cache().lat_long_crs()
+
+
+def existing_path(pathname):
+    """
+    Verifies pathname is a path to an existing file or directory, without
+    loading arcpy.
+    :param pathname: full path to file or directory
+    :return: verified pathname
+    An argparse.ArgumentTypeError is raised if pathname does not exist.
+    """
+    if not os.path.exists(pathname):
+        raise argparse.ArgumentTypeError\
+            ("Cannot find {}".format(pathname))
+
+    return pathname
+
+
+def log_dry_run(run_files, run_options):
+    """
+    Logs the files and options of a planned run, without loading arcpy or
+    reading any data.
+    :param run_files: list of (description, path) tuples for the run's input
+        and output files
+    :param run_options: list of (name, value) tuples for the run's options
+    :return: N/A
+    """
+    log.info(" Dry run: no data will be read or written")
+    for description, pathname in run_files:
+        if os.path.isfile(pathname):
+            status = "{:.1f} MB".format(os.path.getsize(pathname) /
+                                        (1024.0 * 1024.0))
+        elif os.path.isdir(pathname):
+            status = "directory"
+        else:
+            status = "not yet created"
+        log.info(" {}: {} ({})".format(description, pathname, status))
+    for name, value in run_options:
+        log.info(" {} = {}".format(name, value))
+
+
 def valid_gdb(gdb_path):
     """
     Verifies gdb_path is a a path to an existing and valid geodatabase
@@ -110,8 +512,11 @@ def valid_gdb(gdb_path):
     :return: verified gdb_path
     An argparse.ArgumentTypeError is raised if gdb_path is not valid.
     """
+    if not os.path.exists(gdb_path):
+        raise argparse.ArgumentTypeError\
+            ("Geodatabase {} does not exist.".format(gdb_path))
     try:
-        desc = arcpy.Describe(gdb_path)
+        desc = describe(gdb_path)
         assert desc.DataType == 'Workspace'
         assert desc.workspacetype == 'LocalDatabase'
     except IOError:
@@ -162,7 +567,7 @@ def valid_gdb_file(gdb_file_path):
     An argparse.ArgumentTypeError is raised if gdb_file_path is not valid.
     """
     try:
-        desc = arcpy.Describe(gdb_file_path)
+        desc = describe(gdb_file_path)
         assert desc.DataType == 'FeatureClass'
     except IOError:
         raise argparse.ArgumentTypeError\
@@ -184,7 +589,7 @@ def get_valid_polyline_pathname(gdb_path, line_fc_name):
     """
     polyline_pathname = os.path.join(gdb_path, line_fc_name)
     try:
-        desc = arcpy.Describe(polyline_pathname)
+        desc = describe(polyline_pathname)
         assert desc.DataType == 'FeatureClass'
         assert desc.featureType == 'Simple'
         assert desc.shapeType == 'Polyline'
@@ -211,13 +616,81 @@ def get_stream_geom(streams_pathname, llid):
                                                       ["SHAPE@"],
                                                       where_clause)]
     if len(selected) > 1:
-        logging.warning((" Multiple matches for stream with {} {}. ".
-                         format(LLID, llid) +
-                         "Using first match."))
+        log.warning((" Multiple matches for stream with {} {}. ".
+                     format(LLID, llid) +
+                     "Using first match."))
 
     return selected[0]
 
 
+def estimate_geom_bytes(stream_geom):
+    """
+    Estimates the memory used by a geometry object, from its vertex count.
+    :param stream_geom: geometry object
+    :return: estimated size in bytes
+    """
+    return GEOM_BYTES_OVERHEAD + GEOM_BYTES_PER_VERTEX * stream_geom.pointCount
+
+
+def match_csv_column(field_name, csv_headings):
+    """
+    Finds the csv column for a feature class field: the column with the
+    same name, ignoring case, or else the column whose name, cut to the
+    length of a shapefile field name, matches.
+    :param field_name: feature class field name
+    :param csv_headings: column names from the csv header
+    :return: index of matching column, or None if there is none
+    """
+    lower_headings = [heading.lower() for heading in csv_headings]
+    if field_name.lower() in lower_headings:
+        return lower_headings.index(field_name.lower())
+    if len(field_name) == SHAPEFILE_FIELD_NAME_LEN:
+        for index, heading in enumerate(lower_headings):
+            if heading[:SHAPEFILE_FIELD_NAME_LEN] == field_name.lower():
+                return index
+    return None
+
+
+def field_conversion(field):
+    """
+    Builds the function converting csv values for a feature class field:
+    numbers are parsed for numeric fields, text is cut to the field length,
+    and blank values become 0 for fish count fields and null otherwise.
+    :param field: arcpy Field object
+    :return: function taking a csv value string and returning a field value
+    """
+    if field.name in ZERO_FILL_FIELDS:
+        blank_value = 0
+    else:
+        blank_value = None
+
+    if field.type in INTEGER_FIELD_TYPES:
+        parse = lambda value: int(float(value))
+    elif field.type in FLOAT_FIELD_TYPES:
+        parse = float
+    elif field.type == "String":
+        if blank_value is not None:
+            blank_value = str(blank_value)
+        max_len = field.length
+        cut_len = max_len - len(TRUNCATION_MARK)
+        parse = lambda value: value if len(value) <= max_len else \
+            value[:cut_len] + TRUNCATION_MARK
+    else:
+        parse = lambda value: value
+
+    def convert(value):
+        if value == "":
+            return blank_value
+        try:
+            return parse(value)
+        except ValueError:
+            log.warning(" Invalid value '{}' for field {}; using null".
+                        format(value, field.name))
+            return None
+
+    return convert
+
+
 def new_sdi_object(llid, streamname, trib_to, adj_factors):
     """
     Create a new StreamDistanceInfo object with the attributes given
@@ -254,7 +727,49 @@ def add_adj_factors_to_sdi(adj_factor_dictionary, llid, adj_factors):
     sdi_obj.adj_factors = adj_factors
 
 
-def write_sdi_to_csv_file(sdi_dict, sdi_filepath):
+def file_compression(filepath):
+    """
+    Detects whether a file is compressed, from its first bytes.
+    :param filepath: full path to file
+    :return: GZIP, XZ, or None for an uncompressed file
+    """
+    with open(filepath, 'rb') as in_file:
+        first_bytes = in_file.read(max(len(magic) for compression, magic
+                                       in COMPRESSION_MAGIC))
+    for compression, magic in COMPRESSION_MAGIC:
+        if first_bytes.startswith(magic):
+            return compression
+    return None
+
+
+def open_csv_file(filepath, mode='rb', compression=None):
+    """
+    Opens a csv file, decompressing or compressing it as a stream.
+    :param filepath: full path to file
+    :param mode: 'rb' to read, 'wb' to write
+    :param compression: for writing, GZIP, XZ or None; for reading, the
+        compression is detected from the file's first bytes
+    :return: binary file object, for use with csv.reader or csv.writer
+    """
+    if mode == 'rb':
+        compression = file_compression(filepath)
+    if compression is None:
+        return open(filepath, mode)
+    if compression == GZIP:
+        compressed_file = gzip.open(filepath, mode)
+    elif lzma is None:
+        raise IOError("Reading or writing xz file {} requires lzma ".
+                      format(filepath) + "(backports.lzma on Python 2)")
+    else:
+        compressed_file = lzma.LZMAFile(filepath, mode)
+    log.debug(" opened {} file {}".format(compression, filepath))
+    if mode == 'rb':
+        # Buffered reads make line iteration much faster
+        return io.BufferedReader(compressed_file)
+    return compressed_file
+
+
+def write_sdi_to_csv_file(sdi_dict, sdi_filepath, compression=None):
     """
     Writes the contents of the given stream distance info dictionary to the
     given filepath.  One row is written for each adjustment factor, yielding
@@ -264,6 +779,7 @@ def write_sdi_to_csv_file(sdi_dict, sdi_filepath):
         StreamDistanceInfo object, with a sequence of adjustment factors.
     :param sdi_filepath: full path to csv file where dictionary contents
         will be written
+    :param compression: GZIP or XZ to write a compressed file, or None
     :return: N/A, file at sdi_filepath is created and populated
     """
     # Column headers
@@ -275,14 +791,16 @@ def write_sdi_to_csv_file(sdi_dict, sdi_filepath):
                   BEGIN_+X_COORD, BEGIN_+Y_COORD,
                   BEGIN_+XY_NOTE,
                   BEGIN_+SURVEY_COMMENT,
+                  BEGIN_+SNAP_OFFSET,
                   END_+SURVEY_CUM_DISTANCE,
                   END_+STREAMLINE_CUM_DISTANCE,
                   END_+X_COORD, END_+Y_COORD,
                   END_+XY_NOTE,
                   END_+SURVEY_COMMENT,
+                  END_+SNAP_OFFSET,
                   ADJ_FACTOR]
 
-    with open(sdi_filepath, 'wb') as csvfile:
+    with open_csv_file(sdi_filepath, 'wb', compression) as csvfile:
         adj_fact_writer = csv.writer(csvfile)
         adj_fact_writer.writerow(fieldnames)
         # Loop through each stream LLID in dictionary
@@ -291,15 +809,15 @@ def write_sdi_to_csv_file(sdi_dict, sdi_filepath):
             # Write a row for each adjustment factor, including
             # begin and end sync points
             for begin_sync_pt, end_sync_pt, adj_factor in sdi_obj.adj_factors:
-                logging.debug(" {}".format
-                      (chain_data_two_levels(stream_id,
-                                             sdi_obj.name,
-                                             sdi_obj.trib_to,
-                                             expand_sync_pt(begin_sync_pt,
-                                                         DEFAULT_BEGIN_DIST),
-                                             expand_sync_pt(end_sync_pt,
-                                                         DEFAULT_END_DIST),
-                                             adj_factor)))
+                log.debug(" {}".format
+                  (chain_data_two_levels(stream_id,
+                                         sdi_obj.name,
+                                         sdi_obj.trib_to,
+                                         expand_sync_pt(begin_sync_pt,
+                                                     DEFAULT_BEGIN_DIST),
+                                         expand_sync_pt(end_sync_pt,
+                                                     DEFAULT_END_DIST),
+                                         adj_factor)))
                 adj_fact_writer.writerow\
                     (chain_data_two_levels
                      ("'{}'".format(stream_id),  # need to force LLID to be text
@@ -316,8 +834,9 @@ def read_sdi_from_csvfile(sdi_filepath):
     Reads the contents of the given filepath into a stream distance info
     dictionary.
     :param sdi_filepath: full path to csv file containing stream distance
-        information.  There is one row for each adjustment factor, so there
-         may be multiple rows for the same dictionary key LLID.
+        information, possibly gzip or xz compressed.  There is one row for
+        each adjustment factor, so there may be multiple rows for the same
+        dictionary key LLID.
     :return: dictionary of stream distance adjustment information,
         keyed on stream LLID.  Each value contains a StreamDistanceInfo object,
         with a sequence of adjustment factors.  Each adjustment factor is a
@@ -326,7 +845,7 @@ def read_sdi_from_csvfile(sdi_filepath):
     stream_distance_info_dict = {}
     adj_factors = []
     prev_llid = ""
-    with open(sdi_filepath, 'rb') as sdi_file:
+    with open_csv_file(sdi_filepath) as sdi_file:
         # Read and process each row in csv file as namedtuple
         sdi_file_reader = csv.reader(sdi_file)
         headings = sdi_file_reader.next()
@@ -358,14 +877,16 @@ def read_sdi_from_csvfile(sdi_filepath):
                  str(row.Begin_XY_Note),
                  int(row.Begin_Survey_Cum_Dist),
                  float(row.Begin_Streamline_Cum_Dist),
-                 str(row.Begin_Comment))
+                 str(row.Begin_Comment),
+                 parse_float_or_NA(getattr(row, BEGIN_+SNAP_OFFSET, "")))
             end_sync_pt = create_syncpoint\
                 (parse_float_or_NA(row.End_X_coord),
                  parse_float_or_NA(row.End_Y_coord),
                  str(row.End_XY_Note),
                  int(row.End_Survey_Cum_Dist),
                  float(row.End_Streamline_Cum_Dist),
-                 str(row.End_Comment))
+                 str(row.End_Comment),
+                 parse_float_or_NA(getattr(row, END_+SNAP_OFFSET, "")))
             adj_factor = float(row.Adj_Factor)
             #  Add this adjustment factor to the list for this SDI object
             adj_factors.append((begin_sync_pt, end_sync_pt, adj_factor))
@@ -381,7 +902,7 @@ def read_sdi_from_csvfile(sdi_filepath):
 
 def create_syncpoint(in_x_coord, in_y_coord, xy_note,
                     survey_cum_dist, streamline_cum_dist,
-                    survey_comment):
+                    survey_comment, snap_offset=None):
     """
     Creates a new SyncPoint object with the given attributes
     :param in_x_coord: x coordinate for sync point
@@ -391,6 +912,8 @@ def create_syncpoint(in_x_coord, in_y_coord, xy_note,
     :param survey_cum_dist: survey-reported cumulative distance
     :param streamline_cum_dist: cumulative distance calculated along streamline
     :param survey_comment: text fields with notes about survey data/point
+    :param snap_offset: distance from x,y coordinates to the stream, or
+        None if the sync point was not snapped (or SDI predates this field)
     :return: new SyncPoint object with all fields populated
     """
     syncpt = SyncPoint()
@@ -400,10 +923,21 @@ def create_syncpoint(in_x_coord, in_y_coord, xy_note,
     syncpt.survey_cum_dist = survey_cum_dist
     syncpt.streamline_cum_dist = streamline_cum_dist
     syncpt.survey_comment = survey_comment
-    logging.debug(" created syncpt {}".format(syncpt))
+    syncpt.snap_offset = snap_offset
+    log.debug(" created syncpt {}".format(syncpt))
     return syncpt
 
 
+def stream_end_sync_point():
+    """
+    Creates the SyncPoint ending a stream's last adjustment factor when no
+    x,y sync point follows it, as read from a stream distance info file.
+    :return: SyncPoint with no coordinates, at DEFAULT_END_DIST
+    """
+    return create_syncpoint(None, None, "", DEFAULT_END_DIST,
+                            DEFAULT_END_DIST, "")
+
+
 def expand_sync_pt(sync_pt, default_distance):
     """
     Returns a tuple representing the values of the attribues for the given
@@ -413,17 +947,19 @@ def expand_sync_pt(sync_pt, default_distance):
     :param default_distance: Distance to use for values of
         survey_cum_dist and streamline_cum_dist, when input sync_pt is None.
     :return: tuple of (survey_cum_dist, streamline_cum_dist,
-        x_coord, y_coord, xy_note, survey_comment) values for sync_pt
+        x_coord, y_coord, xy_note, survey_comment, snap_offset) values for
+        sync_pt
     """
     if sync_pt is None:
-        return (default_distance, default_distance, "", "", "", "")
+        return (default_distance, default_distance, "", "", "", "", "")
     else:
         return (sync_pt.survey_cum_dist, \
                 sync_pt.streamline_cum_dist, \
                 sync_pt.x_coord, \
                 sync_pt.y_coord, \
                 sync_pt.xy_note, \
-                sync_pt.survey_comment)
+                sync_pt.survey_comment, \
+                "" if sync_pt.snap_offset is None else sync_pt.snap_offset)
 
 def chain_data_two_levels(*elements):
     """
@@ -0,0 +1,290 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Single-file, spatially ordered point output with a packed
+# static R-tree index, in the style of FlatGeobuf.  Points are sorted along
+# a Hilbert curve over their extent, so points near each other are stored
+# near each other, and an R-tree of fixed node size is built bottom-up over
+# the sorted points.  A bounding box query reads only the index nodes and
+# points that can intersect the box.
+#
+#   File layout (little-endian):
+#       magic bytes (MAGIC)
+#       uint32 header length, then header as UTF-8 JSON: field names,
+#           point count, node size, extent and spatial reference
+#       index: NODE_FORMAT nodes (min x, min y, max x, max y, offset), root
+#           first and leaves last.  A leaf's offset is the byte offset of its
+#           point in the data section; any other node's offset is the index
+#           of its first child node.
+#       data: per point, uint32 length of field values, x and y as doubles,
+#           field values as UTF-8 JSON list
+#
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): https://flatgeobuf.org/
+#            https://en.wikipedia.org/wiki/Hilbert_R-tree
+#            https://en.wikipedia.org/wiki/Hilbert_curve
+#            https://docs.python.org/2/library/struct.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import logging
+import struct
+import json
+from collections import deque
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+MAGIC = b"RBAPRT\x01\x00"
+PACKED_FILE_SUFFIX = ".rbapts"
+DEFAULT_NODE_SIZE = 16  # children per R-tree node
+HILBERT_SIZE = 2 ** 16  # Hilbert curve grid cells along each axis
+
+HEADER_LEN_FORMAT = "<I"
+NODE_FORMAT = "<ddddQ"
+NODE_BYTES = struct.calcsize(NODE_FORMAT)
+POINT_FORMAT = "<Idd"
+POINT_BYTES = struct.calcsize(POINT_FORMAT)
+
+
+# ********** CLASSES **********
+
+class PackedPointReader(object):
+    """
+    Reader for a packed point file, with bounding box queries.  Can be used
+    as a context manager, which closes the file.
+    """
+
+    def __init__(self, packed_filepath):
+        self.packed_filepath = packed_filepath
+        self._file = open(packed_filepath, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise IOError("{} is not a packed point file".
+                          format(packed_filepath))
+        header_len, = struct.unpack(HEADER_LEN_FORMAT,
+                                    self._file.read(struct.calcsize
+                                                    (HEADER_LEN_FORMAT)))
+        self.header = json.loads(self._file.read(header_len).decode('utf-8'))
+        self.fields = self.header["fields"]
+        self.count = self.header["count"]
+        self.node_size = self.header["node_size"]
+        self.extent = self.header["extent"]
+        self.level_bounds = level_bounds(self.count, self.node_size)
+        num_nodes = self.level_bounds[0][1] if self.level_bounds else 0
+        self._index_start = self._file.tell()
+        self._data_start = self._index_start + num_nodes * NODE_BYTES
+
+    def __repr__(self):
+        return "PackedPointReader {}, {} points, {} fields".\
+            format(self.packed_filepath, self.count, len(self.fields))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __iter__(self):
+        """
+        Generates every point, in Hilbert order.
+        """
+        self._file.seek(self._data_start)
+        for i in range(self.count):
+            yield self._read_point()
+
+    def query(self, min_x, min_y, max_x, max_y):
+        """
+        Generates the points within a bounding box (edges included), in
+        Hilbert order.
+        :return: generator yielding (x, y, field values list) tuples
+        """
+        for offset in sorted(self._search(min_x, min_y, max_x, max_y)):
+            self._file.seek(self._data_start + offset)
+            yield self._read_point()
+
+    def _search(self, min_x, min_y, max_x, max_y):
+        """
+        Finds the data offsets of leaf nodes intersecting a bounding box,
+        visiting only the nodes whose parents intersect it.
+        """
+        if not self.count:
+            return []
+        offsets = []
+        leaf_level = 0
+        pending = deque([(0, len(self.level_bounds) - 1)])
+        while pending:
+            node_num, level = pending.popleft()
+            level_end = self.level_bounds[level][1]
+            end_num = min(node_num + self.node_size, level_end)
+            self._file.seek(self._index_start + node_num * NODE_BYTES)
+            nodes = self._file.read((end_num - node_num) * NODE_BYTES)
+            for i in range(end_num - node_num):
+                node_min_x, node_min_y, node_max_x, node_max_y, offset = \
+                    struct.unpack_from(NODE_FORMAT, nodes, i * NODE_BYTES)
+                if node_max_x < min_x or node_min_x > max_x or \
+                        node_max_y < min_y or node_min_y > max_y:
+                    continue
+                if level == leaf_level:
+                    offsets.append(offset)
+                else:
+                    pending.append((offset, level - 1))
+        return offsets
+
+    def _read_point(self):
+        values_len, x, y = struct.unpack(POINT_FORMAT,
+                                         self._file.read(POINT_BYTES))
+        values = json.loads(self._file.read(values_len).decode('utf-8'))
+        return x, y, values
+
+
+# ********** FUNCTIONS **********
+
+def level_bounds(num_items, node_size):
+    """
+    Computes where each level of a packed R-tree lies in its node array.
+    :param num_items: number of points (leaf nodes)
+    :param node_size: children per node
+    :return: list of (first node, end node) tuples, from the leaf level to
+        the root level; empty if there are no points
+    """
+    if num_items == 0:
+        return []
+    level_num_nodes = [num_items]
+    num_nodes = num_items
+    while num_nodes > 1:
+        num_nodes = (num_nodes + node_size - 1) // node_size
+        level_num_nodes.append(num_nodes)
+    # Root level first in the node array, leaf level last
+    bounds = []
+    end_num = sum(level_num_nodes)
+    for num_nodes in level_num_nodes:
+        bounds.append((end_num - num_nodes, end_num))
+        end_num -= num_nodes
+    return bounds
+
+
+def hilbert_value(x, y, extent):
+    """
+    Computes the position of a point along a Hilbert curve covering extent.
+    :param x: x coordinate of point
+    :param y: y coordinate of point
+    :param extent: (min x, min y, max x, max y) of all points
+    :return: integer distance along the curve
+    """
+    min_x, min_y, max_x, max_y = extent
+    width = max_x - min_x
+    height = max_y - min_y
+    cell_x = int((HILBERT_SIZE - 1) * (x - min_x) / width) if width else 0
+    cell_y = int((HILBERT_SIZE - 1) * (y - min_y) / height) if height else 0
+    distance = 0
+    step = HILBERT_SIZE // 2
+    while step > 0:
+        rx = 1 if cell_x & step else 0
+        ry = 1 if cell_y & step else 0
+        distance += step * step * ((3 * rx) ^ ry)
+        # Rotate quadrant so the curve continues in the right direction
+        if ry == 0:
+            if rx == 1:
+                cell_x = HILBERT_SIZE - 1 - cell_x
+                cell_y = HILBERT_SIZE - 1 - cell_y
+            cell_x, cell_y = cell_y, cell_x
+        step //= 2
+    return distance
+
+
+def write_packed_points(packed_filepath, fields, points,
+                        node_size=DEFAULT_NODE_SIZE, spatial_reference=None):
+    """
+    Writes points to a packed point file, sorted along a Hilbert curve,
+    with a packed R-tree index.  The file is written under a temporary name
+    and renamed when complete.
+    :param packed_filepath: path of file to write
+    :param fields: names of the field values of each point
+    :param points: iterable of (x, y, field values) tuples
+    :param node_size: children per R-tree node
+    :param spatial_reference: text identifying the points' spatial
+        reference (e.g. WKT), stored in the header; may be None
+    :return: number of points written
+    """
+    points = list(points)
+    if points:
+        extent = (min(pt[0] for pt in points), min(pt[1] for pt in points),
+                  max(pt[0] for pt in points), max(pt[1] for pt in points))
+    else:
+        extent = (0.0, 0.0, 0.0, 0.0)
+    points.sort(key=lambda pt: hilbert_value(pt[0], pt[1], extent))
+
+    # Point records and the leaf node of each
+    data_chunks = []
+    leaf_nodes = []
+    offset = 0
+    for x, y, values in points:
+        encoded = json.dumps(list(values), default=str).encode('utf-8')
+        data_chunks.append(struct.pack(POINT_FORMAT, len(encoded), x, y))
+        data_chunks.append(encoded)
+        leaf_nodes.append((x, y, x, y, offset))
+        offset += POINT_BYTES + len(encoded)
+
+    # Build parent levels bottom-up; each parent covers node_size children
+    bounds = level_bounds(len(points), node_size)
+    nodes = [None] * (bounds[0][1] if bounds else 0)
+    if bounds:
+        nodes[bounds[0][0]:bounds[0][1]] = leaf_nodes
+    for level in range(len(bounds) - 1):
+        child_start, child_end = bounds[level]
+        parent_num = bounds[level + 1][0]
+        for first_child in range(child_start, child_end, node_size):
+            children = nodes[first_child:min(first_child + node_size,
+                                             child_end)]
+            nodes[parent_num] = (min(node[0] for node in children),
+                                 min(node[1] for node in children),
+                                 max(node[2] for node in children),
+                                 max(node[3] for node in children),
+                                 first_child)
+            parent_num += 1
+
+    header = json.dumps({"fields": list(fields), "count": len(points),
+                         "node_size": node_size, "extent": extent,
+                         "spatial_reference": spatial_reference}).\
+        encode('utf-8')
+    temp_filepath = packed_filepath + ".tmp"
+    with open(temp_filepath, 'wb') as packed_file:
+        packed_file.write(MAGIC)
+        packed_file.write(struct.pack(HEADER_LEN_FORMAT, len(header)))
+        packed_file.write(header)
+        for node in nodes:
+            packed_file.write(struct.pack(NODE_FORMAT, *node))
+        for chunk in data_chunks:
+            packed_file.write(chunk)
+    if os.path.exists(packed_filepath):
+        os.remove(packed_filepath)
+    os.rename(temp_filepath, packed_filepath)
+    log.info(" wrote {} points in Hilbert order to {}".
+             format(len(points), packed_filepath))
+    return len(points)
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,326 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Reader for RBA survey CSV files.  Small files (or a single
+# worker) are read with a plain csv.reader.  Large files are memory-mapped
+# and split into byte ranges which start on a record boundary and on a
+# change of stream location ID (LLID), so that no stream's rows are split
+# between chunks.  Chunks are parsed in parallel worker processes and the
+# parsed rows are handed back in original file order.  gzip or xz
+# compressed files are decompressed as a stream and read serially.  This
+# file is for import by top-level scripts only.
+#
+# SOURCE(S): https://docs.python.org/2/library/mmap.html
+#            https://docs.python.org/2/library/multiprocessing.html
+#            https://tools.ietf.org/html/rfc4180
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import logging
+import csv
+import mmap
+import multiprocessing
+import RBA_georef_util as rgutil
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+SURVEY_LLID = "LLID_num"  # survey csv column holding the stream LLID
+
+MIN_PARALLEL_FILE_SIZE = 8 * 1024 * 1024  # smaller files are read serially
+CHUNK_SIZE = 32 * 1024 * 1024  # target size of a parsed byte range
+QUOTE_COUNT_BLOCK_SIZE = 8 * 1024 * 1024  # bytes scanned per quote count
+CHUNKS_IN_FLIGHT_PER_WORKER = 2  # bounds parsed rows held in memory
+
+QUOTE = b'"'
+NEWLINE = b'\n'
+
+
+# ********** CLASSES **********
+
+class _RangeLineReader(object):
+    """
+    Line iterator over the byte range [start, end) of a memory-mapped file.
+    Lines keep their line endings, so csv.reader sees embedded newlines in
+    quoted fields.  pos is the offset just past the last line returned;
+    since csv.reader never reads ahead, pos is the start of the next record
+    each time a record is returned.
+    """
+
+    def __init__(self, mm, start, end):
+        self.mm = mm
+        self.pos = start
+        self.end = end
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.pos >= self.end:
+            raise StopIteration
+        newline_pos = self.mm.find(NEWLINE, self.pos, self.end)
+        if newline_pos == -1:
+            line_end = self.end
+        else:
+            line_end = newline_pos + 1
+        line = self.mm[self.pos:line_end]
+        self.pos = line_end
+        if not isinstance(line, str):
+            line = line.decode('utf-8')
+        return line
+
+    __next__ = next
+
+
+class SurveyCsvReader(object):
+    """
+    Context manager and iterator over the records of a survey CSV file,
+    used in place of csv.reader: the first record returned is the header
+    row, followed by each data row as a list of strings.  When more than one
+    parse worker is requested and the file is large enough, records are
+    parsed in parallel, in chunks aligned to LLID boundaries.
+    """
+
+    def __init__(self, csv_filename, parse_workers=1):
+        self.csv_filename = csv_filename
+        self.parse_workers = parse_workers
+        self._csv_file = None
+        self._pool = None
+        self._records = None
+
+    def __enter__(self):
+        file_size = os.path.getsize(self.csv_filename)
+        compression = rgutil.file_compression(self.csv_filename)
+        if self.parse_workers > 1 and compression is not None:
+            log.info(" {} is {} compressed; reading it serially".
+                     format(self.csv_filename, compression))
+        if self.parse_workers > 1 and file_size >= MIN_PARALLEL_FILE_SIZE \
+                and compression is None:
+            self._records = self._parallel_records()
+        else:
+            self._csv_file = rgutil.open_csv_file(self.csv_filename)
+            self._records = csv.reader(self._csv_file)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._pool is not None:
+            if exc_type is None:
+                self._pool.close()
+            else:
+                self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+        return False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._records)
+
+    __next__ = next
+
+    def _parallel_records(self):
+        """
+        Generator yielding the header row, then the rows of each chunk in
+        file order.  At most parse_workers * CHUNKS_IN_FLIGHT_PER_WORKER
+        chunks are parsed ahead of the consumer.
+        """
+        headings, chunk_ranges = plan_survey_chunks(self.csv_filename,
+                                                    self.parse_workers)
+        log.info(" parsing {} in {} chunks with {} workers".
+                 format(self.csv_filename, len(chunk_ranges),
+                        self.parse_workers))
+        yield headings
+
+        self._pool = multiprocessing.Pool(self.parse_workers)
+        max_in_flight = self.parse_workers * CHUNKS_IN_FLIGHT_PER_WORKER
+        pending = []
+        next_chunk = 0
+        while next_chunk < len(chunk_ranges) or pending:
+            while next_chunk < len(chunk_ranges) and \
+                    len(pending) < max_in_flight:
+                start, end = chunk_ranges[next_chunk]
+                pending.append(self._pool.apply_async
+                               (parse_chunk,
+                                ((self.csv_filename, start, end),)))
+                next_chunk += 1
+            # Results are collected in submission order to preserve row order
+            for row in pending.pop(0).get():
+                yield row
+
+
+# ********** FUNCTIONS **********
+
+def open_survey_csv(csv_filename, parse_workers=1):
+    """
+    Opens a survey CSV file for reading.
+    :param csv_filename: full path to survey csv file, possibly gzip or xz
+        compressed
+    :param parse_workers: number of worker processes used to parse the file;
+        1 reads the file serially with csv.reader, as do compressed files
+    :return: SurveyCsvReader, for use in a with statement.  Iterating over
+        it yields the header row and then each data row, in file order.
+    """
+    return SurveyCsvReader(csv_filename, parse_workers)
+
+
+def read_survey_llids(csv_filename, parse_workers=1):
+    """
+    Lists the stream LLIDs of a survey CSV file.
+    :param csv_filename: full path to survey csv file
+    :param parse_workers: number of worker processes used to parse the file
+    :return: list of distinct LLIDs, in order of first appearance; blank
+        LLIDs are left out
+    """
+    llids = []
+    with open_survey_csv(csv_filename, parse_workers) as survey_reader:
+        llid_index = next(survey_reader).index(SURVEY_LLID)
+        prev_llid = None
+        seen = set()
+        for row in survey_reader:
+            llid = row[llid_index]
+            if llid and llid != prev_llid and llid not in seen:
+                seen.add(llid)
+                llids.append(llid)
+            prev_llid = llid
+    return llids
+
+
+def plan_survey_chunks(csv_filename, parse_workers):
+    """
+    Splits a survey CSV file into byte ranges for parallel parsing.  Each
+    range starts at the beginning of a record whose LLID differs from the
+    LLID of the preceding record, so all rows for a stream fall in a single
+    range.
+    :param csv_filename: full path to survey csv file
+    :param parse_workers: number of worker processes that will parse ranges
+    :return: tuple of (header row, list of (start, end) byte offsets)
+    """
+    with open(csv_filename, 'rb') as csv_file:
+        mm = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            file_size = len(mm)
+            header_reader = _RangeLineReader(mm, 0, file_size)
+            headings = next(csv.reader(header_reader))
+            header_end = header_reader.pos
+            llid_index = headings.index(SURVEY_LLID)
+
+            num_chunks = max(parse_workers,
+                             (file_size - header_end) // CHUNK_SIZE + 1)
+            boundaries = [header_end]
+            for i in range(1, num_chunks):
+                target = header_end + \
+                    (file_size - header_end) * i // num_chunks
+                if target <= boundaries[-1]:
+                    continue
+                boundary = _next_record_boundary(mm, boundaries[-1], target)
+                boundary = _next_llid_boundary(mm, boundary, llid_index)
+                if boundaries[-1] < boundary < file_size:
+                    boundaries.append(boundary)
+            boundaries.append(file_size)
+        finally:
+            mm.close()
+
+    chunk_ranges = [(boundaries[i], boundaries[i + 1])
+                    for i in range(len(boundaries) - 1)
+                    if boundaries[i] < boundaries[i + 1]]
+    log.debug(" survey chunk ranges = {}".format(chunk_ranges))
+    return headings, chunk_ranges
+
+
+def parse_chunk(chunk_spec):
+    """
+    Parses the records in one byte range of a survey CSV file.  Runs in a
+    worker process.
+    :param chunk_spec: tuple of (csv_filename, start offset, end offset)
+    :return: list of rows, each a list of field strings
+    """
+    csv_filename, start, end = chunk_spec
+    with open(csv_filename, 'rb') as csv_file:
+        mm = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            rows = list(csv.reader(_RangeLineReader(mm, start, end)))
+        finally:
+            mm.close()
+    return rows
+
+
+def _count_quotes(mm, start, end):
+    """
+    Counts double quote characters in mm[start:end], a block at a time.
+    """
+    count = 0
+    for block_start in range(start, end, QUOTE_COUNT_BLOCK_SIZE):
+        block_end = min(block_start + QUOTE_COUNT_BLOCK_SIZE, end)
+        count += mm[block_start:block_end].count(QUOTE)
+    return count
+
+
+def _next_record_boundary(mm, record_start, target):
+    """
+    Finds the first record boundary at or after target.  A newline ends a
+    record only when it is outside quotes, i.e. when the number of quote
+    characters since a known record start is even (escaped quotes come in
+    pairs and do not change the parity).
+    :param mm: memory-mapped survey file
+    :param record_start: offset of a known record start before target
+    :param target: offset at which to begin looking for a boundary
+    :return: offset of the start of a record, or len(mm)
+    """
+    quotes = _count_quotes(mm, record_start, target)
+    pos = target
+    while True:
+        newline_pos = mm.find(NEWLINE, pos)
+        if newline_pos == -1:
+            return len(mm)
+        quotes += _count_quotes(mm, pos, newline_pos)
+        pos = newline_pos + 1
+        if quotes % 2 == 0:
+            return pos
+
+
+def _next_llid_boundary(mm, record_start, llid_index):
+    """
+    Finds the first record at or after record_start with an LLID different
+    from the LLID of the record at record_start.
+    :param mm: memory-mapped survey file
+    :param record_start: offset of the start of a record
+    :param llid_index: column index of the LLID field
+    :return: offset of the start of that record, or len(mm)
+    """
+    line_reader = _RangeLineReader(mm, record_start, len(mm))
+    first_llid = None
+    row_start = record_start
+    for row in csv.reader(line_reader):
+        llid = row[llid_index] if len(row) > llid_index else ""
+        if first_llid is None:
+            first_llid = llid
+        elif llid != first_llid:
+            return row_start
+        row_start = line_reader.pos
+    return len(mm)
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Three-stage pipeline for overlapping survey file reading,
+# georeferencing computation and output writes.  A reader thread fills a
+# bounded queue from the input, the calling thread transforms items, and a
+# writer thread, which owns the output cursor, drains a second bounded
+# queue.  Full queues block the stage feeding them (backpressure), items
+# keep their original order, and an exception in any stage stops the other
+# stages and is raised in the calling thread.  This file is for import by
+# top-level scripts only.
+#
+# SOURCE(S): https://docs.python.org/2/library/threading.html
+#            https://docs.python.org/2/library/queue.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import logging
+import threading
+try:
+    import Queue as queue  # Python 2
+except ImportError:
+    import queue
+import RBA_georef_util as rgutil
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+DEFAULT_QUEUE_SIZE = 1000  # items buffered between stages
+POLL_SECONDS = 0.1  # how often blocked stages check for a failed stage
+
+
+# ********** CLASSES **********
+
+class _EndOfStream(object):
+    """
+    Marker placed on a queue after the last item.
+    """
+    pass
+
+END_OF_STREAM = _EndOfStream()
+
+
+class PipelineAborted(Exception):
+    """
+    Raised inside a stage when another stage has failed.
+    """
+    pass
+
+
+class Pipeline(object):
+    """
+    Shared state for the stages of one pipeline run: the stop flag and the
+    first exception raised by any stage.
+    """
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.error = None
+        self._lock = threading.Lock()
+
+    def fail(self, error):
+        """
+        Records a stage failure and tells the other stages to stop.
+        """
+        with self._lock:
+            if self.error is None:
+                self.error = error
+        self.stopped.set()
+
+    def put(self, item_queue, item):
+        """
+        Puts item on item_queue, blocking while the queue is full unless
+        the pipeline is stopped.
+        """
+        while True:
+            if self.stopped.is_set():
+                raise PipelineAborted()
+            try:
+                item_queue.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+
+    def items(self, item_queue):
+        """
+        Generates items from item_queue until the end of stream marker,
+        blocking while the queue is empty unless the pipeline is stopped.
+        """
+        while True:
+            if self.stopped.is_set():
+                raise PipelineAborted()
+            try:
+                item = item_queue.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is END_OF_STREAM:
+                return
+            yield item
+
+
+# ********** FUNCTIONS **********
+
+def run_pipeline(source, transform, sink, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Runs source, transform and sink as overlapping stages.
+    :param source: iterable of input items; iterated in the reader thread,
+        so any file it reads is opened and read there
+    :param transform: function taking an iterator of input items and
+        returning an iterable of output items; run in the calling thread
+    :param sink: function taking an iterator of output items and consuming
+        all of them; run in the writer thread, so any cursor it opens is
+        owned by that thread
+    :param queue_size: maximum number of items held between two stages
+    :return: N/A; an exception raised by any stage is re-raised
+    """
+    pipeline = Pipeline()
+    caller_logger = log.current()  # stage threads log as the caller does
+    caller_describes = rgutil.current_describe_cache()  # and share its cache
+    input_queue = queue.Queue(queue_size)
+    output_queue = queue.Queue(queue_size)
+
+    def read_stage():
+        with log.bind(caller_logger), caller_describes.bind():
+            try:
+                for item in source:
+                    pipeline.put(input_queue, item)
+                pipeline.put(input_queue, END_OF_STREAM)
+            except PipelineAborted:
+                pass
+            except Exception as err:
+                log.exception(" pipeline reader failed")
+                pipeline.fail(err)
+            finally:
+                # Let a generator source close any file it has open
+                if hasattr(source, 'close'):
+                    source.close()
+
+    def write_stage():
+        with log.bind(caller_logger), caller_describes.bind():
+            try:
+                sink(pipeline.items(output_queue))
+            except PipelineAborted:
+                pass
+            except Exception as err:
+                log.exception(" pipeline writer failed")
+                pipeline.fail(err)
+
+    reader = threading.Thread(target=read_stage, name="pipeline-reader")
+    writer = threading.Thread(target=write_stage, name="pipeline-writer")
+    reader.daemon = True
+    writer.daemon = True
+    reader.start()
+    writer.start()
+    try:
+        for item in transform(pipeline.items(input_queue)):
+            pipeline.put(output_queue, item)
+        pipeline.put(output_queue, END_OF_STREAM)
+    except PipelineAborted:
+        pass
+    except Exception as err:
+        pipeline.fail(err)
+        raise
+    finally:
+        reader.join()
+        writer.join()
+
+    if pipeline.error is not None:
+        raise pipeline.error
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
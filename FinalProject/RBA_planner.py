@@ -0,0 +1,377 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Execution planner for the RBA georeferencing steps.  Before
+# a run, the planner samples its inputs cheaply: the first part of the
+# survey csv file gives the rows, streams (LLIDs) and sync points per byte,
+# scaled up by the file size, and a few of those streams give the typical
+# vertex count of a stream geometry.  A cost model, with per-row,
+# per-stream and per-vertex costs measured by benchmark_RBA_georef
+# --calibrate, estimates the run time of each execution strategy:
+#
+#       serial: one process reads the survey file; each stream geometry
+#           is fetched with its own query as its rows are reached
+#       batched: stream geometries are preloaded with a few large queries,
+#           within the geometry cache budget, and (when georeferencing)
+#           reading, georeferencing and writing overlap in a pipeline
+#       parallel: batched, with the survey file parsed by several worker
+#           processes; only for uncompressed files of at least
+#           RBA_parallel_csv.MIN_PARALLEL_FILE_SIZE
+#
+# The fastest strategy, and its number of parse workers, is chosen and
+# logged.  A strategy, worker count or pipeline queue size given by the
+# caller overrides the planner's choice.
+#
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): https://docs.python.org/2/library/json.html
+#            https://docs.python.org/2/library/multiprocessing.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import logging
+import csv
+import json
+import multiprocessing
+from collections import namedtuple, OrderedDict
+import RBA_georef_util as rgutil
+from RBA_georef_util import arcpy  # imported on first use
+from RBA_georef_util import log  # logger of the calling session
+import RBA_parallel_csv as rgcsv
+import RBA_pipeline as rgpipe
+
+
+# ********** GLOBAL CONSTANTS **********
+
+AUTO = "auto"  # let the planner choose
+SERIAL = "serial"
+BATCHED = "batched"
+PARALLEL = "parallel"
+STRATEGIES = [AUTO, SERIAL, BATCHED, PARALLEL]
+
+SURVEY_X = "X"  # survey csv column holding a sync point's x coordinate
+
+SAMPLE_BYTES = 1024 * 1024  # survey csv bytes read to sample its rows
+SAMPLE_STREAMS = 20  # stream geometries read to sample vertex counts
+COMPRESSION_RATIO = 5.0  # estimated csv bytes per gzip or xz file byte
+
+# Cost model written by benchmark_RBA_georef --calibrate, next to the
+# scripts
+DEFAULT_COST_MODEL_FILEPATH = os.path.join(os.path.dirname
+                                           (os.path.abspath(__file__)),
+                                           "RBA_cost_model.json")
+
+# Costs in seconds used when no calibrated cost model is found
+DEFAULT_COSTS = OrderedDict([
+    ("process_start", 0.5),  # start a parse worker process
+    ("pipeline_start", 0.05),  # start the pipeline stage threads
+    ("row_parse", 1.0e-5),  # parse one survey csv row
+    ("row_compute", 5.0e-5),  # adjust or georeference one row
+    ("row_write", 5.0e-5),  # insert one point row (georeferencing only)
+    ("sync_point", 2.0e-4),  # locate one sync point on its stream
+    ("sync_vertex", 2.0e-7),  # per stream vertex, locating a sync point
+    ("stream_query", 2.0e-2),  # fetch one stream geometry in its own query
+    ("preload_stream", 2.0e-3),  # fetch one stream geometry in a batch
+    ("vertex", 2.0e-6),  # read one vertex of a fetched stream geometry
+])
+
+
+# ********** CLASSES **********
+
+# Sampled statistics of a run's inputs; counts are estimates for the whole
+# survey file
+InputStats = namedtuple('InputStats',
+                        ['file_bytes', 'compression', 'rows', 'streams',
+                         'sync_points', 'vertices_per_stream'])
+
+# Execution plan: strategy, options for the georeferencing functions, and
+# the estimated run time in seconds
+ExecutionPlan = namedtuple('ExecutionPlan',
+                           ['strategy', 'parse_workers',
+                            'pipeline_queue_size', 'preload',
+                            'estimated_seconds'])
+
+
+class CostModel(object):
+    """
+    Estimated costs, in seconds, of the steps of a run, with the formulas
+    combining them into the run time of each strategy.
+    """
+
+    def __init__(self, costs=None, source="defaults"):
+        """
+        :param costs: dictionary of cost name to seconds, per DEFAULT_COSTS;
+            missing costs take their default
+        :param source: where the costs came from, for logging
+        """
+        self.costs = OrderedDict(DEFAULT_COSTS)
+        for name, seconds in (costs or {}).items():
+            if name not in DEFAULT_COSTS:
+                log.warning(" Ignoring unknown cost {} in {}".
+                            format(name, source))
+                continue
+            self.costs[name] = float(seconds)
+        self.source = source
+
+    def __repr__(self):
+        return "CostModel from {}: {}".\
+            format(self.source, ", ".join("{} {:.3g} s".format(name, seconds)
+                                          for name, seconds
+                                          in self.costs.items()))
+
+    def estimate_seconds(self, stats, strategy, parse_workers=1,
+                         writes_rows=False, cache_bytes=None):
+        """
+        Estimates the run time of a strategy.
+        :param stats: InputStats of the run
+        :param strategy: SERIAL, BATCHED or PARALLEL
+        :param parse_workers: number of parse worker processes, for PARALLEL
+        :param writes_rows: True when georeferencing, which writes a point
+            per row and can overlap its stages in a pipeline; False when
+            defining adjustment factors
+        :param cache_bytes: geometry cache budget, limiting preloading
+        :return: estimated seconds
+        """
+        costs = self.costs
+        parse = stats.rows * costs["row_parse"]
+        compute = stats.rows * costs["row_compute"] + \
+            stats.sync_points * (costs["sync_point"] +
+                                 stats.vertices_per_stream *
+                                 costs["sync_vertex"])
+        write = stats.rows * costs["row_write"] if writes_rows else 0.0
+        stream_vertices = stats.vertices_per_stream * costs["vertex"]
+        if strategy == SERIAL:
+            return parse + compute + write + \
+                stats.streams * (costs["stream_query"] + stream_vertices)
+
+        preloaded = min(stats.streams,
+                        preloadable_streams(stats, cache_bytes))
+        preload = preloaded * (costs["preload_stream"] + stream_vertices)
+        fetch = (stats.streams - preloaded) * \
+            (costs["stream_query"] + stream_vertices)
+        if strategy == PARALLEL:
+            parse = parse / parse_workers + \
+                parse_workers * costs["process_start"]
+        if writes_rows:
+            # Streams to preload are known from the stream distance
+            # information; the slowest pipeline stage sets the pace
+            return preload + costs["pipeline_start"] + \
+                max(parse, compute + fetch, write)
+        # Streams to preload are found by a first pass over the survey file
+        return parse + preload + parse + compute + fetch
+
+
+# ********** FUNCTIONS **********
+
+def load_cost_model(cost_model_filepath=None):
+    """
+    Reads a cost model written by benchmark_RBA_georef --calibrate.
+    :param cost_model_filepath: path of cost model json file, or None for
+        DEFAULT_COST_MODEL_FILEPATH if it exists
+    :return: CostModel; with the default costs if no file is found
+    """
+    if cost_model_filepath is None:
+        cost_model_filepath = DEFAULT_COST_MODEL_FILEPATH
+        if not os.path.exists(cost_model_filepath):
+            return CostModel()
+    with open(cost_model_filepath) as cost_model_file:
+        calibration = json.load(cost_model_file)
+    return CostModel(calibration.get("costs"), cost_model_filepath)
+
+
+def write_cost_model(cost_model, cost_model_filepath, notes=None):
+    """
+    Writes a cost model as json, for load_cost_model.
+    :param cost_model: CostModel
+    :param cost_model_filepath: path of file to write
+    :param notes: dictionary of other information to record, e.g. how the
+        costs were measured
+    :return: N/A
+    """
+    calibration = OrderedDict([("costs", cost_model.costs),
+                               ("notes", notes or {})])
+    temp_filepath = cost_model_filepath + ".tmp"
+    with open(temp_filepath, 'w') as cost_model_file:
+        json.dump(calibration, cost_model_file, indent=2)
+    if os.path.exists(cost_model_filepath):
+        os.remove(cost_model_filepath)
+    os.rename(temp_filepath, cost_model_filepath)
+
+
+def preloadable_streams(stats, cache_bytes=None):
+    """
+    Estimates how many stream geometries of typical size fit in the
+    geometry cache budget.
+    """
+    if cache_bytes is None:
+        cache_bytes = rgutil.DEFAULT_GEOM_CACHE_MB * 1024 * 1024
+    return int(cache_bytes // (rgutil.GEOM_BYTES_OVERHEAD +
+                               rgutil.GEOM_BYTES_PER_VERTEX *
+                               stats.vertices_per_stream))
+
+
+def parallel_parse_possible(stats):
+    """
+    True if the survey file is large enough, and uncompressed, for parallel
+    parsing.
+    """
+    return stats.compression is None and \
+        stats.file_bytes >= rgcsv.MIN_PARALLEL_FILE_SIZE
+
+
+def sample_input_stats(survey_data_filename, streams_pathname,
+                       sample_bytes=SAMPLE_BYTES,
+                       sample_streams=SAMPLE_STREAMS):
+    """
+    Estimates the size of a run from the first sample_bytes of its survey
+    csv file and a few of its stream geometries.
+    :param survey_data_filename: full path to survey csv file, possibly
+        gzip or xz compressed
+    :param streams_pathname: feature class containing streams
+    :param sample_bytes: csv bytes to read
+    :param sample_streams: most stream geometries to read
+    :return: InputStats
+    """
+    file_bytes = os.path.getsize(survey_data_filename)
+    compression = rgutil.file_compression(survey_data_filename)
+    csv_file = rgutil.open_csv_file(survey_data_filename)
+    try:
+        sample = csv_file.read(sample_bytes)
+    finally:
+        csv_file.close()
+    if len(sample) < sample_bytes:
+        scale = 1.0  # the whole file was read
+    else:
+        # Leave out the last, possibly partial, line
+        sample = sample[:sample.rfind(b'\n') + 1]
+        csv_bytes = file_bytes
+        if compression is not None:
+            csv_bytes = file_bytes * COMPRESSION_RATIO
+        scale = max(1.0, csv_bytes / float(len(sample) or 1))
+
+    records = csv.reader(sample.splitlines(True))
+    headings = next(records, [])
+    llid_index = headings.index(rgcsv.SURVEY_LLID)
+    x_index = headings.index(SURVEY_X)
+    num_rows = 0
+    num_sync_points = 0
+    llids = OrderedDict()
+    for row in records:
+        num_rows += 1
+        if row[x_index] != "":
+            num_sync_points += 1
+        if row[llid_index]:
+            llids[row[llid_index]] = True
+
+    vertex_counts = []
+    llids = list(llids)
+    sampled_llids = llids[::max(1, len(llids) // sample_streams)][
+        :sample_streams]
+    if sampled_llids:
+        where_clause = "{} IN ({})".\
+            format(arcpy.AddFieldDelimiters(streams_pathname, rgutil.LLID),
+                   ", ".join("'{}'".format(llid) for llid in sampled_llids))
+        with arcpy.da.SearchCursor(streams_pathname, ["SHAPE@"],
+                                   where_clause) as cursor:
+            vertex_counts = [stream_geom.pointCount for stream_geom, in cursor
+                             if stream_geom is not None]
+    vertices_per_stream = 0
+    if vertex_counts:
+        vertices_per_stream = sum(vertex_counts) // len(vertex_counts)
+
+    stats = InputStats(file_bytes, compression, int(num_rows * scale),
+                       int(len(llids) * scale),
+                       int(num_sync_points * scale), vertices_per_stream)
+    log.info(" sampled {}: about {} rows on {} streams, {} sync points, "
+             "{} vertices per stream".
+             format(survey_data_filename, stats.rows, stats.streams,
+                    stats.sync_points, stats.vertices_per_stream))
+    return stats
+
+
+def plan_execution(stats, cost_model, writes_rows=False, cache_bytes=None,
+                   strategy=AUTO, parse_workers=None,
+                   pipeline_queue_size=None, max_workers=None):
+    """
+    Chooses the execution strategy and number of parse workers with the
+    lowest estimated run time, and logs the decision.
+    :param stats: InputStats of the run
+    :param cost_model: CostModel
+    :param writes_rows: True when georeferencing, False when defining
+        adjustment factors; see CostModel.estimate_seconds
+    :param cache_bytes: geometry cache budget
+    :param strategy: AUTO to choose, or SERIAL, BATCHED or PARALLEL to
+        override the choice
+    :param parse_workers: number of parse workers overriding the choice, or
+        None to choose
+    :param pipeline_queue_size: pipeline queue size overriding the
+        strategy's, or None
+    :param max_workers: most parse workers to consider; defaults to the
+        number of CPUs
+    :return: ExecutionPlan
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    candidates = [(SERIAL, 1), (BATCHED, 1)]
+    if parallel_parse_possible(stats):
+        candidates += [(PARALLEL, workers)
+                       for workers in range(2, max_workers + 1)]
+    elif strategy == PARALLEL:
+        log.warning(" {} cannot be parsed in parallel; planning a batched "
+                    "run".format("Compressed survey file"
+                                 if stats.compression is not None
+                                 else "Survey file under {} bytes".
+                                 format(rgcsv.MIN_PARALLEL_FILE_SIZE)))
+        strategy = BATCHED
+    if strategy != AUTO:
+        candidates = [candidate for candidate in candidates
+                      if candidate[0] == strategy]
+    if parse_workers is not None and \
+            any(workers == parse_workers for name, workers in candidates):
+        candidates = [candidate for candidate in candidates
+                      if candidate[1] == parse_workers]
+
+    estimates = sorted((cost_model.estimate_seconds
+                        (stats, name, workers, writes_rows, cache_bytes),
+                        name, workers) for name, workers in candidates)
+    for seconds, name, workers in estimates:
+        log.debug(" estimated {:.1f} s for {} run with {} parse workers".
+                  format(seconds, name, workers))
+    estimated_seconds, chosen, chosen_workers = estimates[0]
+
+    if parse_workers is not None:
+        chosen_workers = parse_workers
+    if pipeline_queue_size is None:
+        pipeline_queue_size = 0
+        if writes_rows and chosen != SERIAL:
+            pipeline_queue_size = rgpipe.DEFAULT_QUEUE_SIZE
+    plan = ExecutionPlan(chosen, chosen_workers, pipeline_queue_size,
+                         chosen != SERIAL, estimated_seconds)
+    log.info(" execution plan ({}): {} run with {} parse workers, "
+             "pipeline queue size {}, {}preloading geometries; "
+             "estimated {:.1f} s".
+             format("chosen" if strategy == AUTO else "given", plan.strategy,
+                    plan.parse_workers, plan.pipeline_queue_size,
+                    "" if plan.preload else "not ", plan.estimated_seconds))
+    log.debug(" {}".format(cost_model))
+    return plan
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Index of georeferenced pools by distance along each stream,
+# for finding the pools between two survey distances (or two sync points)
+# on a stream, or the pool nearest a distance, without reading the survey
+# data points.  For each stream location ID (LLID), the index holds its
+# pools' survey distances, adjusted distances and output feature class row
+# ids (OIDs) in survey distance order, plus the same pools in adjusted
+# distance order.  Queries are binary searches within one stream's rows.
+#
+#   Index file layout:
+#       MAGIC, header length, json header: source, streams with their first
+#           row and row count, total rows
+#       survey distances, adjusted distances: float64, per stream in
+#           survey distance order
+#       OIDs: int32, in the same order
+#       adjusted distances: float64, per stream in adjusted distance order
+#       adjusted order: int32, row of each of those in survey distance order
+#
+# This file is for import by top-level scripts, or by analysis code
+# reading an index.
+#
+# SOURCE(S): https://docs.python.org/2/library/bisect.html
+#            https://docs.python.org/2/library/array.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import logging
+import struct
+import json
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+MAGIC = b"RBAPIX\x01\x00"
+POOL_INDEX_SUFFIX = "_pools.rbapix"
+HEADER_LEN_FORMAT = "<I"
+
+SURVEY = "survey"  # query by survey distance
+ADJUSTED = "adjusted"  # query by adjusted distance along the stream
+DISTANCE_KINDS = [SURVEY, ADJUSTED]
+
+
+# ********** CLASSES **********
+
+# A pool found in the index: row id in the output feature class, survey
+# distance and adjusted distance along its stream
+IndexedPool = namedtuple('IndexedPool',
+                         ['oid', 'survey_dist', 'adjusted_dist'])
+
+
+class PoolIndex(object):
+    """
+    Pool index read from an index file.  Loads only the index arrays,
+    never the survey data points.
+    """
+
+    def __init__(self, index_filepath):
+        self.index_filepath = index_filepath
+        with open(index_filepath, 'rb') as index_file:
+            if index_file.read(len(MAGIC)) != MAGIC:
+                raise IOError("{} is not a pool index file".
+                              format(index_filepath))
+            header_len, = struct.unpack(HEADER_LEN_FORMAT,
+                                        index_file.read(struct.calcsize
+                                                        (HEADER_LEN_FORMAT)))
+            self.header = json.loads(index_file.read(header_len).
+                                     decode('utf-8'))
+            num_rows = self.header["rows"]
+            self.survey_dists = read_array(index_file, 'd', num_rows)
+            self.adjusted_dists = read_array(index_file, 'd', num_rows)
+            self.oids = read_array(index_file, 'i', num_rows)
+            self.sorted_adjusted_dists = read_array(index_file, 'd', num_rows)
+            self.adjusted_order = read_array(index_file, 'i', num_rows)
+        self.streams = dict((llid, (first, count)) for llid, first, count
+                            in self.header["streams"])
+
+    def __repr__(self):
+        return "PoolIndex {}, {} pools on {} streams".\
+            format(self.index_filepath, len(self.oids), len(self.streams))
+
+    def __len__(self):
+        return len(self.oids)
+
+    def __contains__(self, llid):
+        return llid in self.streams
+
+    def llids(self):
+        return [llid for llid, first, count in self.header["streams"]]
+
+    def _pool(self, row):
+        return IndexedPool(self.oids[row], self.survey_dists[row],
+                           self.adjusted_dists[row])
+
+    def _keys_and_rows(self, llid, by):
+        """
+        Finds a stream's sorted distances for a query.
+        :return: tuple of (sorted distance array, first row, end row,
+            function from a position in the array to a row), or None if the
+            stream is not indexed
+        """
+        if by not in DISTANCE_KINDS:
+            raise ValueError("distances are {}, not {}".
+                             format(" or ".join(DISTANCE_KINDS), by))
+        if llid not in self.streams:
+            return None
+        first, count = self.streams[llid]
+        if by == SURVEY:
+            return self.survey_dists, first, first + count, lambda pos: pos
+        return self.sorted_adjusted_dists, first, first + count, \
+            lambda pos: self.adjusted_order[pos]
+
+    def pools_between(self, llid, begin_dist, end_dist, by=SURVEY):
+        """
+        Finds the pools on a stream between two distances, both included.
+        :param llid: Location ID for stream
+        :param begin_dist: lower distance
+        :param end_dist: upper distance
+        :param by: SURVEY to compare survey distances, ADJUSTED to compare
+            adjusted distances
+        :return: list of IndexedPool, in order of the compared distance
+        """
+        found = self._keys_and_rows(llid, by)
+        if found is None:
+            return []
+        keys, first, end, row_at = found
+        start = bisect_left(keys, begin_dist, first, end)
+        stop = bisect_right(keys, end_dist, start, end)
+        return [self._pool(row_at(pos)) for pos in range(start, stop)]
+
+    def pools_in_reach(self, llid, begin_sync_point, end_sync_point):
+        """
+        Finds the pools on a stream in the reach between two sync points,
+        by survey distance.
+        :param llid: Location ID for stream
+        :param begin_sync_point: SyncPoint at the lower end of the reach
+        :param end_sync_point: SyncPoint at the upper end of the reach
+        :return: list of IndexedPool, in survey distance order
+        """
+        return self.pools_between(llid, begin_sync_point.survey_cum_dist,
+                                  end_sync_point.survey_cum_dist, SURVEY)
+
+    def nearest_pool(self, llid, distance, by=SURVEY):
+        """
+        Finds the pool on a stream nearest a distance; of two equally near,
+        the lower one.
+        :param llid: Location ID for stream
+        :param distance: distance along the stream
+        :param by: SURVEY or ADJUSTED, as in pools_between
+        :return: IndexedPool, or None if the stream has no indexed pools
+        """
+        found = self._keys_and_rows(llid, by)
+        if found is None:
+            return None
+        keys, first, end, row_at = found
+        pos = bisect_left(keys, distance, first, end)
+        if pos == end or \
+                (pos > first and distance - keys[pos - 1] <= keys[pos] -
+                 distance):
+            pos -= 1
+        return self._pool(row_at(pos))
+
+
+# ********** FUNCTIONS **********
+
+def default_pool_index_filepath(gdb_path, survey_data_fc_name):
+    """
+    Names the pool index of an output feature class, next to its
+    geodatabase.
+    """
+    return os.path.splitext(gdb_path)[0] + "_" + survey_data_fc_name + \
+        POOL_INDEX_SUFFIX
+
+
+def read_array(index_file, typecode, count):
+    """
+    Reads count little-endian values into an array.
+    """
+    values = array(typecode)
+    values.fromfile(index_file, count)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def write_array(index_file, values):
+    """
+    Writes an array as little-endian values.
+    """
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(index_file)
+
+
+def write_pool_index(index_filepath, pools, source=""):
+    """
+    Writes a pool index file.  The file is written under a temporary name
+    and renamed when complete.
+    :param index_filepath: path of file to write
+    :param pools: iterable of (llid, survey distance, adjusted distance,
+        oid) tuples, in any order
+    :param source: description of the indexed points, e.g. the path of the
+        feature class, stored in the header
+    :return: number of pools indexed
+    """
+    stream_pools = OrderedDict()
+    for llid, survey_dist, adjusted_dist, oid in pools:
+        stream_pools.setdefault(llid, []).\
+            append((survey_dist, adjusted_dist, oid))
+
+    survey_dists = array('d')
+    adjusted_dists = array('d')
+    oids = array('i')
+    sorted_adjusted_dists = array('d')
+    adjusted_order = array('i')
+    streams = []
+    for llid in sorted(stream_pools):
+        first = len(oids)
+        rows = sorted(stream_pools[llid])
+        for survey_dist, adjusted_dist, oid in rows:
+            survey_dists.append(survey_dist)
+            adjusted_dists.append(adjusted_dist)
+            oids.append(oid)
+        for adjusted_dist, num in sorted((row[1], num) for num, row
+                                         in enumerate(rows)):
+            sorted_adjusted_dists.append(adjusted_dist)
+            adjusted_order.append(first + num)
+        streams.append((llid, first, len(rows)))
+
+    header = json.dumps({"source": source, "rows": len(oids),
+                         "streams": streams}).encode('utf-8')
+    temp_filepath = index_filepath + ".tmp"
+    with open(temp_filepath, 'wb') as index_file:
+        index_file.write(MAGIC)
+        index_file.write(struct.pack(HEADER_LEN_FORMAT, len(header)))
+        index_file.write(header)
+        for values in (survey_dists, adjusted_dists, oids,
+                       sorted_adjusted_dists, adjusted_order):
+            write_array(index_file, values)
+    if os.path.exists(index_filepath):
+        os.remove(index_filepath)
+    os.rename(temp_filepath, index_filepath)
+    log.info(" indexed {} pools on {} streams in {}".
+             format(len(oids), len(streams), index_filepath))
+    return len(oids)
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
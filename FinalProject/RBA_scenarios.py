@@ -0,0 +1,216 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Evaluation of several sets of stream distance information
+# (SDI scenarios, e.g. alternative sync points) in one pass over the survey
+# data.  For each stream, the adjustment factors of every scenario are held
+# in padded numpy arrays, so the adjusted distances of all of the stream's
+# pools under all scenarios are computed as one array operation.  Pool
+# locations under each scenario, and the displacement between scenarios,
+# follow from the stream's vertex arrays.
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): http://docs.scipy.org/doc/numpy/user/basics.broadcasting.html
+#            http://docs.scipy.org/doc/numpy/reference/generated/numpy.interp.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import logging
+import numpy as np
+import RBA_georef_util as rgutil
+
+
+# ********** GLOBAL CONSTANTS **********
+
+COMBINED = "combined"  # one output with location columns per scenario
+SEPARATE = "separate"  # one output per scenario
+SCENARIO_OUTPUTS = [COMBINED, SEPARATE]
+
+SCENARIO_X_FIELD = "Scen{}_X"
+SCENARIO_Y_FIELD = "Scen{}_Y"
+MEAN_DISP_FIELD = "Scen_Mean_Disp"  # mean distance from scenario 1
+MAX_DISP_FIELD = "Scen_Max_Disp"  # largest distance from scenario 1
+MAX_PAIR_DISP_FIELD = "Scen_Pair_Disp"  # largest distance between any two
+SCENARIO_FC_SUFFIX = "_scen{}"
+
+MAX_MATCH_VALUES = 4000000  # scenarios x factors x pools compared at once
+
+
+# ********** CLASSES **********
+
+class StreamScenarios(object):
+    """
+    Adjustment factors of one stream under each scenario, as arrays of
+    scenarios x factors.  Scenarios with fewer factors are padded with
+    factors that match no survey distance.
+    """
+
+    def __init__(self, stream_line, scenario_adj_factors):
+        """
+        :param stream_line: StreamLine for the stream
+        :param scenario_adj_factors: list with, for each scenario, a
+            sequence of tuples (begin_sync_point, end_sync_point,
+            adj_factor) for the stream
+        """
+        self.stream_line = stream_line
+        self.cum_dists = np.frombuffer(stream_line.cum_dists, dtype=float)
+        self.xs = np.frombuffer(stream_line.xs, dtype=float)
+        self.ys = np.frombuffer(stream_line.ys, dtype=float)
+
+        num_scenarios = len(scenario_adj_factors)
+        num_factors = max([1] + [len(adj_factors) for adj_factors
+                                 in scenario_adj_factors])
+        shape = (num_scenarios, num_factors)
+        self.begin_survey_dists = np.empty(shape)
+        self.begin_survey_dists.fill(np.inf)
+        self.end_survey_dists = np.empty(shape)
+        self.end_survey_dists.fill(-np.inf)
+        self.begin_streamline_dists = np.zeros(shape)
+        self.factors = np.empty(shape)
+        self.factors.fill(rgutil.DEFAULT_ADJ_FACTOR)
+        self.last_nums = np.zeros(num_scenarios, dtype=int)
+        for scenario, adj_factors in enumerate(scenario_adj_factors):
+            for num, (begin_pt, end_pt, adj_factor) in enumerate(adj_factors):
+                self.begin_survey_dists[scenario, num] = \
+                    begin_pt.survey_cum_dist
+                self.end_survey_dists[scenario, num] = end_pt.survey_cum_dist
+                self.begin_streamline_dists[scenario, num] = \
+                    begin_pt.streamline_cum_dist
+                self.factors[scenario, num] = adj_factor
+            if adj_factors:
+                self.last_nums[scenario] = len(adj_factors) - 1
+            else:
+                # No factors: survey distances are used unadjusted
+                self.begin_survey_dists[scenario, 0] = 0.0
+
+    def __repr__(self):
+        return "StreamScenarios {}, {} scenarios, up to {} adj factors".\
+            format(self.stream_line.llid, self.factors.shape[0],
+                   self.factors.shape[1])
+
+    @property
+    def num_scenarios(self):
+        return self.factors.shape[0]
+
+    def adjusted_distances(self, pool_survey_dists):
+        """
+        Computes the adjusted distances of pools under every scenario, as
+        adjust_stream_distance does: each pool uses the first factor whose
+        segment includes its survey distance, or if none does, the begin
+        point of the last factor and DEFAULT_ADJ_FACTOR.
+        :param pool_survey_dists: sequence of survey distances of pools
+        :return: numpy array of adjusted distances, scenarios x pools
+        """
+        pool_survey_dists = np.asarray(pool_survey_dists, dtype=float)
+        distances = np.empty((self.num_scenarios, len(pool_survey_dists)))
+        scenario_nums = np.arange(self.num_scenarios)[:, np.newaxis]
+        chunk_size = max(1, MAX_MATCH_VALUES // self.factors.size)
+        for start in range(0, len(pool_survey_dists), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            pool_dists = pool_survey_dists[chunk]
+            # scenarios x factors x pools
+            matches = (self.begin_survey_dists[:, :, np.newaxis] <=
+                       pool_dists) & \
+                (pool_dists <= self.end_survey_dists[:, :, np.newaxis])
+            matched = matches.any(axis=1)
+            nums = np.where(matched, matches.argmax(axis=1),
+                            self.last_nums[:, np.newaxis])
+            factors = np.where(matched, self.factors[scenario_nums, nums],
+                               rgutil.DEFAULT_ADJ_FACTOR)
+            distances[:, chunk] = \
+                self.begin_streamline_dists[scenario_nums, nums] + \
+                (pool_dists - self.begin_survey_dists[scenario_nums, nums]) * \
+                factors
+        return distances
+
+    def locations(self, pool_survey_dists):
+        """
+        Locates pools on the stream under every scenario.
+        :param pool_survey_dists: sequence of survey distances of pools
+        :return: tuple of numpy arrays (x coordinates, y coordinates), each
+            scenarios x pools
+        """
+        distances = self.adjusted_distances(pool_survey_dists)
+        if not len(self.cum_dists):
+            return np.zeros(distances.shape), np.zeros(distances.shape)
+        return np.interp(distances, self.cum_dists, self.xs), \
+            np.interp(distances, self.cum_dists, self.ys)
+
+    def scenario_values(self, pool_survey_dists):
+        """
+        Computes the values of the scenario fields (see scenario_field_names)
+        for pools.
+        :param pool_survey_dists: sequence of survey distances of pools
+        :return: numpy array, pools x fields
+        """
+        xs, ys = self.locations(pool_survey_dists)
+        coords = np.empty((xs.shape[1], 2 * self.num_scenarios))
+        coords[:, 0::2] = xs.T
+        coords[:, 1::2] = ys.T
+        return np.hstack([coords, displacement_stats(xs, ys)])
+
+
+# ********** FUNCTIONS **********
+
+def scenario_field_names(num_scenarios):
+    """
+    Names the fields holding pool locations under each scenario, numbered
+    from 1, followed by the displacement statistics.
+    """
+    names = []
+    for scenario_num in range(1, num_scenarios + 1):
+        names.append(SCENARIO_X_FIELD.format(scenario_num))
+        names.append(SCENARIO_Y_FIELD.format(scenario_num))
+    return names + [MEAN_DISP_FIELD, MAX_DISP_FIELD, MAX_PAIR_DISP_FIELD]
+
+
+def scenario_fc_name(survey_data_fc_name, scenario_num):
+    """
+    Names the output feature class of a scenario, numbered from 1; scenario
+    1 is written to survey_data_fc_name itself.
+    """
+    if scenario_num == 1:
+        return survey_data_fc_name
+    return survey_data_fc_name + SCENARIO_FC_SUFFIX.format(scenario_num)
+
+
+def displacement_stats(xs, ys):
+    """
+    Computes how far each pool moves between scenarios.
+    :param xs: numpy array of x coordinates, scenarios x pools
+    :param ys: numpy array of y coordinates, scenarios x pools
+    :return: numpy array, pools x 3: mean and largest distance from the
+        scenario 1 location over the other scenarios, and largest distance
+        between the locations of any two scenarios
+    """
+    num_scenarios, num_pools = xs.shape
+    stats = np.zeros((num_pools, 3))
+    if num_scenarios < 2:
+        return stats
+    from_first = np.hypot(xs[1:] - xs[0], ys[1:] - ys[0])
+    stats[:, 0] = from_first.mean(axis=0)
+    stats[:, 1] = from_first.max(axis=0)
+    for scenario in range(num_scenarios - 1):
+        pair_disps = np.hypot(xs[scenario + 1:] - xs[scenario],
+                              ys[scenario + 1:] - ys[scenario]).max(axis=0)
+        stats[:, 2] = np.maximum(stats[:, 2], pair_disps)
+    return stats
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
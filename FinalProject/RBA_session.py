@@ -0,0 +1,292 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Library interface to the RBA georeferencing steps, for use
+# inside a long-running Python process (e.g. a job runner) instead of
+# starting a script for every survey.  A GeorefSession holds one
+# geodatabase's configuration, its stream caches and indexes, and its own
+# logger.  Its methods take survey data rows already in memory and return
+# stream distance information or point rows, without writing files unless
+# asked.  Nothing is configured process-wide: logging is not set up,
+# arcpy.env is not changed, messages go to the session's logger, and
+# datasets are described through the session's own cache, cleared by
+# close() so datasets replaced between jobs are described afresh.
+#
+# Several sessions, or several threads sharing one session, may run jobs
+# at the same time.  A session's caches are filled on first use and shared
+# by its threads.
+#
+#   Example:
+#       session = GeorefSession(gdb_path, sync_coords_in_lat_long=True)
+#       sdi_dict = session.define_adj_factors(survey_records)
+#       points = session.georeference_records(survey_records, sdi_dict,
+#                                             survey_data_template)
+#       # points.fields and points.rows suit an arcpy.da.InsertCursor
+#
+# This file is for import by other Python code only.
+#
+# SOURCE(S): https://docs.python.org/2/library/logging.html
+#            https://docs.python.org/2/library/threading.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import logging
+import threading
+import itertools
+from collections import namedtuple
+from contextlib import contextmanager
+import RBA_georef_util as rgutil
+import RBA_stream_network as rgnet
+import define_RBA_dist_adj_factors as rgdefine
+import georef_RBA_survey_data as rggeoref
+
+
+# ********** GLOBAL CONSTANTS **********
+
+LOGGER_NAME = "RBA.session"  # parent of the session loggers
+
+_session_numbers = itertools.count(1)  # names the default session loggers
+
+
+# ********** CLASSES **********
+
+# Georeferenced points: cursor field names ("SHAPE@" first) and a row of
+# values per point
+PointRecords = namedtuple('PointRecords', ['fields', 'rows'])
+
+
+class GeorefSession(object):
+    """
+    Configuration, caches and logger for georeferencing survey data on the
+    streams of one geodatabase.  Can be used as a context manager, which
+    releases the caches on exit.
+    """
+
+    def __init__(self, gdb_path, sync_coords_in_lat_long=False,
+                 assign_missing_llid=False,
+                 max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST,
+                 geom_cache_mb=rgutil.DEFAULT_GEOM_CACHE_MB,
+                 river_index_cache=None, logger=None):
+        """
+        :param gdb_path: full path to geodatabase containing streams
+        :param sync_coords_in_lat_long: True if x,y coordinates in survey
+            data are in lat/long decimal degrees, False if they are in the
+            coordinates of the streams
+        :param assign_missing_llid: True to assign rows with no LLID to the
+            nearest stream, based on their x,y coordinates
+        :param max_snap_dist: maximum distance to the nearest stream for
+            assign_missing_llid
+        :param geom_cache_mb: memory budget for cached stream geometries
+        :param river_index_cache: file where the stream network index for
+            outlet distances is cached between sessions, or None to build it
+            in memory
+        :param logger: logger for the session's messages; if None, a child
+            of LOGGER_NAME numbered for the session
+        """
+        self.gdb_path = gdb_path
+        self.sync_coords_in_lat_long = sync_coords_in_lat_long
+        self.assign_missing_llid = assign_missing_llid
+        self.max_snap_dist = max_snap_dist
+        self.geom_cache_mb = geom_cache_mb
+        self.river_index_cache = river_index_cache
+        self.logger = logger or logging.getLogger\
+            ("{}.{}".format(LOGGER_NAME, next(_session_numbers)))
+        self._lock = threading.RLock()
+        self._describe_cache = rgutil.DescribeCache()
+        self._streams_pathname = None
+        self._geom_cache = None
+        self._stream_index = None
+        self._river_index = None
+
+    def __repr__(self):
+        return "GeorefSession {}, logger {}, {}".\
+            format(self.gdb_path, self.logger.name,
+                   self._geom_cache or "no geometries cached")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Releases the session's caches and indexes, including Describe
+        objects; they are rebuilt if the session is used again.
+        """
+        with self._lock:
+            self._describe_cache.clear()
+            self._streams_pathname = None
+            self._geom_cache = None
+            self._stream_index = None
+            self._river_index = None
+
+    @contextmanager
+    def using_session(self):
+        """
+        Context manager sending the calling thread's RBA messages to the
+        session's logger, and describing datasets through the session's
+        cache.
+        """
+        with rgutil.log.bind(self.logger), self._describe_cache.bind():
+            yield self
+
+    @property
+    def streams_pathname(self):
+        with self._lock:
+            if self._streams_pathname is None:
+                with self.using_session():
+                    self._streams_pathname = \
+                        rgutil.get_valid_polyline_pathname\
+                        (self.gdb_path, rgutil.STREAMS_FC_NAME)
+            return self._streams_pathname
+
+    @property
+    def geom_cache(self):
+        with self._lock:
+            if self._geom_cache is None:
+                self._geom_cache = rgutil.StreamGeometryCache\
+                    (self.streams_pathname,
+                     int(self.geom_cache_mb * 1024 * 1024))
+            return self._geom_cache
+
+    @property
+    def stream_index(self):
+        """
+        StreamSegmentIndex of all streams if assign_missing_llid, else None.
+        """
+        if not self.assign_missing_llid:
+            return None
+        with self._lock:
+            if self._stream_index is None:
+                with self.using_session():
+                    self._stream_index = rgnet.build_stream_segment_index\
+                        (self.streams_pathname)
+            return self._stream_index
+
+    def river_index(self, stream_dist_info_dict=None):
+        """
+        Finds the RiverDistanceIndex of the streams, building it on first
+        use.
+        :param stream_dist_info_dict: stream distance information whose
+            stream names help choose among streams meeting at a confluence;
+            used only when the index is built
+        :return: RiverDistanceIndex object
+        """
+        with self._lock:
+            if self._river_index is None:
+                stream_names = dict((llid, (sdi.name, sdi.trib_to))
+                                    for llid, sdi in
+                                    (stream_dist_info_dict or {}).items())
+                with self.using_session():
+                    if self.river_index_cache is not None:
+                        self._river_index = \
+                            rgnet.load_or_build_river_distance_index\
+                            (self.streams_pathname, self.river_index_cache,
+                             stream_names)
+                    else:
+                        self._river_index = rgnet.build_river_distance_index\
+                            (rgnet.read_stream_lines(self.streams_pathname),
+                             stream_names)
+            return self._river_index
+
+    def define_adj_factors(self, survey_records):
+        """
+        Develops stream distance adjustment factors from survey data, as
+        define_RBA_dist_adj_factors does.
+        :param survey_records: iterable of survey csv records, as lists of
+            strings: the header row, then each data row, sorted by LLID and
+            cumulative distance
+        :return: dictionary of StreamDistanceInfo objects, keyed on LLID
+        """
+        with self.using_session():
+            return rgdefine.build_sdi_from_records\
+                (survey_records, self.streams_pathname,
+                 self.sync_coords_in_lat_long, self.stream_index,
+                 self.max_snap_dist, self.geom_cache)
+
+    def georeference_records(self, survey_records, stream_dist_info_dict,
+                             survey_data_template, outlet_dist=False,
+                             error_model=None, scenario_sdi_dicts=None):
+        """
+        Locates survey data rows on their streams, as georef_RBA_survey_data
+        does, without writing them.
+        :param survey_records: iterable of survey csv records, as lists of
+            strings: the header row, then each data row
+        :param stream_dist_info_dict: dictionary of StreamDistanceInfo
+            objects keyed on LLID, e.g. from define_adj_factors
+        :param survey_data_template: file with field definitions for survey
+            data, giving the fields and types of the point rows
+        :param outlet_dist: True to add river distance from the basin outlet
+        :param error_model: RBA_uncertainty.ErrorModel to add positional
+            spreads, or None
+        :param scenario_sdi_dicts: stream distance information of other
+            scenarios, to add scenario locations, or None
+        :return: PointRecords
+        """
+        with self.using_session():
+            template_fields = rggeoref.survey_template_fields\
+                (survey_data_template)
+            num_scenarios = 0
+            if scenario_sdi_dicts:
+                num_scenarios = len(scenario_sdi_dicts) + 1
+            fields = ["SHAPE@"] + \
+                [desc_field.name for desc_field in template_fields] + \
+                rggeoref.extra_field_names(outlet_dist, error_model,
+                                           num_scenarios)
+            river_index = None
+            if outlet_dist:
+                river_index = self.river_index(stream_dist_info_dict)
+            point_rows = rggeoref.georeference_survey_records\
+                (survey_records, stream_dist_info_dict,
+                 self.streams_pathname, template_fields, self.stream_index,
+                 self.sync_coords_in_lat_long, self.max_snap_dist,
+                 river_index, self.geom_cache, error_model=error_model,
+                 scenario_sdi_dicts=scenario_sdi_dicts)
+            rows = [point_row for group, llid, point_row in point_rows]
+            self.logger.info(" georeferenced {} rows".format(len(rows)))
+            return PointRecords(fields, rows)
+
+    def read_sdi(self, sdi_filepath):
+        """
+        Reads stream distance information written by define_RBA_dist_adj_
+        factors or write_sdi.
+        :return: dictionary of StreamDistanceInfo objects, keyed on LLID
+        """
+        with self.using_session():
+            return rgutil.read_sdi_from_csvfile(sdi_filepath)
+
+    def write_sdi(self, stream_dist_info_dict, sdi_filepath,
+                  compression=None):
+        """
+        Writes stream distance information to a csv file, for review.
+        :param compression: GZIP or XZ to write a compressed file, or None
+        """
+        with self.using_session():
+            rgutil.write_sdi_to_csv_file(stream_dist_info_dict, sdi_filepath,
+                                         compression)
+
+
+# ********** FUNCTIONS **********
+
+# See GeorefSession
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,444 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Sharded execution of the RBA scripts by any number of
+# worker hosts sharing a directory.  The survey data is split into shards
+# that each hold every row of a set of streams (LLIDs), listed in a manifest
+# in the shard directory.  Workers claim shards with lease files, created
+# atomically, and keep their leases alive by touching them while they work;
+# a lease not touched within the lease timeout belongs to a dead worker,
+# and its shard can be reclaimed, by one worker at a time.  When every
+# shard is done, one worker merges the shard outputs, in shard order, into
+# the artifacts a single run would produce.  Several processes on one host
+# can stand in for worker hosts.
+#
+#   Shard directory layout:
+#       manifest.json - survey data file, its hash, and the shards
+#       inputs/<shard>.csv - survey data rows for each shard
+#       outputs/<shard><suffix> - output written by the worker for a shard
+#       leases/<shard>.lease - held by the worker processing a shard
+#       leases/<shard>.lease.reclaim - held while reclaiming an expired lease
+#       done/<shard>.done - written when a shard's output is complete
+#       merge.lease, merged.done - the same, for merging shard outputs
+#
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): https://docs.python.org/2/library/os.html#os.open
+#            https://docs.python.org/2/library/threading.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import errno
+import socket
+import time
+import json
+import csv
+import logging
+import threading
+from collections import OrderedDict
+import RBA_parallel_csv as rgcsv
+import RBA_checkpoint as rgckpt
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+DEFAULT_NUM_SHARDS = 16
+DEFAULT_LEASE_SECONDS = 600.0  # lease not touched this long has expired
+HEARTBEATS_PER_LEASE = 4  # times a lease is touched per lease timeout
+POLL_SECONDS = 5.0  # how often idle workers check for work
+MANIFEST_VERSION = 1
+
+MANIFEST_NAME = "manifest.json"
+PLAN_LEASE_NAME = "plan.lease"
+MERGE_LEASE_NAME = "merge.lease"
+MERGED_NAME = "merged.done"
+INPUTS_DIR = "inputs"
+OUTPUTS_DIR = "outputs"
+LEASES_DIR = "leases"
+DONE_DIR = "done"
+LEASE_SUFFIX = ".lease"
+RECLAIM_SUFFIX = ".reclaim"  # held by the worker reclaiming a lease
+DONE_SUFFIX = ".done"
+
+
+# ********** CLASSES **********
+
+class ShardError(Exception):
+    """
+    Raised when a shard directory cannot be used for the given inputs.
+    """
+    pass
+
+
+class LeaseHeartbeat(object):
+    """
+    Context manager that touches a lease file from a background thread,
+    so the lease does not expire while its holder works, and removes the
+    lease file on exit.  The lease is renewed or removed only while it still
+    names this worker: if it expired and another worker reclaimed it, the
+    heartbeat stops and lost is set.
+    """
+
+    def __init__(self, lease_path, lease_seconds):
+        self.lease_path = lease_path
+        self.interval = lease_seconds / HEARTBEATS_PER_LEASE
+        self.owner = worker_id()
+        self.lost = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat,
+                                        name="lease-heartbeat")
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+        if not self.owns_lease():
+            return False
+        try:
+            os.remove(self.lease_path)
+        except OSError:
+            log.warning(" lease {} was already removed".
+                        format(self.lease_path))
+        return False
+
+    def owns_lease(self):
+        """
+        :return: True if the lease file still names this worker; otherwise
+            lost is set
+        """
+        if not self.lost and lease_owner(self.lease_path) != self.owner:
+            log.warning(" lease {} is no longer held by {}".
+                        format(self.lease_path, self.owner))
+            self.lost = True
+        return not self.lost
+
+    def _beat(self):
+        while not self._stopped.wait(self.interval):
+            if not self.owns_lease():
+                return
+            try:
+                os.utime(self.lease_path, None)
+            except OSError:
+                log.warning(" could not renew lease {}".
+                            format(self.lease_path))
+
+
+# ********** FUNCTIONS **********
+
+def worker_id():
+    """
+    Identifies this worker process: host name and process ID.
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def create_exclusive(filepath, content=""):
+    """
+    Creates a file only if it does not already exist, atomically, so only
+    one of several workers racing to create it succeeds.
+    :param filepath: full path to file
+    :param content: text written to the new file
+    :return: True if this call created the file, False if it existed
+    """
+    try:
+        fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as err:
+        if err.errno == errno.EEXIST:
+            return False
+        raise
+    with os.fdopen(fd, 'w') as new_file:
+        new_file.write(content)
+    return True
+
+
+def lease_owner(lease_path):
+    """
+    :param lease_path: full path to lease file
+    :return: ID of the worker holding the lease, or None if there is no
+        lease file
+    """
+    try:
+        with open(lease_path, 'r') as lease_file:
+            return lease_file.read()
+    except (IOError, OSError):
+        return None
+
+
+def lease_age(lease_path):
+    """
+    :param lease_path: full path to lease (or reclaim) file
+    :return: seconds since the file was last touched, or None if there is
+        no such file
+    """
+    try:
+        return time.time() - os.path.getmtime(lease_path)
+    except OSError:
+        return None
+
+
+def acquire_lease(lease_path, lease_seconds):
+    """
+    Takes a lease, reclaiming it if its holder has not touched it within
+    lease_seconds.  Workers reclaim a lease one at a time, holding its
+    reclaim file, created atomically; each checks again that the lease is
+    expired before replacing it, so a lease just reclaimed by one worker is
+    not reclaimed again by another that also saw it expire.  A reclaim file
+    left by a worker that stopped while reclaiming expires like a lease.
+    :param lease_path: full path to lease file
+    :param lease_seconds: lease timeout
+    :return: True if the lease was acquired
+    """
+    if create_exclusive(lease_path, worker_id()):
+        return True
+    age = lease_age(lease_path)
+    if age is None or age <= lease_seconds:
+        return False  # held, or released meanwhile; try again on next pass
+    reclaim_path = lease_path + RECLAIM_SUFFIX
+    if not create_exclusive(reclaim_path, worker_id()):
+        reclaim_age = lease_age(reclaim_path)
+        if reclaim_age is not None and reclaim_age > lease_seconds:
+            log.warning(" removing {}, left by a stopped worker".
+                        format(reclaim_path))
+            try:
+                os.remove(reclaim_path)
+            except OSError:
+                pass
+        return False  # another worker is reclaiming it
+    try:
+        age = lease_age(lease_path)
+        if age is not None:
+            if age <= lease_seconds:
+                return False  # reclaimed by another worker meanwhile
+            os.remove(lease_path)
+            log.warning(" reclaiming expired lease {} ({:.0f} s old)".
+                        format(lease_path, age))
+        return create_exclusive(lease_path, worker_id())
+    finally:
+        os.remove(reclaim_path)
+
+
+def plan_shards(shard_dir, survey_data_filename, num_shards,
+                parse_workers=1):
+    """
+    Splits the survey data into shards and writes the manifest.  Rows are
+    grouped by LLID, with rows that have no LLID kept with the stream
+    before them; the groups, in order of first appearance, are divided into
+    num_shards runs of roughly equal row counts.  The survey data is read
+    twice, so it is never held in memory.
+    :param shard_dir: shared shard directory
+    :param survey_data_filename: survey data csv file
+    :param num_shards: number of shards to create
+    :param parse_workers: number of worker processes used to parse the
+        survey data
+    :return: manifest dictionary
+    """
+    # First pass: rows per stream, in order of first appearance
+    group_rows = OrderedDict()
+    with rgcsv.open_survey_csv(survey_data_filename, parse_workers) \
+            as pts_file_reader:
+        headings = next(pts_file_reader)
+        llid_col = headings.index(rgcsv.SURVEY_LLID)
+        group = ""
+        for r in pts_file_reader:
+            group = r[llid_col] or group
+            group_rows[group] = group_rows.get(group, 0) + 1
+
+    # Assign runs of streams to shards
+    total_rows = sum(group_rows.values())
+    num_shards = max(1, min(num_shards, len(group_rows)))
+    shard_of_group = {}
+    shards = []
+    rows_so_far = 0
+    for group, num_rows in group_rows.items():
+        shard_num = min(num_shards - 1,
+                        rows_so_far * num_shards // max(1, total_rows))
+        while len(shards) <= shard_num:
+            shards.append({"name": "shard_{:04d}".format(len(shards)),
+                           "rows": 0, "streams": 0})
+        shards[shard_num]["rows"] += num_rows
+        shards[shard_num]["streams"] += 1
+        shard_of_group[group] = shard_num
+        rows_so_far += num_rows
+
+    # Second pass: write each shard's rows
+    inputs_dir = os.path.join(shard_dir, INPUTS_DIR)
+    shard_files = [open(os.path.join(inputs_dir, shard["name"] + ".csv"),
+                        'wb') for shard in shards]
+    try:
+        shard_writers = [csv.writer(shard_file) for shard_file in shard_files]
+        for shard_writer in shard_writers:
+            shard_writer.writerow(headings)
+        with rgcsv.open_survey_csv(survey_data_filename, parse_workers) \
+                as pts_file_reader:
+            next(pts_file_reader)
+            group = ""
+            for r in pts_file_reader:
+                group = r[llid_col] or group
+                shard_writers[shard_of_group[group]].writerow(r)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+
+    manifest = {"version": MANIFEST_VERSION,
+                "survey_data": os.path.abspath(survey_data_filename),
+                "survey_hash": rgckpt.hash_file(survey_data_filename).
+                hexdigest(),
+                "shards": shards}
+    temp_path = os.path.join(shard_dir, MANIFEST_NAME + ".tmp")
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.rename(temp_path, os.path.join(shard_dir, MANIFEST_NAME))
+    log.info(" split {} rows of {} streams into {} shards in {}".
+             format(total_rows, len(group_rows), len(shards), shard_dir))
+    return manifest
+
+
+def load_or_plan_manifest(shard_dir, survey_data_filename,
+                          num_shards=DEFAULT_NUM_SHARDS, parse_workers=1,
+                          lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Reads the shard manifest, or plans the shards if no worker has yet.
+    Only the worker holding the plan lease plans; the others wait for the
+    manifest to appear.
+    :return: manifest dictionary
+    A ShardError is raised if the manifest is for different survey data.
+    """
+    for subdir in (INPUTS_DIR, OUTPUTS_DIR, LEASES_DIR, DONE_DIR):
+        try:
+            os.makedirs(os.path.join(shard_dir, subdir))
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    manifest_path = os.path.join(shard_dir, MANIFEST_NAME)
+    plan_lease_path = os.path.join(shard_dir, PLAN_LEASE_NAME)
+    while not os.path.exists(manifest_path):
+        if acquire_lease(plan_lease_path, lease_seconds):
+            with LeaseHeartbeat(plan_lease_path, lease_seconds):
+                return plan_shards(shard_dir, survey_data_filename,
+                                   num_shards, parse_workers)
+        log.info(" waiting for another worker to plan shards")
+        time.sleep(POLL_SECONDS)
+
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["survey_hash"] != \
+            rgckpt.hash_file(survey_data_filename).hexdigest():
+        raise ShardError("Shard directory {} was planned for other ".
+                         format(shard_dir) + "survey data ({})".
+                         format(manifest["survey_data"]))
+    return manifest
+
+
+def shard_paths(shard_dir, shard, output_suffix):
+    """
+    :return: tuple of (input csv, output, lease, done marker) paths for a
+        shard
+    """
+    name = shard["name"]
+    return (os.path.join(shard_dir, INPUTS_DIR, name + ".csv"),
+            os.path.join(shard_dir, OUTPUTS_DIR, name + output_suffix),
+            os.path.join(shard_dir, LEASES_DIR, name + LEASE_SUFFIX),
+            os.path.join(shard_dir, DONE_DIR, name + DONE_SUFFIX))
+
+
+def run_sharded(shard_dir, survey_data_filename, process_shard,
+                merge_outputs, output_suffix,
+                num_shards=DEFAULT_NUM_SHARDS, parse_workers=1,
+                lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Runs as one worker: claims and processes shards until all are done,
+    then merges the outputs unless another worker is doing so.
+    :param shard_dir: shared shard directory
+    :param survey_data_filename: survey data csv file
+    :param process_shard: function taking (shard input csv path, shard
+        output path), which writes the shard's output, replacing any partial
+        output left by a failed worker
+    :param merge_outputs: function taking the list of shard output paths,
+        in shard order, which writes the merged artifacts
+    :param output_suffix: suffix of shard output file or directory names
+    :param num_shards: number of shards, if this worker plans them
+    :param parse_workers: number of worker processes used to parse csv files
+    :param lease_seconds: lease timeout
+    :return: tuple of (number of shards processed by this worker, True if
+        this worker merged the outputs)
+    """
+    manifest = load_or_plan_manifest(shard_dir, survey_data_filename,
+                                     num_shards, parse_workers, lease_seconds)
+    shards = manifest["shards"]
+    processed = 0
+    while True:
+        pending = [shard for shard in shards if not os.path.exists
+                   (shard_paths(shard_dir, shard, output_suffix)[3])]
+        if not pending:
+            break
+        claimed = None
+        for shard in pending:
+            lease_path = shard_paths(shard_dir, shard, output_suffix)[2]
+            if acquire_lease(lease_path, lease_seconds):
+                claimed = shard
+                break
+        if claimed is None:
+            log.info(" {} shards in progress by other workers".
+                     format(len(pending)))
+            time.sleep(POLL_SECONDS)
+            continue
+
+        input_path, output_path, lease_path, done_path = \
+            shard_paths(shard_dir, claimed, output_suffix)
+        with LeaseHeartbeat(lease_path, lease_seconds) as heartbeat:
+            if os.path.exists(done_path):
+                continue  # finished by a worker whose lease expired
+            log.info(" {} processing {} ({} rows, {} streams)".
+                     format(worker_id(), claimed["name"],
+                            claimed["rows"], claimed["streams"]))
+            process_shard(input_path, output_path)
+            if not heartbeat.owns_lease():
+                continue  # reclaimed meanwhile; its new holder finishes it
+            create_exclusive(done_path, worker_id())
+        processed += 1
+
+    # All shards are done; one worker merges
+    merged_path = os.path.join(shard_dir, MERGED_NAME)
+    merge_lease_path = os.path.join(shard_dir, MERGE_LEASE_NAME)
+    while not os.path.exists(merged_path):
+        if acquire_lease(merge_lease_path, lease_seconds):
+            with LeaseHeartbeat(merge_lease_path, lease_seconds) \
+                    as heartbeat:
+                if os.path.exists(merged_path):
+                    break
+                outputs = [shard_paths(shard_dir, shard, output_suffix)[1]
+                           for shard in shards]
+                log.info(" {} merging {} shard outputs".
+                         format(worker_id(), len(outputs)))
+                merge_outputs(outputs)
+                if not heartbeat.owns_lease():
+                    continue  # reclaimed meanwhile; its new holder merges
+                create_exclusive(merged_path, worker_id())
+            return processed, True
+        time.sleep(POLL_SECONDS)
+    return processed, False
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
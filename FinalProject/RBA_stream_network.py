@@ -0,0 +1,695 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Network-wide stream geometry structures for RBA survey
+# georeferencing.  StreamLine holds the vertices and cumulative vertex
+# distances for one stream, so distances along the stream and snapping can
+# be computed without geometry calls.  StreamSegmentIndex is a uniform grid
+# index over the segments of every stream in the streams feature class,
+# used to find the stream nearest to an x,y location.  This file is for
+# import by top-level scripts only.
+#
+# SOURCE(S): http://resources.arcgis.com/en/help/
+#            https://docs.python.org/
+#            http://geomalgorithms.com/a02-_lines.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import math
+import logging
+import hashlib
+import pickle
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+import RBA_georef_util as rgutil
+from RBA_georef_util import arcpy  # imported on first use
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+DEFAULT_MAX_SNAP_DIST = 100.0  # in units of the streams feature class
+DEFAULT_AMBIGUITY_TOLERANCE = 5.0  # runner-up this close means ambiguous
+SEGMENTS_PER_CELL = 4.0  # target average index grid occupancy
+DEFAULT_CONFLUENCE_TOLERANCE = 50.0  # max gap from trib mouth to parent
+RIVER_INDEX_VERSION = 1  # increment when cached index contents change
+
+# Result of a nearest-stream query.  snap_dist is the distance from the
+# query point to the nearest stream; runner_up_llid/runner_up_dist identify
+# the nearest other stream within the search distance (None if there is
+# none); ambiguity is snap_dist / runner_up_dist, approaching 1.0 when two
+# streams are nearly equally close.
+NearestStream = namedtuple('NearestStream',
+                           ['llid', 'snap_dist', 'streamline_dist',
+                            'runner_up_llid', 'runner_up_dist',
+                            'ambiguity', 'ambiguous'])
+
+
+# ********** CLASSES **********
+
+class StreamLine(object):
+    """
+    Vertices and cumulative distances for a single stream polyline, with
+    distance measured from the first vertex (the stream mouth).  Parts of a
+    multipart polyline are stored one after another; part_starts holds the
+    index of the first vertex of each part, and no segment joins the last
+    vertex of one part to the first vertex of the next.
+    """
+
+    def __init__(self, llid, xs, ys, part_starts=None):
+        self.llid = llid
+        self.xs = array('d', xs)
+        self.ys = array('d', ys)
+        self.part_starts = part_starts or [0]
+        self.cum_dists = array('d', [0.0] * len(self.xs))
+        part_start_set = set(self.part_starts)
+        for i in range(1, len(self.xs)):
+            step = 0.0
+            if i not in part_start_set:
+                step = math.hypot(self.xs[i] - self.xs[i - 1],
+                                  self.ys[i] - self.ys[i - 1])
+            self.cum_dists[i] = self.cum_dists[i - 1] + step
+        self._part_start_set = part_start_set
+
+    def __repr__(self):
+        return "StreamLine {}, {} vertices, length {}".\
+            format(self.llid, len(self.xs), self.length)
+
+    @property
+    def length(self):
+        return self.cum_dists[-1] if len(self.cum_dists) else 0.0
+
+    def segments(self):
+        """
+        Generates (vertex index, x1, y1, x2, y2) for each segment.
+        """
+        for i in range(len(self.xs) - 1):
+            if i + 1 not in self._part_start_set:
+                yield (i, self.xs[i], self.ys[i],
+                       self.xs[i + 1], self.ys[i + 1])
+
+    def segment_index_at(self, distance):
+        """
+        Finds the segment containing the given distance along the stream,
+        by binary search of the cumulative distances.
+        :param distance: distance from stream mouth
+        :return: index of the segment's first vertex
+        """
+        i = bisect_right(self.cum_dists, distance) - 1
+        i = max(0, min(i, len(self.xs) - 2))
+        # zero-length steps between parts are not segments
+        while i + 1 in self._part_start_set and i > 0:
+            i -= 1
+        return i
+
+    def position_along_line(self, distance):
+        """
+        Equivalent of Polyline.positionAlongLine for this stream.
+        :param distance: distance from stream mouth; values beyond either
+            end of the stream are clamped to that end
+        :return: tuple of (x, y)
+        """
+        if len(self.xs) == 1:
+            return self.xs[0], self.ys[0]
+        distance = max(0.0, min(distance, self.length))
+        return self._point_on_segment(self.segment_index_at(distance),
+                                      distance)
+
+    def sub_line(self, begin_dist, end_dist):
+        """
+        Equivalent of Polyline.segmentAlongLine for this stream: the
+        vertices of the stream between two distances, found by one binary
+        search for each end.
+        :param begin_dist: distance from stream mouth to start of sub-line
+        :param end_dist: distance from stream mouth to end of sub-line;
+            distances beyond either end of the stream are clamped to that
+            end
+        :return: list of parts, each a list of two or more (x, y) tuples,
+            in order upstream; empty if the stream has fewer than two
+            vertices or no length lies between the distances
+        """
+        begin_dist = max(0.0, min(begin_dist, self.length))
+        end_dist = min(end_dist, self.length)
+        if len(self.xs) < 2 or end_dist <= begin_dist:
+            return []
+        begin_i = self.segment_index_at(begin_dist)
+        end_i = self.segment_index_at(end_dist)
+        parts = [[self._point_on_segment(begin_i, begin_dist)]]
+        for i in range(begin_i + 1, end_i + 1):
+            if i in self._part_start_set:
+                parts.append([])
+            parts[-1].append((self.xs[i], self.ys[i]))
+        parts[-1].append(self._point_on_segment(end_i, end_dist))
+        # A part of one vertex has no segments
+        return [part for part in parts if len(part) > 1]
+
+    def _point_on_segment(self, i, distance):
+        """
+        Interpolates the point at a distance along segment i.
+        """
+        seg_len = self.cum_dists[i + 1] - self.cum_dists[i]
+        if seg_len <= 0.0:
+            return self.xs[i], self.ys[i]
+        frac = max(0.0, min(1.0, (distance - self.cum_dists[i]) / seg_len))
+        return (self.xs[i] + frac * (self.xs[i + 1] - self.xs[i]),
+                self.ys[i] + frac * (self.ys[i + 1] - self.ys[i]))
+
+    def query_point_and_distance(self, x, y):
+        """
+        Equivalent of Polyline.queryPointAndDistance for this stream.
+        :param x: x coordinate of point to snap
+        :param y: y coordinate of point to snap
+        :return: tuple of ((snapped x, snapped y), distance along stream,
+            offset distance from stream)
+        """
+        best = None
+        for i, x1, y1, x2, y2 in self.segments():
+            offset, frac = point_segment_distance(x, y, x1, y1, x2, y2)
+            if best is None or offset < best[0]:
+                best = (offset, i, frac)
+        if best is None:
+            return (self.xs[0], self.ys[0]), 0.0, \
+                math.hypot(x - self.xs[0], y - self.ys[0])
+        offset, i, frac = best
+        snapped = (self.xs[i] + frac * (self.xs[i + 1] - self.xs[i]),
+                   self.ys[i] + frac * (self.ys[i + 1] - self.ys[i]))
+        streamline_dist = self.cum_dists[i] + \
+            frac * (self.cum_dists[i + 1] - self.cum_dists[i])
+        return snapped, streamline_dist, offset
+
+
+class StreamSegmentIndex(object):
+    """
+    Uniform grid index over the segments of all streams in a network.
+    Each grid cell lists the segments whose bounding boxes overlap it, so a
+    nearest-stream query examines only the cells in rings around the query
+    point rather than every polyline in the network.
+    """
+
+    def __init__(self, stream_lines, cell_size=None):
+        self.llids = []
+        self.seg_x1 = array('d')
+        self.seg_y1 = array('d')
+        self.seg_x2 = array('d')
+        self.seg_y2 = array('d')
+        self.seg_start_dist = array('d')
+        self.seg_stream = array('l')
+        for stream_num, stream_line in enumerate(stream_lines):
+            self.llids.append(stream_line.llid)
+            for i, x1, y1, x2, y2 in stream_line.segments():
+                self.seg_x1.append(x1)
+                self.seg_y1.append(y1)
+                self.seg_x2.append(x2)
+                self.seg_y2.append(y2)
+                self.seg_start_dist.append(stream_line.cum_dists[i])
+                self.seg_stream.append(stream_num)
+
+        self.cell_size = cell_size or self._default_cell_size()
+        self.cells = {}
+        for seg in range(len(self.seg_x1)):
+            col_lo, row_lo = self._cell(min(self.seg_x1[seg],
+                                            self.seg_x2[seg]),
+                                        min(self.seg_y1[seg],
+                                            self.seg_y2[seg]))
+            col_hi, row_hi = self._cell(max(self.seg_x1[seg],
+                                            self.seg_x2[seg]),
+                                        max(self.seg_y1[seg],
+                                            self.seg_y2[seg]))
+            for col in range(col_lo, col_hi + 1):
+                for row in range(row_lo, row_hi + 1):
+                    self.cells.setdefault((col, row), []).append(seg)
+        log.info(" indexed {} segments of {} streams in {} grid cells".
+                 format(len(self.seg_x1), len(self.llids),
+                        len(self.cells)))
+
+    def __repr__(self):
+        return "StreamSegmentIndex {} streams, {} segments, cell size {}".\
+            format(len(self.llids), len(self.seg_x1), self.cell_size)
+
+    def _default_cell_size(self):
+        """
+        Chooses a cell size giving about SEGMENTS_PER_CELL segments per
+        occupied cell, based on the mean segment extent.
+        """
+        num_segs = len(self.seg_x1)
+        if num_segs == 0:
+            return 1.0
+        total_extent = 0.0
+        for seg in range(num_segs):
+            total_extent += max(abs(self.seg_x2[seg] - self.seg_x1[seg]),
+                                abs(self.seg_y2[seg] - self.seg_y1[seg]))
+        return max(total_extent / num_segs * SEGMENTS_PER_CELL, 1e-6)
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def _ring_cells(self, col, row, ring):
+        """
+        Generates the cells at Chebyshev distance ring from (col, row).
+        """
+        if ring == 0:
+            yield (col, row)
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield (c, row - ring)
+            yield (c, row + ring)
+        for r in range(row - ring + 1, row + ring):
+            yield (col - ring, r)
+            yield (col + ring, r)
+
+    def nearest(self, x, y, max_snap_dist=DEFAULT_MAX_SNAP_DIST,
+                ambiguity_tolerance=DEFAULT_AMBIGUITY_TOLERANCE):
+        """
+        Finds the stream nearest to the given point.
+        :param x: x coordinate, in the coordinates of the streams
+        :param y: y coordinate, in the coordinates of the streams
+        :param max_snap_dist: streams further than this are not considered
+        :param ambiguity_tolerance: the match is flagged as ambiguous when
+            another stream is within this distance of the nearest one
+        :return: NearestStream, or None if no stream is within max_snap_dist
+        """
+        col, row = self._cell(x, y)
+        max_ring = int(math.ceil(max_snap_dist / self.cell_size)) + 1
+        best_by_stream = {}  # stream number -> (offset, segment, fraction)
+        seen = set()
+        for ring in range(max_ring + 1):
+            for cell in self._ring_cells(col, row, ring):
+                for seg in self.cells.get(cell, ()):
+                    if seg in seen:
+                        continue
+                    seen.add(seg)
+                    offset, frac = point_segment_distance\
+                        (x, y, self.seg_x1[seg], self.seg_y1[seg],
+                         self.seg_x2[seg], self.seg_y2[seg])
+                    stream_num = self.seg_stream[seg]
+                    prev = best_by_stream.get(stream_num)
+                    if prev is None or offset < prev[0]:
+                        best_by_stream[stream_num] = (offset, seg, frac)
+            # Segments in cells beyond this ring are at least this far away
+            searched_dist = ring * self.cell_size
+            ranked = sorted(best_by_stream.values())
+            if len(ranked) >= 2 and ranked[1][0] <= searched_dist:
+                break
+            if len(ranked) >= 1 and ranked[0][0] + ambiguity_tolerance \
+                    <= searched_dist:
+                break
+
+        ranked = sorted((offset, stream_num, seg, frac) for
+                        stream_num, (offset, seg, frac) in
+                        best_by_stream.items() if offset <= max_snap_dist)
+        if not ranked:
+            return None
+        snap_dist, stream_num, seg, frac = ranked[0]
+        seg_len = math.hypot(self.seg_x2[seg] - self.seg_x1[seg],
+                             self.seg_y2[seg] - self.seg_y1[seg])
+        streamline_dist = self.seg_start_dist[seg] + frac * seg_len
+        runner_up_llid = None
+        runner_up_dist = None
+        ambiguity = 0.0
+        if len(ranked) > 1:
+            runner_up_dist = ranked[1][0]
+            runner_up_llid = self.llids[ranked[1][1]]
+            if runner_up_dist > 0.0:
+                ambiguity = snap_dist / runner_up_dist
+            else:
+                ambiguity = 1.0
+        ambiguous = runner_up_dist is not None and \
+            runner_up_dist - snap_dist <= ambiguity_tolerance
+        return NearestStream(self.llids[stream_num], snap_dist,
+                             streamline_dist, runner_up_llid, runner_up_dist,
+                             ambiguity, ambiguous)
+
+    def streams_within(self, x, y, radius, exclude_llid=None):
+        """
+        Finds all streams within radius of the given point.
+        :param x: x coordinate, in the coordinates of the streams
+        :param y: y coordinate, in the coordinates of the streams
+        :param radius: search distance
+        :param exclude_llid: LLID of a stream to leave out of the results
+        :return: list of (distance, llid, streamline_dist) tuples, nearest
+            first, giving the closest point on each stream
+        """
+        col, row = self._cell(x, y)
+        max_ring = int(math.ceil(radius / self.cell_size)) + 1
+        best_by_stream = {}  # stream number -> (offset, segment, fraction)
+        seen = set()
+        for ring in range(max_ring + 1):
+            for cell in self._ring_cells(col, row, ring):
+                for seg in self.cells.get(cell, ()):
+                    if seg in seen:
+                        continue
+                    seen.add(seg)
+                    stream_num = self.seg_stream[seg]
+                    if self.llids[stream_num] == exclude_llid:
+                        continue
+                    offset, frac = point_segment_distance\
+                        (x, y, self.seg_x1[seg], self.seg_y1[seg],
+                         self.seg_x2[seg], self.seg_y2[seg])
+                    prev = best_by_stream.get(stream_num)
+                    if prev is None or offset < prev[0]:
+                        best_by_stream[stream_num] = (offset, seg, frac)
+
+        found = []
+        for stream_num, (offset, seg, frac) in best_by_stream.items():
+            if offset <= radius:
+                seg_len = math.hypot(self.seg_x2[seg] - self.seg_x1[seg],
+                                     self.seg_y2[seg] - self.seg_y1[seg])
+                found.append((offset, self.llids[stream_num],
+                              self.seg_start_dist[seg] + frac * seg_len))
+        return sorted(found)
+
+
+class RiverDistanceIndex(object):
+    """
+    Stream network topology, for measuring distance from the basin outlet.
+    For each stream, parents holds the LLID of the stream it flows into
+    (None for a stream reaching the outlet), confluence_dists holds the
+    distance along the parent at which it enters, confluence_gaps holds the
+    distance from the stream's mouth to the parent, and outlet_offsets holds
+    the river distance from the basin outlet to the stream's mouth.
+    """
+
+    def __init__(self, signature=None):
+        self.signature = signature
+        self.version = RIVER_INDEX_VERSION
+        self.parents = {}
+        self.confluence_dists = {}
+        self.confluence_gaps = {}
+        self.outlet_offsets = {}
+
+    def __repr__(self):
+        return "RiverDistanceIndex {} streams, {} outlets".\
+            format(len(self.parents),
+                   len([p for p in self.parents.values() if p is None]))
+
+    def distance_from_outlet(self, llid, stream_dist):
+        """
+        Converts a distance along a stream to a river distance from the
+        basin outlet.
+        :param llid: Location ID for stream
+        :param stream_dist: distance from the stream's mouth
+        :return: distance from the basin outlet, or None if the stream is
+            not in the index
+        """
+        offset = self.outlet_offsets.get(llid)
+        if offset is None:
+            return None
+        return offset + stream_dist
+
+    def compute_outlet_offsets(self):
+        """
+        Accumulates confluence distances from each stream down to the basin
+        outlet.  Where parents form a loop (e.g. two streams whose mouths
+        nearly touch), the stream in the loop farthest from its parent is
+        treated as reaching the outlet.
+        """
+        self.outlet_offsets = {}
+        for llid in self.parents:
+            # Walk downstream until reaching a stream with a known offset
+            path = []
+            current = llid
+            while current is not None and \
+                    current not in self.outlet_offsets:
+                if current in path:
+                    loop = path[path.index(current):]
+                    outlet = max(loop, key=lambda stream:
+                                 self.confluence_gaps.get(stream, 0.0))
+                    log.warning(" Tributary loop through {} {}; ".
+                                format(rgutil.LLID, loop) +
+                                "treating {} as a basin outlet".
+                                format(outlet))
+                    self.parents[outlet] = None
+                    self.confluence_dists[outlet] = 0.0
+                    path = path[:path.index(outlet)]
+                    current = outlet
+                path.append(current)
+                current = self.parents.get(current)
+            # Then fill in offsets on the way back upstream
+            for stream in reversed(path):
+                parent = self.parents[stream]
+                if parent is None:
+                    self.outlet_offsets[stream] = 0.0
+                else:
+                    self.outlet_offsets[stream] = \
+                        self.outlet_offsets[parent] + \
+                        self.confluence_dists[stream]
+
+
+# ********** FUNCTIONS **********
+
+def point_segment_distance(x, y, x1, y1, x2, y2):
+    """
+    Computes the distance from a point to a line segment.
+    :return: tuple of (distance, fraction along segment of closest point)
+    """
+    dx = x2 - x1
+    dy = y2 - y1
+    seg_len_sq = dx * dx + dy * dy
+    if seg_len_sq == 0.0:
+        frac = 0.0
+    else:
+        frac = ((x - x1) * dx + (y - y1) * dy) / seg_len_sq
+        frac = max(0.0, min(1.0, frac))
+    return math.hypot(x - (x1 + frac * dx), y - (y1 + frac * dy)), frac
+
+
+def stream_line_from_geometry(llid, stream_geom):
+    """
+    Creates a StreamLine from an arcpy Polyline geometry object.
+    :param llid: Location ID for stream
+    :param stream_geom: Polyline geometry object for stream
+    :return: new StreamLine object
+    """
+    xs = []
+    ys = []
+    part_starts = []
+    for part in stream_geom:
+        part_starts.append(len(xs))
+        for pnt in part:
+            if pnt is not None:  # None separates interior rings
+                xs.append(pnt.X)
+                ys.append(pnt.Y)
+    return StreamLine(llid, xs, ys, part_starts)
+
+
+def read_stream_lines(streams_pathname):
+    """
+    Reads every stream in the streams feature class as a StreamLine.
+    :param streams_pathname: feature class containing streams
+    :return: list of StreamLine objects
+    """
+    stream_lines = []
+    with arcpy.da.SearchCursor(streams_pathname,
+                               ["SHAPE@", rgutil.LLID]) as cursor:
+        for stream_geom, llid in cursor:
+            if stream_geom is not None:
+                stream_lines.append(stream_line_from_geometry(str(llid),
+                                                              stream_geom))
+    return stream_lines
+
+
+def build_stream_segment_index(streams_pathname):
+    """
+    Builds a network-wide segment index for the streams feature class.
+    :param streams_pathname: feature class containing streams
+    :return: new StreamSegmentIndex object
+    """
+    return StreamSegmentIndex(read_stream_lines(streams_pathname))
+
+
+def streams_signature(streams_pathname):
+    """
+    Computes a signature of the streams feature class from each stream's
+    LLID, length and centroid, without reading the geometries.
+    :param streams_pathname: feature class containing streams
+    :return: hex digest string, which changes when any stream changes
+    """
+    digest = hashlib.sha1()
+    with arcpy.da.SearchCursor(streams_pathname,
+                               [rgutil.LLID, "SHAPE@LENGTH", "SHAPE@XY"],
+                               sql_clause=(None, "ORDER BY {}".
+                                           format(rgutil.LLID))) as cursor:
+        for llid, length, centroid in cursor:
+            digest.update("{}|{!r}|{!r};".format(llid, length, centroid).
+                          encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_river_distance_index(stream_lines, stream_names=None,
+                               confluence_tolerance=DEFAULT_CONFLUENCE_TOLERANCE,
+                               signature=None):
+    """
+    Builds a RiverDistanceIndex for a stream network.  Each stream's parent
+    is the stream passing nearest its mouth (first vertex), within
+    confluence_tolerance.  When several streams are that close, the one
+    whose name matches the stream's Trib_To name is preferred.
+    :param stream_lines: StreamLine objects for every stream in the network
+    :param stream_names: optional dictionary keyed on LLID, with values of
+        (stream name, trib_to name), e.g. from stream distance information
+    :param confluence_tolerance: maximum distance from a stream's mouth to
+        its parent
+    :param signature: streams signature stored with the index, for caching
+    :return: new RiverDistanceIndex object
+    """
+    stream_names = stream_names or {}
+    segment_index = StreamSegmentIndex(stream_lines)
+    river_index = RiverDistanceIndex(signature)
+    for stream_line in stream_lines:
+        llid = stream_line.llid
+        candidates = segment_index.streams_within\
+            (stream_line.xs[0], stream_line.ys[0], confluence_tolerance,
+             exclude_llid=llid)
+        parent = None
+        confluence_dist = 0.0
+        offset = 0.0
+        if candidates:
+            offset, parent, confluence_dist = candidates[0]
+            trib_to = stream_names.get(llid, ("", ""))[1]
+            for cand_offset, cand_llid, cand_dist in candidates:
+                if trib_to != "" and \
+                        stream_names.get(cand_llid, ("", ""))[0] == trib_to:
+                    offset, parent, confluence_dist = \
+                        cand_offset, cand_llid, cand_dist
+                    break
+        river_index.parents[llid] = parent
+        river_index.confluence_dists[llid] = confluence_dist
+        river_index.confluence_gaps[llid] = offset
+        log.debug(" {} {} enters {} at {}".
+                  format(rgutil.LLID, llid, parent, confluence_dist))
+    river_index.compute_outlet_offsets()
+    log.info(" built {}".format(river_index))
+    return river_index
+
+
+def load_or_build_river_distance_index(streams_pathname, cache_filepath,
+                                       stream_names=None,
+                                       confluence_tolerance=DEFAULT_CONFLUENCE_TOLERANCE):
+    """
+    Loads the river distance index for the streams feature class from
+    cache_filepath, or builds it and saves it there if the cached index is
+    missing or was built from different streams.
+    :param streams_pathname: feature class containing streams
+    :param cache_filepath: full path to the cached index file
+    :param stream_names: optional dictionary of (name, trib_to) by LLID,
+        used to choose among streams meeting at a confluence
+    :param confluence_tolerance: maximum distance from a stream's mouth to
+        its parent
+    :return: RiverDistanceIndex object
+    """
+    signature = streams_signature(streams_pathname)
+    if stream_names:
+        # Names can change the choice of parent, so they are part of the key
+        names_digest = hashlib.sha1()
+        for llid in sorted(stream_names):
+            names_digest.update("{}|{}|{};".format(llid, *stream_names[llid]).
+                                encode('utf-8'))
+        signature += names_digest.hexdigest()
+    if os.path.exists(cache_filepath):
+        try:
+            with open(cache_filepath, 'rb') as cache_file:
+                river_index = pickle.load(cache_file)
+            if river_index.signature == signature and \
+                    river_index.version == RIVER_INDEX_VERSION:
+                log.info(" loaded {} from {}".format(river_index,
+                                                    cache_filepath))
+                return river_index
+            log.info(" streams changed since {} was built; rebuilding".
+                     format(cache_filepath))
+        except (IOError, EOFError, pickle.UnpicklingError,
+                AttributeError) as err:
+            log.warning(" cannot read river index {}: {}".
+                        format(cache_filepath, err))
+
+    river_index = build_river_distance_index\
+        (read_stream_lines(streams_pathname), stream_names,
+         confluence_tolerance, signature)
+    # Write to a temporary file first, so an interrupted run leaves no
+    # partial cache behind
+    temp_filepath = cache_filepath + ".tmp"
+    with open(temp_filepath, 'wb') as cache_file:
+        pickle.dump(river_index, cache_file, pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(cache_filepath):
+        os.remove(cache_filepath)
+    os.rename(temp_filepath, cache_filepath)
+    return river_index
+
+
+def project_xy_to_streams(x_coord, y_coord, sync_coords_in_lat_long,
+                          streams_spat_ref):
+    """
+    Converts survey x,y coordinates to the coordinates of the streams.
+    :param x_coord: survey x coordinate
+    :param y_coord: survey y coordinate
+    :param sync_coords_in_lat_long: True if coordinates are in lat/long
+        (decimal degrees), False if in the streams reference system
+    :param streams_spat_ref: spatial reference of the streams feature class
+    :return: tuple of (x, y) in the streams reference system
+    """
+    if not sync_coords_in_lat_long:
+        return x_coord, y_coord
+    pt_geom = arcpy.PointGeometry(arcpy.Point(x_coord, y_coord),
+                                  rgutil.lat_long_crs())
+    pt_geom = pt_geom.projectAs(streams_spat_ref)
+    return pt_geom.firstPoint.X, pt_geom.firstPoint.Y
+
+
+def assign_nearest_llid(stream_index, row, sync_coords_in_lat_long,
+                        streams_spat_ref,
+                        max_snap_dist=DEFAULT_MAX_SNAP_DIST):
+    """
+    Assigns an LLID to a survey row with no LocationID, using the stream
+    nearest to the row's X, Y coordinates.  The assignment, its snap
+    distance and its ambiguity are logged.
+    :param stream_index: StreamSegmentIndex for the streams feature class
+    :param row: namedtuple containing 1 row of survey data
+    :param sync_coords_in_lat_long: True if X and Y are in lat/long
+    :param streams_spat_ref: spatial reference of the streams feature class
+    :param max_snap_dist: maximum distance from row location to stream
+    :return: NearestStream for the assignment, or None if the row has no
+        X, Y coordinates or no stream is close enough
+    """
+    x_coord = rgutil.parse_float_or_NA(row.X)
+    y_coord = rgutil.parse_float_or_NA(row.Y)
+    if x_coord is None or y_coord is None:
+        return None
+    x_coord, y_coord = project_xy_to_streams(x_coord, y_coord,
+                                             sync_coords_in_lat_long,
+                                             streams_spat_ref)
+    match = stream_index.nearest(x_coord, y_coord, max_snap_dist)
+    if match is None:
+        log.warning(" No stream within {} of ({}, {}) for ".
+                    format(max_snap_dist, row.X, row.Y) +
+                    "stream {}, pool {}".format(row.STREAM, row.Pool_num))
+    else:
+        log.info(" Assigned {} {} to stream {}, pool {}: ".
+                 format(rgutil.LLID, match.llid, row.STREAM,
+                        row.Pool_num) +
+                 "snap distance {:.1f}, ambiguity {:.2f}{}".
+                 format(match.snap_dist, match.ambiguity,
+                        " (AMBIGUOUS, runner-up {} at {:.1f})".
+                        format(match.runner_up_llid,
+                               match.runner_up_dist)
+                        if match.ambiguous else ""))
+    return match
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Pre-rendered tile pyramid of georeferenced survey points,
+# for reviewing a whole basin without loading every point.  Tiles are
+# stored in one SQLite file laid out as an MBTiles tileset (metadata and
+# tiles tables, TMS tile rows).  At each zoom level below the highest,
+# points falling in the same cell of a grid over the tile are merged into
+# one cluster feature with a point count and the range of adjustment
+# factors; at the highest zoom level every point is its own feature, with
+# its LLID, pool number and adjustment factor.
+#
+# Tiles are generated in parallel worker processes and written by the
+# calling process.  The file also records a signature of each stream's
+# points and the tiles they fall in, so rebuilding after some streams
+# change regenerates only the tiles those streams touch, before or after
+# the change.
+#
+#   Tile data: gzip compressed json, {"extent": TILE_EXTENT, "features":
+#   [{"xy": [x, y], "properties": {...}}, ...]}, with x, y in tile pixels
+#   from the tile's upper left corner, as in vector tiles.
+#
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+#            http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+#            https://docs.python.org/2/library/sqlite3.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import math
+import json
+import gzip
+import io
+import hashlib
+import sqlite3
+import logging
+import multiprocessing
+from collections import namedtuple
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+DEFAULT_MIN_ZOOM = 6
+DEFAULT_MAX_ZOOM = 16  # about 2 m per tile pixel
+TILE_EXTENT = 4096  # tile pixels along each side
+CLUSTER_CELLS = 32  # clustering grid cells along each side of a tile
+MAX_LATITUDE = 85.0511287798  # limit of web mercator tiles
+TILE_FORMAT = "json"
+TILES_PER_TASK = 64  # tiles generated per worker task
+PYRAMID_VERSION = 1  # increment when tile contents change
+
+LLID_PROPERTY = "LLID"
+POOL_NUM_PROPERTY = "Pool_num"
+ADJ_FACTOR_PROPERTY = "Adj_Factor"
+COUNT_PROPERTY = "count"
+MIN_ADJ_FACTOR_PROPERTY = "Min_Adj_Factor"
+MAX_ADJ_FACTOR_PROPERTY = "Max_Adj_Factor"
+
+SCHEMA = ["CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, " +
+          "value TEXT)",
+          "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, " +
+          "tile_column INTEGER, tile_row INTEGER, tile_data BLOB, " +
+          "PRIMARY KEY (zoom_level, tile_column, tile_row))",
+          "CREATE TABLE IF NOT EXISTS streams (llid TEXT PRIMARY KEY, " +
+          "signature TEXT)",
+          "CREATE TABLE IF NOT EXISTS stream_tiles (llid TEXT, " +
+          "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER)",
+          "CREATE INDEX IF NOT EXISTS stream_tiles_llid " +
+          "ON stream_tiles (llid)"]
+
+
+# ********** CLASSES **********
+
+# A survey point to show in the tiles, in lat/long decimal degrees
+TilePoint = namedtuple('TilePoint', ['llid', 'lon', 'lat', 'pool_num',
+                                     'adj_factor'])
+
+
+# ********** FUNCTIONS **********
+
+def tile_pixel(lon, lat, zoom):
+    """
+    Finds the tile containing a point at a zoom level, and the point's
+    position in the tile.
+    :return: tuple of (tile column, tile y counted from the north, pixel x,
+        pixel y), with pixels counted from the tile's upper left corner
+    """
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    num_tiles = 2 ** zoom
+    world_x = (lon + 180.0) / 360.0 * num_tiles
+    lat_rad = math.radians(lat)
+    world_y = (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) /
+               math.pi) / 2.0 * num_tiles
+    tile_x = min(num_tiles - 1, max(0, int(world_x)))
+    tile_y = min(num_tiles - 1, max(0, int(world_y)))
+    pixel_x = min(TILE_EXTENT - 1, int((world_x - tile_x) * TILE_EXTENT))
+    pixel_y = min(TILE_EXTENT - 1, int((world_y - tile_y) * TILE_EXTENT))
+    return tile_x, tile_y, pixel_x, pixel_y
+
+
+def tile_row(zoom, tile_y):
+    """
+    Converts a tile y counted from the north to an MBTiles (TMS) tile row,
+    counted from the south.
+    """
+    return 2 ** zoom - 1 - tile_y
+
+
+def tile_features(zoom, max_zoom, pixels):
+    """
+    Makes the features of one tile from its points.
+    :param zoom: zoom level of the tile
+    :param max_zoom: highest zoom level, at which points are not clustered
+    :param pixels: list of (pixel x, pixel y, TilePoint) tuples
+    :return: list of feature dictionaries
+    """
+    if zoom >= max_zoom:
+        return [{"xy": [pixel_x, pixel_y],
+                 "properties": {LLID_PROPERTY: point.llid,
+                                POOL_NUM_PROPERTY: point.pool_num,
+                                ADJ_FACTOR_PROPERTY: point.adj_factor}}
+                for pixel_x, pixel_y, point in
+                sorted(pixels, key=lambda item: (item[2].llid, item[1],
+                                                 item[0]))]
+
+    cell_size = TILE_EXTENT // CLUSTER_CELLS
+    cells = {}
+    for pixel_x, pixel_y, point in pixels:
+        cells.setdefault((pixel_x // cell_size, pixel_y // cell_size),
+                         []).append((pixel_x, pixel_y, point))
+    features = []
+    for cell in sorted(cells):
+        members = cells[cell]
+        count = len(members)
+        factors = [point.adj_factor for pixel_x, pixel_y, point in members
+                   if point.adj_factor is not None]
+        llids = set(point.llid for pixel_x, pixel_y, point in members)
+        properties = {COUNT_PROPERTY: count,
+                      LLID_PROPERTY: llids.pop() if len(llids) == 1
+                      else None,
+                      MIN_ADJ_FACTOR_PROPERTY: min(factors) if factors
+                      else None,
+                      MAX_ADJ_FACTOR_PROPERTY: max(factors) if factors
+                      else None}
+        if count == 1:
+            properties[POOL_NUM_PROPERTY] = members[0][2].pool_num
+        features.append({"xy": [sum(item[0] for item in members) // count,
+                                sum(item[1] for item in members) // count],
+                         "properties": properties})
+    return features
+
+
+def encode_tile(features):
+    """
+    Encodes tile features as gzip compressed json.
+    """
+    buf = io.BytesIO()
+    # mtime=0 keeps unchanged tiles byte for byte identical
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz_file:
+        gz_file.write(json.dumps({"extent": TILE_EXTENT,
+                                  "features": features},
+                                 sort_keys=True).encode('utf-8'))
+    return buf.getvalue()
+
+
+def decode_tile(tile_data):
+    """
+    Decodes tile data written by encode_tile.
+    :return: dictionary with "extent" and "features"
+    """
+    with gzip.GzipFile(fileobj=io.BytesIO(tile_data), mode='rb') as gz_file:
+        return json.loads(gz_file.read().decode('utf-8'))
+
+
+def render_tiles(task):
+    """
+    Renders a batch of tiles; run in worker processes.
+    :param task: tuple of (max zoom, list of (zoom, tile x, tile y, pixels)
+        tuples, pixels as for tile_features)
+    :return: list of (zoom, tile column, tile row, tile data) tuples
+    """
+    max_zoom, tiles = task
+    return [(zoom, tile_x, tile_row(zoom, tile_y),
+             encode_tile(tile_features(zoom, max_zoom, pixels)))
+            for zoom, tile_x, tile_y, pixels in tiles]
+
+
+def stream_signatures(points):
+    """
+    Computes a signature of each stream's points.
+    :param points: iterable of TilePoint
+    :return: dictionary of hex digest strings keyed on LLID
+    """
+    stream_points = {}
+    for point in points:
+        stream_points.setdefault(point.llid, []).append(point)
+    signatures = {}
+    for llid, llid_points in stream_points.items():
+        digest = hashlib.sha1("{}|{}|{}|{};".format(PYRAMID_VERSION,
+                                                    TILE_EXTENT,
+                                                    CLUSTER_CELLS,
+                                                    llid).encode('utf-8'))
+        for point_text in sorted("{!r}|{!r}|{}|{!r};".
+                                 format(point.lon, point.lat, point.pool_num,
+                                        point.adj_factor)
+                                 for point in llid_points):
+            digest.update(point_text.encode('utf-8'))
+        signatures[llid] = digest.hexdigest()
+    return signatures
+
+
+def write_tile_pyramid(tiles_filepath, points, min_zoom=DEFAULT_MIN_ZOOM,
+                       max_zoom=DEFAULT_MAX_ZOOM, workers=1, name=""):
+    """
+    Builds or updates the tile pyramid of a set of points.  If tiles_filepath
+    already holds a pyramid for the same zoom levels, only the tiles touched
+    by streams whose points changed, were added or were removed are
+    regenerated; otherwise every tile is generated.
+    :param tiles_filepath: path of the SQLite tiles file
+    :param points: list of TilePoint, every point of the survey
+    :param min_zoom: lowest zoom level
+    :param max_zoom: highest zoom level, at which points are not clustered
+    :param workers: number of worker processes generating tiles; 1
+        generates them in this process
+    :param name: name of the tileset, stored in its metadata
+    :return: tuple of (tiles written, tiles removed)
+    """
+    connection = sqlite3.connect(tiles_filepath)
+    try:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        metadata = dict(connection.execute("SELECT name, value " +
+                                           "FROM metadata"))
+        signatures = stream_signatures(points)
+        old_signatures = dict(connection.execute("SELECT llid, signature " +
+                                                 "FROM streams"))
+        full_rebuild = metadata.get("minzoom") != str(min_zoom) or \
+            metadata.get("maxzoom") != str(max_zoom)
+        if full_rebuild:
+            changed_llids = set(signatures) | set(old_signatures)
+        else:
+            changed_llids = set(llid for llid in
+                                set(signatures) | set(old_signatures)
+                                if signatures.get(llid) !=
+                                old_signatures.get(llid))
+
+        # Tiles touched by changed streams, before and after the change
+        new_stream_tiles = {}
+        tile_points = {}
+        for point in points:
+            for zoom in range(min_zoom, max_zoom + 1):
+                tile_x, tile_y, pixel_x, pixel_y = \
+                    tile_pixel(point.lon, point.lat, zoom)
+                tile_points.setdefault((zoom, tile_x, tile_y), []).\
+                    append((pixel_x, pixel_y, point))
+                if point.llid in changed_llids:
+                    new_stream_tiles.setdefault(point.llid, set()).\
+                        add((zoom, tile_x, tile_row(zoom, tile_y)))
+        affected = set()
+        for tiles in new_stream_tiles.values():
+            affected.update(tiles)
+        if full_rebuild:
+            affected.update(connection.execute("SELECT zoom_level, " +
+                                               "tile_column, tile_row " +
+                                               "FROM tiles"))
+        else:
+            for llid in changed_llids:
+                affected.update(connection.execute
+                                ("SELECT zoom_level, tile_column, " +
+                                 "tile_row FROM stream_tiles WHERE llid = ?",
+                                 (llid,)))
+
+        tasks = []
+        batch = []
+        removed = []
+        for zoom, tile_x, row in sorted(affected):
+            tile_y = tile_row(zoom, row)
+            pixels = tile_points.get((zoom, tile_x, tile_y))
+            if not pixels:
+                removed.append((zoom, tile_x, row))
+                continue
+            batch.append((zoom, tile_x, tile_y, pixels))
+            if len(batch) == TILES_PER_TASK:
+                tasks.append((max_zoom, batch))
+                batch = []
+        if batch:
+            tasks.append((max_zoom, batch))
+
+        if workers > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(workers)
+            try:
+                rendered = pool.imap_unordered(render_tiles, tasks)
+                num_written = store_tiles(connection, rendered)
+            finally:
+                pool.terminate()
+        else:
+            num_written = store_tiles(connection,
+                                      (render_tiles(task) for task in tasks))
+
+        connection.executemany("DELETE FROM tiles WHERE zoom_level = ? AND " +
+                               "tile_column = ? AND tile_row = ?", removed)
+        for llid in changed_llids:
+            connection.execute("DELETE FROM stream_tiles WHERE llid = ?",
+                               (llid,))
+            connection.execute("DELETE FROM streams WHERE llid = ?", (llid,))
+            if llid in signatures:
+                connection.execute("INSERT INTO streams VALUES (?, ?)",
+                                   (llid, signatures[llid]))
+                connection.executemany("INSERT INTO stream_tiles " +
+                                       "VALUES (?, ?, ?, ?)",
+                                       [(llid,) + tile for tile
+                                        in new_stream_tiles[llid]])
+        write_metadata(connection, points, min_zoom, max_zoom, name)
+        connection.commit()
+    finally:
+        connection.close()
+    log.info(" {} tiles written, {} removed for {} changed streams in {}".
+             format(num_written, len(removed), len(changed_llids),
+                    tiles_filepath))
+    return num_written, len(removed)
+
+
+def store_tiles(connection, rendered_batches):
+    """
+    Writes rendered tiles, replacing existing tiles.
+    :return: number of tiles written
+    """
+    num_written = 0
+    for tiles in rendered_batches:
+        connection.executemany("INSERT OR REPLACE INTO tiles " +
+                               "VALUES (?, ?, ?, ?)",
+                               [(zoom, column, row, sqlite3.Binary(data))
+                                for zoom, column, row, data in tiles])
+        num_written += len(tiles)
+    return num_written
+
+
+def write_metadata(connection, points, min_zoom, max_zoom, name):
+    """
+    Writes the MBTiles metadata of the tileset.
+    """
+    metadata = {"name": name, "format": TILE_FORMAT, "type": "overlay",
+                "version": str(PYRAMID_VERSION),
+                "minzoom": str(min_zoom), "maxzoom": str(max_zoom),
+                "description": "RBA survey points, clustered below zoom {}".
+                format(max_zoom)}
+    if points:
+        bounds = [min(point.lon for point in points),
+                  min(point.lat for point in points),
+                  max(point.lon for point in points),
+                  max(point.lat for point in points)]
+        metadata["bounds"] = ",".join(repr(value) for value in bounds)
+        metadata["center"] = "{!r},{!r},{}".format\
+            ((bounds[0] + bounds[2]) / 2.0, (bounds[1] + bounds[3]) / 2.0,
+             min_zoom)
+    connection.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                           sorted(metadata.items()))
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
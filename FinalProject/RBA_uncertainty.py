@@ -0,0 +1,236 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Monte Carlo propagation of sync point errors to the
+# georeferenced locations of survey pools.  For each stream, N samples of
+# sync point errors are drawn at once as numpy arrays: x,y coordinate
+# errors, moved onto the stream along its direction at the snapped
+# location, and survey distance errors.  Adjustment factors and adjusted
+# distances for every pool and sample are then recomputed with array
+# operations, and the spread of each pool's sampled locations is reported.
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): http://docs.scipy.org/doc/numpy/reference/routines.random.html
+#            http://docs.scipy.org/doc/numpy/reference/generated/numpy.interp.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import math
+import logging
+from collections import namedtuple
+import numpy as np
+import RBA_georef_util as rgutil
+
+
+# ********** GLOBAL CONSTANTS **********
+
+DEFAULT_SAMPLES = 1000
+DEFAULT_XY_ERROR = 15.0  # std dev of sync x and y, in stream units
+DEFAULT_SURVEY_DIST_ERROR = 10.0  # std dev of sync survey distance
+MAX_SAMPLE_VALUES = 4000000  # samples x pools computed at one time
+STREAM_SEED_LIMIT = 2 ** 31 - 1  # seeds drawn by stream_error_model
+
+
+# ********** CLASSES **********
+
+# Error model: number of samples, standard deviations of the normally
+# distributed errors, and random seed (None for unseeded runs)
+ErrorModel = namedtuple('ErrorModel', ['samples', 'xy_error',
+                                       'survey_dist_error', 'seed'])
+
+
+class StreamUncertainty(object):
+    """
+    Sampled sync point errors for one stream, from which the positional
+    spread of any pool on the stream can be computed.  Sync points shared
+    by consecutive adjustment factors are perturbed together, so every
+    sample is a consistent set of adjustment factors.
+    """
+
+    def __init__(self, stream_line, stream_adj_factors, error_model,
+                 random_state):
+        """
+        :param stream_line: StreamLine for the stream
+        :param stream_adj_factors: sequence of tuples
+            (begin_sync_point, end_sync_point, adj_factor) for the stream
+        :param error_model: ErrorModel
+        :param random_state: numpy RandomState used to draw the errors
+        """
+        self.stream_line = stream_line
+        self.cum_dists = np.frombuffer(stream_line.cum_dists, dtype=float)
+        self.xs = np.frombuffer(stream_line.xs, dtype=float)
+        self.ys = np.frombuffer(stream_line.ys, dtype=float)
+
+        # Unique sync points, and the points beginning and ending each
+        # adjustment factor's segment
+        point_nums = {}
+        points = []
+        begin_nums = []
+        end_nums = []
+        for begin_pt, end_pt, adj_factor in stream_adj_factors:
+            for sync_pt, nums in ((begin_pt, begin_nums), (end_pt, end_nums)):
+                key = (sync_pt.survey_cum_dist, sync_pt.streamline_cum_dist)
+                if key not in point_nums:
+                    point_nums[key] = len(points)
+                    points.append(sync_pt)
+                nums.append(point_nums[key])
+        self.begin_nums = np.array(begin_nums, dtype=int)
+        self.end_nums = np.array(end_nums, dtype=int)
+        self.factors = np.array([factor[2] for factor in stream_adj_factors],
+                                dtype=float)
+        survey_dists = np.array([pt.survey_cum_dist for pt in points],
+                                dtype=float)
+        streamline_dists = np.array([pt.streamline_cum_dist for pt in points],
+                                    dtype=float)
+        self.begin_survey_dists = survey_dists[self.begin_nums]
+        self.end_survey_dists = survey_dists[self.end_nums]
+
+        # Only sync points located by x,y coordinates have errors
+        measured = np.array([pt.x_coord is not None for pt in points])
+        tangents = np.array([self._tangent(dist) for dist in
+                             streamline_dists]).reshape(len(points), 2)
+
+        # Linearized snap: an x,y error moves the snapped location along
+        # the stream by the error's component in the stream's direction
+        samples = error_model.samples
+        xy_errors = random_state.normal(0.0, error_model.xy_error,
+                                        (samples, len(points), 2))
+        streamline_errors = (xy_errors * tangents).sum(axis=2) * measured
+        survey_errors = random_state.normal(0.0,
+                                            error_model.survey_dist_error,
+                                            (samples, len(points))) * measured
+        self.sampled_streamline = streamline_dists + streamline_errors
+        self.sampled_survey = survey_dists + survey_errors
+
+        # Rescale each factor by the sampled change in its segment's
+        # streamline and survey lengths; factors of unmeasured segments
+        # (e.g. unsynced stream ends) are unchanged
+        base_streamline_len = streamline_dists[self.end_nums] - \
+            streamline_dists[self.begin_nums]
+        base_survey_len = self.end_survey_dists - self.begin_survey_dists
+        rescaled = measured[self.end_nums] & (base_streamline_len > 0) & \
+            (base_survey_len > 0)
+        base_streamline_len[~rescaled] = 1.0
+        base_survey_len[~rescaled] = 1.0
+        streamline_ratio = (self.sampled_streamline[:, self.end_nums] -
+                            self.sampled_streamline[:, self.begin_nums]) / \
+            base_streamline_len
+        survey_ratio = (self.sampled_survey[:, self.end_nums] -
+                        self.sampled_survey[:, self.begin_nums]) / \
+            base_survey_len
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.sampled_factors = np.where(rescaled,
+                                            self.factors * streamline_ratio /
+                                            survey_ratio, self.factors)
+
+    def __repr__(self):
+        return "StreamUncertainty {}, {} samples, {} adj factors".\
+            format(self.stream_line.llid, self.sampled_factors.shape[0],
+                   len(self.factors))
+
+    def _tangent(self, distance):
+        """
+        Unit vector in the downstream-to-upstream direction of the stream
+        at the given distance, or (0, 0) for a stream with no length.
+        """
+        if len(self.stream_line.xs) < 2:
+            return (0.0, 0.0)
+        i = self.stream_line.segment_index_at(distance)
+        dx = self.stream_line.xs[i + 1] - self.stream_line.xs[i]
+        dy = self.stream_line.ys[i + 1] - self.stream_line.ys[i]
+        seg_len = math.hypot(dx, dy)
+        if seg_len <= 0.0:
+            return (0.0, 0.0)
+        return (dx / seg_len, dy / seg_len)
+
+    def factor_nums(self, pool_survey_dists):
+        """
+        Finds the adjustment factor applied to each pool, as
+        adjust_stream_distance does: the first factor whose segment includes
+        the pool's survey distance, or -1 where none does, in which case the
+        last factor's begin point and DEFAULT_ADJ_FACTOR are used.
+        """
+        nums = np.searchsorted(self.end_survey_dists, pool_survey_dists,
+                               side='left')
+        nums[nums >= len(self.factors)] = -1
+        outside = (nums < 0) | \
+            (self.begin_survey_dists[nums] > pool_survey_dists)
+        nums[outside] = -1
+        return nums
+
+    def adjusted_distances(self, pool_survey_dists):
+        """
+        Computes the sampled adjusted distances of pools.
+        :param pool_survey_dists: numpy array of survey distances of pools
+        :return: numpy array of adjusted distances, samples x pools
+        """
+        nums = self.factor_nums(pool_survey_dists)
+        begin_nums = self.begin_nums[nums]
+        factors = self.sampled_factors[:, nums]
+        factors[:, nums < 0] = rgutil.DEFAULT_ADJ_FACTOR
+        return self.sampled_streamline[:, begin_nums] + \
+            (pool_survey_dists - self.sampled_survey[:, begin_nums]) * factors
+
+    def positional_spread(self, pool_survey_dists):
+        """
+        Computes the spread of each pool's sampled locations: the standard
+        distance (root mean square distance from the mean location).
+        :param pool_survey_dists: sequence of survey distances of pools
+        :return: numpy array of spreads, in stream units
+        """
+        pool_survey_dists = np.asarray(pool_survey_dists, dtype=float)
+        if not len(self.factors):
+            return np.zeros(len(pool_survey_dists))
+        spreads = np.empty(len(pool_survey_dists))
+        chunk_size = max(1, MAX_SAMPLE_VALUES //
+                         self.sampled_factors.shape[0])
+        for start in range(0, len(pool_survey_dists), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            distances = self.adjusted_distances(pool_survey_dists[chunk])
+            pts_x = np.interp(distances, self.cum_dists, self.xs)
+            pts_y = np.interp(distances, self.cum_dists, self.ys)
+            spreads[chunk] = np.sqrt(pts_x.var(axis=0) + pts_y.var(axis=0))
+        return spreads
+
+
+# ********** FUNCTIONS **********
+
+def new_random_state(error_model):
+    """
+    Creates the random number generator for a run.
+    """
+    return np.random.RandomState(error_model.seed)
+
+
+def stream_error_model(error_model, random_state):
+    """
+    Creates the error model of one stream, seeded from the run's random
+    number generator, for streams sampled in worker processes.  Streams
+    drawn in the same order get the same seeds whichever workers sample
+    them.
+    :param error_model: ErrorModel of the run
+    :param random_state: random number generator of the run, from
+        new_random_state
+    :return: ErrorModel with the stream's seed
+    """
+    return error_model._replace(seed=int(random_state.randint
+                                         (STREAM_SEED_LIMIT)))
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
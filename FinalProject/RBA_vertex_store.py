@@ -0,0 +1,474 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Stream vertices shared by worker processes.  The process
+# that starts the workers packs the vertices and cumulative distances of
+# every stream it needs into one file, with a table of each stream's
+# location ID (LLID) and offsets.  Workers map the file read-only and view
+# its arrays in place with numpy, so each stream is stored once however
+# many workers use it, and a worker starts by mapping a file rather than
+# fetching polylines or unpickling copies.  SharedStreamLine computes
+# positions along a stream and snaps points to it directly on the shared
+# arrays.
+#
+# georef_RBA_survey_data --stream_workers uses a store so that worker
+# processes compute the positional spreads (RBA_uncertainty) and scenario
+# values (RBA_scenarios) of several streams at once.
+#
+# Each store is named for its host and owning process.  The owner stops
+# its workers and removes it when done; a store left behind by an owner
+# that crashed is removed the next time a store is created in the same
+# directory.
+#
+#   Store layout (little-endian):
+#       MAGIC, then header: owner pid, streams, vertices, parts, LLID bytes
+#       vertex offsets: int64, one per stream plus one
+#       part offsets: int64, one per stream plus one
+#       part starts: int64, vertex index of each part within its stream
+#       xs, ys, cum_dists: float64, one per vertex
+#       LLIDs: utf-8 text, one per line, in stream order
+#
+#   Example:
+#       with vertex_store_workers(stream_lines, 4) as workers:
+#           workers.pool.apply_async(task, (workers.store_filepath, ...))
+#           ... task calls attach_vertex_store(store_filepath) ...
+#
+# This file is for import by top-level scripts only.
+#
+# SOURCE(S): https://docs.python.org/2/library/mmap.html
+#            https://docs.python.org/2/library/multiprocessing.html
+#            http://docs.scipy.org/doc/numpy/reference/generated/numpy.frombuffer.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import errno
+import socket
+import struct
+import mmap
+import logging
+import itertools
+import tempfile
+import multiprocessing
+from collections import namedtuple
+from contextlib import contextmanager
+import numpy as np
+import RBA_georef_util as rgutil
+import RBA_stream_network as rgnet
+from RBA_georef_util import arcpy  # imported on first use
+from RBA_georef_util import log  # logger of the calling session
+
+
+# ********** GLOBAL CONSTANTS **********
+
+MAGIC = b"RBAVTX\x01\x00"
+HEADER_FORMAT = "<QQQQQ"
+HEADER_BYTES = struct.calcsize(HEADER_FORMAT)
+STORE_PREFIX = "rba_vertices_"
+STORE_SUFFIX = ".dat"
+TEMP_SUFFIX = ".tmp"
+
+# Windows process query, for finding stores of crashed owners
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+ERROR_ACCESS_DENIED = 5
+
+_store_numbers = itertools.count(1)  # numbers the stores of this process
+_attached_stores = {}  # stores attached by this process, by file path
+
+
+# ********** CLASSES **********
+
+# Worker processes attached to a vertex store: their multiprocessing.Pool,
+# the store's full path, and the number of workers
+StoreWorkers = namedtuple('StoreWorkers', ['pool', 'store_filepath',
+                                           'processes'])
+
+
+class SharedStreamLine(rgnet.StreamLine):
+    """
+    StreamLine whose vertices and cumulative distances are read-only numpy
+    views into a vertex store.  Creating one copies no vertices.
+    """
+
+    def __init__(self, llid, xs, ys, cum_dists, part_starts):
+        self.llid = llid
+        self.xs = xs
+        self.ys = ys
+        self.cum_dists = cum_dists
+        self.part_starts = part_starts
+        self._part_start_set = set(part_starts)
+
+    def __repr__(self):
+        return "SharedStreamLine {}, {} vertices, length {}".\
+            format(self.llid, len(self.xs), self.length)
+
+    def segment_index_at(self, distance):
+        """
+        Finds the segment containing the given distance along the stream.
+        See StreamLine.segment_index_at.
+        """
+        i = int(np.searchsorted(self.cum_dists, distance, side='right')) - 1
+        i = max(0, min(i, len(self.xs) - 2))
+        while i + 1 in self._part_start_set and i > 0:
+            i -= 1
+        return i
+
+    def query_point_and_distance(self, x, y):
+        """
+        Snaps a point to the stream, measuring its distance to every
+        segment at once.  See StreamLine.query_point_and_distance.
+        """
+        offsets = None
+        if len(self.xs) > 1:
+            x1 = self.xs[:-1]
+            y1 = self.ys[:-1]
+            dx = self.xs[1:] - x1
+            dy = self.ys[1:] - y1
+            seg_len_sq = dx * dx + dy * dy
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fracs = np.where(seg_len_sq > 0.0,
+                                 ((x - x1) * dx + (y - y1) * dy) / seg_len_sq,
+                                 0.0)
+            fracs = np.clip(fracs, 0.0, 1.0)
+            offsets = np.hypot(x - (x1 + fracs * dx), y - (y1 + fracs * dy))
+            # No segment joins one part to the next
+            offsets[np.asarray(self.part_starts[1:], dtype=int) - 1] = np.inf
+        if offsets is None or not np.isfinite(offsets).any():
+            return (self.xs[0], self.ys[0]), 0.0, \
+                float(np.hypot(x - self.xs[0], y - self.ys[0]))
+        i = int(offsets.argmin())
+        frac = float(fracs[i])
+        snapped = (float(self.xs[i] + frac * dx[i]),
+                   float(self.ys[i] + frac * dy[i]))
+        streamline_dist = float(self.cum_dists[i] +
+                                frac * (self.cum_dists[i + 1] -
+                                        self.cum_dists[i]))
+        return snapped, streamline_dist, float(offsets[i])
+
+
+class VertexStore(object):
+    """
+    Read-only view of a vertex store file, mapped into memory.  Can be used
+    as a context manager, which unmaps the file.
+    """
+
+    def __init__(self, store_filepath):
+        self.store_filepath = store_filepath
+        self._file = open(store_filepath, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            self._file.close()
+            raise IOError("{} is not a vertex store".format(store_filepath))
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise IOError("{} is not a vertex store".format(store_filepath))
+        self.owner_pid, num_streams, num_vertices, num_parts, llid_bytes = \
+            struct.unpack_from(HEADER_FORMAT, self._mm, len(MAGIC))
+        pos = len(MAGIC) + HEADER_BYTES
+        self._vertex_offsets, pos = self._view('<i8', num_streams + 1, pos)
+        self._part_offsets, pos = self._view('<i8', num_streams + 1, pos)
+        self._part_starts, pos = self._view('<i8', num_parts, pos)
+        self._xs, pos = self._view('<f8', num_vertices, pos)
+        self._ys, pos = self._view('<f8', num_vertices, pos)
+        self._cum_dists, pos = self._view('<f8', num_vertices, pos)
+        llids = self._mm[pos:pos + llid_bytes].decode('utf-8').split("\n")
+        self._stream_nums = dict((llid, num) for num, llid
+                                 in enumerate(llids) if num < num_streams)
+
+    def __repr__(self):
+        return "VertexStore {}, {} streams, {} vertices".\
+            format(self.store_filepath, len(self._stream_nums),
+                   len(self._xs) if self._xs is not None else 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._stream_nums)
+
+    def __contains__(self, llid):
+        return llid in self._stream_nums
+
+    def llids(self):
+        return sorted(self._stream_nums, key=self._stream_nums.get)
+
+    def _view(self, dtype, count, pos):
+        """
+        Views count values of dtype at pos in the mapped file, without
+        copying them.
+        :return: tuple of (read-only numpy array, position after it)
+        """
+        values = np.frombuffer(self._mm, dtype=dtype, count=count,
+                               offset=pos)
+        return values, pos + values.nbytes
+
+    def stream_line(self, llid):
+        """
+        Finds a stream in the store.
+        :param llid: Location ID for stream
+        :return: SharedStreamLine viewing the stream's vertices, or None if
+            the stream is not in the store
+        """
+        num = self._stream_nums.get(llid)
+        if num is None:
+            return None
+        start, end = self._vertex_offsets[num:num + 2]
+        part_start, part_end = self._part_offsets[num:num + 2]
+        return SharedStreamLine(llid, self._xs[start:end],
+                                self._ys[start:end],
+                                self._cum_dists[start:end],
+                                [int(part) for part in
+                                 self._part_starts[part_start:part_end]])
+
+    def close(self):
+        """
+        Unmaps the store.  Arrays of SharedStreamLines still held keep the
+        mapping open until they are released.
+        """
+        self._vertex_offsets = self._part_offsets = self._part_starts = None
+        self._xs = self._ys = self._cum_dists = None
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+
+# ********** FUNCTIONS **********
+
+def read_needed_stream_lines(streams_pathname, llids):
+    """
+    Reads the streams with the given LLIDs as StreamLines; other streams
+    are skipped without converting their geometries.
+    :param streams_pathname: feature class containing streams
+    :param llids: collection of Location IDs of the streams needed
+    :return: list of StreamLine objects
+    """
+    llids = set(llids)
+    stream_lines = []
+    with arcpy.da.SearchCursor(streams_pathname,
+                               ["SHAPE@", rgutil.LLID]) as cursor:
+        for stream_geom, llid in cursor:
+            if stream_geom is not None and str(llid) in llids:
+                stream_lines.append(rgnet.stream_line_from_geometry
+                                    (str(llid), stream_geom))
+    return stream_lines
+
+
+def write_vertex_store(store_filepath, stream_lines):
+    """
+    Packs the vertices of streams into a vertex store file.  The file is
+    written under a temporary name and renamed when complete, so workers
+    never map a partial store.
+    :param store_filepath: full path to the store file
+    :param stream_lines: StreamLine objects for the streams to store
+    :return: number of vertices stored
+    """
+    vertex_offsets = [0]
+    part_offsets = [0]
+    part_starts = []
+    for stream_line in stream_lines:
+        vertex_offsets.append(vertex_offsets[-1] + len(stream_line.xs))
+        part_starts.extend(stream_line.part_starts)
+        part_offsets.append(len(part_starts))
+    llid_text = "\n".join(stream_line.llid for stream_line
+                          in stream_lines).encode('utf-8')
+
+    temp_filepath = store_filepath + TEMP_SUFFIX
+    with open(temp_filepath, 'wb') as store_file:
+        store_file.write(MAGIC)
+        store_file.write(struct.pack(HEADER_FORMAT, os.getpid(),
+                                     len(stream_lines), vertex_offsets[-1],
+                                     len(part_starts), len(llid_text)))
+        for offsets in (vertex_offsets, part_offsets, part_starts):
+            np.asarray(offsets, dtype='<i8').tofile(store_file)
+        for attr in ("xs", "ys", "cum_dists"):
+            for stream_line in stream_lines:
+                np.asarray(getattr(stream_line, attr),
+                           dtype='<f8').tofile(store_file)
+        store_file.write(llid_text)
+    if os.path.exists(store_filepath):
+        os.remove(store_filepath)
+    os.rename(temp_filepath, store_filepath)
+    log.info(" stored {} vertices of {} streams in {}".
+             format(vertex_offsets[-1], len(stream_lines), store_filepath))
+    return vertex_offsets[-1]
+
+
+def process_alive(pid):
+    """
+    Checks whether a process on this host is still running.
+    :param pid: process id
+    :return: True if the process exists
+    """
+    if os.name == 'nt':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION,
+                                      False, pid)
+        if not handle:
+            return kernel32.GetLastError() == ERROR_ACCESS_DENIED
+        exit_code = ctypes.c_ulong()
+        try:
+            if not kernel32.GetExitCodeProcess(handle,
+                                               ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def store_owner(store_filename):
+    """
+    Finds the host and process that created a store from its file name.
+    :return: tuple of (host name, pid), or None if the name is not that of
+        a store
+    """
+    if not store_filename.startswith(STORE_PREFIX):
+        return None
+    name = store_filename[len(STORE_PREFIX):]
+    for suffix in (STORE_SUFFIX + TEMP_SUFFIX, STORE_SUFFIX):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    else:
+        return None
+    try:
+        host, pid, num = name.rsplit("_", 2)
+        return host, int(pid)
+    except ValueError:
+        return None
+
+
+def remove_stale_stores(store_dir):
+    """
+    Removes stores (and partly written stores) in a directory whose owning
+    process on this host is no longer running.
+    :param store_dir: directory holding stores
+    :return: number of stores removed
+    """
+    host = socket.gethostname()
+    num_removed = 0
+    for filename in os.listdir(store_dir):
+        owner = store_owner(filename)
+        if owner is None or owner[0] != host or process_alive(owner[1]):
+            continue
+        try:
+            os.remove(os.path.join(store_dir, filename))
+            num_removed += 1
+            log.info(" removed {}, left by stopped process {}".
+                     format(filename, owner[1]))
+        except OSError:
+            log.warning(" cannot remove {}, still in use".format(filename))
+    return num_removed
+
+
+@contextmanager
+def shared_vertex_store(stream_lines, store_dir=None):
+    """
+    Context manager that writes a vertex store for worker processes and
+    removes it on exit.  Stores left in store_dir by crashed processes are
+    removed first.
+    :param stream_lines: StreamLine objects for the streams to store
+    :param store_dir: directory for the store; if None, the temporary
+        directory
+    :return: full path to the store file, to be passed to the workers
+    """
+    if store_dir is None:
+        store_dir = tempfile.gettempdir()
+    remove_stale_stores(store_dir)
+    store_filepath = os.path.join\
+        (store_dir, "{}{}_{}_{}{}".format(STORE_PREFIX, socket.gethostname(),
+                                          os.getpid(), next(_store_numbers),
+                                          STORE_SUFFIX))
+    try:
+        write_vertex_store(store_filepath, stream_lines)
+        yield store_filepath
+    finally:
+        for filepath in (store_filepath + TEMP_SUFFIX, store_filepath):
+            if os.path.exists(filepath):
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    log.warning(" cannot remove {}, still in use".
+                                format(filepath))
+
+
+def attach_vertex_store(store_filepath):
+    """
+    Maps a vertex store into this process, once; later calls return the
+    same VertexStore.  Suitable as a multiprocessing.Pool initializer.
+    :param store_filepath: full path to the store file
+    :return: VertexStore object
+    """
+    store = _attached_stores.get(store_filepath)
+    if store is None:
+        store = VertexStore(store_filepath)
+        _attached_stores[store_filepath] = store
+    return store
+
+
+def vertex_store_pool(store_filepath, processes=None):
+    """
+    Starts worker processes that each attach to a vertex store on start.
+    :param store_filepath: full path to the store file
+    :param processes: number of workers; if None, one per CPU
+    :return: multiprocessing.Pool object
+    """
+    return multiprocessing.Pool(processes, attach_vertex_store,
+                                (store_filepath,))
+
+
+@contextmanager
+def vertex_store_workers(stream_lines, processes, store_dir=None):
+    """
+    Context manager that writes a vertex store and starts worker processes
+    attached to it.  On exit the workers finish their tasks, or are stopped
+    if the block raised an exception, and then the store is removed.
+    :param stream_lines: StreamLine objects for the streams to store
+    :param processes: number of worker processes
+    :param store_dir: directory for the store; if None, the temporary
+        directory
+    :return: StoreWorkers for the store and workers
+    """
+    with shared_vertex_store(stream_lines, store_dir) as store_filepath:
+        pool = vertex_store_pool(store_filepath, processes)
+        try:
+            yield StoreWorkers(pool, store_filepath, processes)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+
+# ********** MAIN **********
+
+def main():
+    logging.error(" Not intended for top-level use.")
+    return 1
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,492 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION: This script measures the performance of the RBA
+# georeferencing scripts, so changes can be compared run to run.
+# Benchmarks:
+#       startup: time to import each script and its modules, and to show
+#           its help, each in a new Python process, and whether arcpy was
+#           loaded along the way
+#       calibrate: per-row, per-stream and per-process costs used by the
+#           execution planner (RBA_planner) to choose between serial,
+#           batched and parallel runs.  Row parsing, distance adjustment,
+#           worker process and pipeline startup are measured on synthetic
+#           data.  If a geodatabase is given, the costs needing arcpy are
+#           measured on its streams: vertex reads, sync point location
+#           (per sync point and per stream vertex), stream geometry
+#           queries, and row inserts into a scratch feature class.  Costs
+#           not measured keep their previous values.  The notes in the
+#           cost model file list the costs measured by this or an earlier
+#           calibration ("measured") and those still at the planner's
+#           default estimates ("estimated").
+#
+# INSTRUCTIONS:
+#       Run the script at the command line. Use "-h" to view the input
+#       arguments.
+#
+#       Input:
+#          --repeats: number of times each measurement is repeated; the
+#              fastest and median times are reported (default 5)
+#          --results_filepath: csv file where results are appended
+#          --calibrate: also measure the planner's costs and write them to
+#              the cost model file
+#          --cost_model_file: cost model json file written by --calibrate
+#              (default RBA_cost_model.json next to the scripts, where the
+#              scripts look for it)
+#          --geodatabase: geodatabase whose streams are used to measure
+#              the stream geometry, sync point and row write costs for
+#              --calibrate (requires arcpy)
+#
+#       Output:
+#          Script returns 0 if it completes successfully, 1 if it does not.
+#          Results are logged to the console, and appended to the
+#          results file if one is given.  --calibrate creates or
+#          overwrites the cost model file.
+#
+#       Exceptions:
+#          Problem locating given files are handled and reported.
+#          Other exceptions are not handled.
+#
+# SOURCE(S): https://docs.python.org/2/library/subprocess.html
+#            https://docs.python.org/2/library/timeit.html
+#            https://docs.python.org/2/library/json.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import csv
+import argparse
+import logging
+import subprocess
+import timeit
+import json
+import platform
+import RBA_georef_util as rgutil
+from RBA_georef_util import arcpy  # imported on first use
+import RBA_parallel_csv as rgcsv
+import RBA_pipeline as rgpipe
+import RBA_planner as rgplan
+import RBA_stream_network as rgnet
+import define_RBA_dist_adj_factors as rgdefine
+import georef_RBA_survey_data as rggeoref
+
+
+# ********** GLOBAL CONSTANTS **********
+
+BENCHMARKED_SCRIPTS = ["define_RBA_dist_adj_factors",
+                       "georef_RBA_survey_data",
+                       "review_RBA_adj_factors"]
+DEFAULT_REPEATS = 5
+RESULTS_HEADINGS = ["Benchmark", "Target", "Min_Seconds", "Median_Seconds",
+                    "Repeats", "Arcpy_Loaded"]
+
+CALIBRATION_ROWS = 20000  # synthetic survey rows for row costs
+CALIBRATION_ROWS_PER_STREAM = 200
+CALIBRATION_SYNC_SPACING = 20  # rows between synthetic sync points
+CALIBRATION_STREAMS = 50  # stream geometries fetched for query costs
+CALIBRATION_SYNC_POINTS = 20  # sync points located on each stream
+CALIBRATION_WRITE_ROWS = 5000  # rows inserted for row write costs
+CALIBRATION_FC_NAME = "RBA_calibration"  # scratch feature class
+
+# Imports a module in a new process, printing whether arcpy was loaded
+IMPORT_COMMAND = "import sys; import {}; " + \
+                 "sys.stdout.write(str('arcpy' in sys.modules))"
+
+#LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = logging.INFO
+
+
+# ********** CLASSES **********
+
+# See RBA_georef_utl
+
+
+# ********** FUNCTIONS **********
+
+def parse_args(argv):
+    """
+    Defines and parses input arguments.
+    :param argv: Input arguments, excluding the script name.
+    :return: Argument values:
+        repeats: number of times each measurement is repeated
+        results_filepath: path to csv file where results are appended, or
+            None
+        calibrate: indicates whether the planner's costs are measured
+        cost_model_filepath: path to cost model file written by calibrate
+        gdb_path: path to geodatabase for stream query costs, or None
+    """
+    parser = argparse.ArgumentParser\
+        (description="Measure performance of the RBA georeferencing scripts.")
+    parser.add_argument("--repeats", dest="repeats", type=int,
+                        help="number of times each measurement is repeated")
+    parser.add_argument("--results_filepath", dest="results_filepath",
+                        type=rgutil.valid_filedir,
+                        help="csv file where results are appended")
+    parser.add_argument("--calibrate", dest="calibrate", action='store_true',
+                        help="measure the costs used to choose the " +
+                             "execution strategy")
+    parser.add_argument("--cost_model_file", dest="cost_model_filepath",
+                        type=rgutil.valid_filedir,
+                        help="cost model file written by --calibrate")
+    parser.add_argument("--geodatabase", dest="gdb_path",
+                        type=rgutil.existing_path,
+                        help="geodatabase whose streams are used to " +
+                             "measure stream query costs")
+    parser.set_defaults(repeats=DEFAULT_REPEATS, results_filepath=None,
+                        calibrate=False,
+                        cost_model_filepath=rgplan.DEFAULT_COST_MODEL_FILEPATH,
+                        gdb_path=None)
+    args = parser.parse_args(argv)
+    return args.repeats, args.results_filepath, args.calibrate, \
+        args.cost_model_filepath, args.gdb_path
+
+
+def time_command(command, repeats):
+    """
+    Runs a command repeatedly in new processes, timing each run.
+    :param command: list of command arguments
+    :param repeats: number of runs
+    :return: tuple of (run times in seconds, sorted; output of the last run)
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    output = ""
+    for i in range(repeats):
+        start = timeit.default_timer()
+        output = subprocess.check_output(command, cwd=script_dir)
+        times.append(timeit.default_timer() - start)
+    return sorted(times), output
+
+
+def benchmark_startup(repeats):
+    """
+    Measures startup cost of each script: importing it (with the modules it
+    imports) and showing its help, each in a new Python process.
+    :param repeats: number of times each measurement is repeated
+    :return: list of result rows, per RESULTS_HEADINGS
+    """
+    results = []
+    for script in BENCHMARKED_SCRIPTS:
+        times, output = time_command([sys.executable, "-c",
+                                      IMPORT_COMMAND.format(script)], repeats)
+        results.append(["import", script, times[0], times[len(times) // 2],
+                        repeats, output.strip() == b"True"])
+        times, output = time_command([sys.executable, script + ".py",
+                                      "--help"], repeats)
+        results.append(["help", script, times[0], times[len(times) // 2],
+                        repeats, ""])
+    # Baseline: a Python process that does nothing
+    times, output = time_command([sys.executable, "-c", "pass"], repeats)
+    results.append(["python", "", times[0], times[len(times) // 2],
+                    repeats, ""])
+    return results
+
+
+def time_function(function, repeats):
+    """
+    Calls a function repeatedly in this process, timing each call.
+    :param function: function taking no arguments
+    :param repeats: number of calls
+    :return: call times in seconds, sorted
+    """
+    times = []
+    for i in range(repeats):
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+    return sorted(times)
+
+
+def synthetic_survey_lines(num_rows):
+    """
+    Makes survey csv lines with the usual columns, for timing row parsing.
+    :param num_rows: number of data rows
+    :return: list of lines: the header, then the data rows
+    """
+    headings = [rgcsv.SURVEY_LLID, rgutil.STREAMNAME, rgutil.TRIB_TO,
+                "Cum_Dist", rgplan.SURVEY_X, "Y", rgutil.XY_NOTE,
+                rgutil.SURVEY_COMMENT] + rgutil.ZERO_FILL_FIELDS
+    lines = [",".join(headings) + "\r\n"]
+    for row_num in range(num_rows):
+        sync_point = row_num % CALIBRATION_SYNC_SPACING == 0
+        lines.append(",".join(
+            ["{}".format(1230000000000 + row_num //
+                         CALIBRATION_ROWS_PER_STREAM),
+             "Example Creek", "\"Example River, North Fork\"",
+             "{:.1f}".format(row_num % CALIBRATION_ROWS_PER_STREAM * 35.5),
+             "-123.456789" if sync_point else "",
+             "45.678901" if sync_point else "", "", ""] +
+            [str(row_num % 7) for field in rgutil.ZERO_FILL_FIELDS]) +
+            "\r\n")
+    return lines
+
+
+def synthetic_adj_factors(num_factors):
+    """
+    Makes a stream's adjustment factors, for timing distance adjustment.
+    :return: list of (begin SyncPoint, end SyncPoint, adj_factor) tuples
+    """
+    sync_points = []
+    for num in range(num_factors + 1):
+        sync_point = rgutil.SyncPoint()
+        sync_point.survey_cum_dist = num * 700.0
+        sync_point.streamline_cum_dist = num * 735.0
+        sync_points.append(sync_point)
+    return [(sync_points[num], sync_points[num + 1], 1.05)
+            for num in range(num_factors)]
+
+
+def fit_line(xs, ys):
+    """
+    Fits y = intercept + slope * x by least squares.
+    :return: tuple of (intercept, slope); slope is 0 if all xs are equal
+    """
+    mean_x = sum(xs) / float(len(xs))
+    mean_y = sum(ys) / float(len(ys))
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return mean_y, 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return mean_y - slope * mean_x, slope
+
+
+def time_sync_points(stream_geoms, repeats):
+    """
+    Times locating sync points on streams, as define_RBA_dist_adj_factors
+    does, with points along each stream offset from it.
+    :param stream_geoms: Polyline geometry objects of streams
+    :param repeats: number of times each stream is timed; the fastest is
+        used
+    :return: list of (vertices, seconds per sync point) for each stream
+    """
+    stream_times = []
+    for stream_geom in stream_geoms:
+        points = []
+        for num in range(CALIBRATION_SYNC_POINTS):
+            point = stream_geom.positionAlongLine\
+                ((num + 0.5) / CALIBRATION_SYNC_POINTS, True).firstPoint
+            points.append((point.X + 10.0, point.Y + 10.0))
+        times = time_function(lambda: [rgdefine.compute_xy_sync_point
+                                       (stream_geom, x, y, 0, "", "", False)
+                                       for x, y in points], repeats)
+        stream_times.append((stream_geom.pointCount,
+                             times[0] / CALIBRATION_SYNC_POINTS))
+    return stream_times
+
+
+def time_row_writes(spatial_reference, repeats):
+    """
+    Times inserting point rows into a scratch feature class, as
+    georef_RBA_survey_data does into the survey data feature class.
+    :param spatial_reference: spatial reference of the points
+    :param repeats: number of times the rows are inserted
+    :return: insert times in seconds, sorted
+    """
+    scratch_fc = os.path.join(arcpy.env.scratchGDB, CALIBRATION_FC_NAME)
+    if arcpy.Exists(scratch_fc):
+        arcpy.Delete_management(scratch_fc)
+    arcpy.CreateFeatureclass_management\
+        (arcpy.env.scratchGDB, CALIBRATION_FC_NAME, "POINT",
+         spatial_reference=spatial_reference)
+    try:
+        fields = [rgcsv.SURVEY_LLID, rgutil.STREAMNAME, "Cum_Dist"]
+        arcpy.AddField_management(scratch_fc, fields[0], "TEXT")
+        arcpy.AddField_management(scratch_fc, fields[1], "TEXT")
+        arcpy.AddField_management(scratch_fc, fields[2], "DOUBLE")
+        rows = [[arcpy.PointGeometry(arcpy.Point(row_num, row_num),
+                                     spatial_reference),
+                 str(1230000000000 + row_num // CALIBRATION_ROWS_PER_STREAM),
+                 "Example Creek", row_num * 35.5]
+                for row_num in range(CALIBRATION_WRITE_ROWS)]
+
+        def insert_rows():
+            with arcpy.da.InsertCursor(scratch_fc,
+                                       ["SHAPE@"] + fields) as cursor:
+                for row in rows:
+                    cursor.insertRow(row)
+
+        return time_function(insert_rows, repeats)
+    finally:
+        arcpy.Delete_management(scratch_fc)
+
+
+def previously_measured(cost_model_filepath):
+    """
+    Reads which costs an earlier calibration measured.
+    :param cost_model_filepath: path of cost model json file written by
+        this script
+    :return: list of cost names; empty if the file does not list them
+    """
+    with open(cost_model_filepath) as cost_model_file:
+        notes = json.load(cost_model_file).get("notes") or {}
+    return [str(name) for name in notes.get("measured", [])]
+
+
+def calibrate_costs(repeats, cost_model, gdb_path=None):
+    """
+    Measures the planner's costs on this machine.
+    :param repeats: number of times each measurement is repeated; the
+        fastest is used
+    :param cost_model: RBA_planner.CostModel whose costs are updated
+    :param gdb_path: geodatabase whose streams are used to measure the
+        stream geometry, sync point and row write costs, or None to leave
+        those costs unchanged
+    :return: list of result rows, per RESULTS_HEADINGS, in seconds per
+        unit of each measured cost
+    """
+    results = []
+
+    def record(name, times, units):
+        cost_model.costs[name] = times[0] / units
+        results.append(["calibrate", name, times[0] / units,
+                        times[len(times) // 2] / units, repeats, ""])
+
+    # A parse worker process imports the csv reader before its first chunk
+    times, output = time_command([sys.executable, "-c",
+                                  IMPORT_COMMAND.format("RBA_parallel_csv")],
+                                 repeats)
+    record("process_start", times, 1)
+
+    lines = synthetic_survey_lines(CALIBRATION_ROWS)
+    record("row_parse", time_function(lambda: list(csv.reader(lines)),
+                                      repeats), CALIBRATION_ROWS)
+
+    adj_factors = synthetic_adj_factors(CALIBRATION_ROWS_PER_STREAM //
+                                        CALIBRATION_SYNC_SPACING)
+    survey_dists = [row_num % CALIBRATION_ROWS_PER_STREAM * 35.5
+                    for row_num in range(CALIBRATION_ROWS)]
+    record("row_compute",
+           time_function(lambda: [rggeoref.adjust_stream_distance
+                                  (survey_dist, adj_factors)
+                                  for survey_dist in survey_dists], repeats),
+           CALIBRATION_ROWS)
+
+    # Starting and joining the pipeline stage threads, with nothing to pass
+    record("pipeline_start",
+           time_function(lambda: rgpipe.run_pipeline([], list, list),
+                         repeats), 1)
+
+    if gdb_path is not None:
+        streams_pathname = rgutil.get_valid_polyline_pathname\
+            (gdb_path, rgutil.STREAMS_FC_NAME)
+        llids = []
+        stream_geoms = []
+        num_vertices = 0
+        with arcpy.da.SearchCursor(streams_pathname,
+                                   [rgutil.LLID, "SHAPE@"]) as cursor:
+            for llid, stream_geom in cursor:
+                if stream_geom is None or str(llid) in llids:
+                    continue
+                llids.append(str(llid))
+                stream_geoms.append(stream_geom)
+                num_vertices += stream_geom.pointCount
+                if len(llids) == CALIBRATION_STREAMS:
+                    break
+        if llids:
+            record("vertex",
+                   time_function(lambda: [rgnet.stream_line_from_geometry
+                                          (llid, stream_geom)
+                                          for llid, stream_geom
+                                          in zip(llids, stream_geoms)],
+                                 repeats), max(1, num_vertices))
+
+            # Time per sync point grows with the vertices of its stream
+            sync_point_secs, sync_vertex_secs = fit_line\
+                (*zip(*time_sync_points(stream_geoms, repeats)))
+            record("sync_point", [max(0.0, sync_point_secs)], 1)
+            record("sync_vertex", [max(0.0, sync_vertex_secs)], 1)
+
+            # Per-stream costs exclude reading the vertices
+            vertex_seconds = num_vertices * cost_model.costs["vertex"]
+            times = time_function(lambda: [rgutil.get_stream_geom
+                                           (streams_pathname, llid)
+                                           for llid in llids], repeats)
+            record("stream_query", [max(0.0, secs - vertex_seconds)
+                                    for secs in times], len(llids))
+            times = time_function(lambda: rgutil.StreamGeometryCache
+                                  (streams_pathname).preload(llids), repeats)
+            record("preload_stream", [max(0.0, secs - vertex_seconds)
+                                      for secs in times], len(llids))
+
+        record("row_write",
+               time_row_writes(rgutil.describe(streams_pathname).
+                               spatialReference, repeats),
+               CALIBRATION_WRITE_ROWS)
+    return results
+
+
+def write_results(results, results_filepath):
+    """
+    Appends benchmark results to a csv file, writing headings first if the
+    file is new.
+    :param results: list of result rows, per RESULTS_HEADINGS
+    :param results_filepath: path to csv file
+    :return: N/A
+    """
+    new_file = not os.path.exists(results_filepath)
+    with open(results_filepath, 'ab') as results_file:
+        results_writer = csv.writer(results_file)
+        if new_file:
+            results_writer.writerow(RESULTS_HEADINGS)
+        results_writer.writerows(results)
+
+
+# ********** MAIN **********
+
+def main(repeats=DEFAULT_REPEATS, results_filepath=None, calibrate=False,
+         cost_model_filepath=rgplan.DEFAULT_COST_MODEL_FILEPATH,
+         gdb_path=None):
+
+    # Initialize
+    logging.basicConfig(level=LOG_LEVEL)
+
+    results = benchmark_startup(repeats)
+    cost_model = None
+    if calibrate:
+        # Start from the previous calibration, if any, so costs not
+        # measured this time are kept
+        cost_model = rgplan.CostModel()
+        measured = []
+        if os.path.exists(cost_model_filepath):
+            cost_model = rgplan.load_cost_model(cost_model_filepath)
+            measured = previously_measured(cost_model_filepath)
+        results += calibrate_costs(repeats, cost_model, gdb_path)
+    for benchmark, target, min_secs, median_secs, runs, arcpy_loaded in \
+            results:
+        logging.info(" {} {}: min {:.3g} s, median {:.3g} s{}".
+                     format(benchmark, target, min_secs, median_secs,
+                            " (arcpy loaded)" if arcpy_loaded is True
+                            else ""))
+    if cost_model is not None:
+        # Costs never measured are still the planner's default estimates
+        measured.extend(target for benchmark, target, min_secs, median_secs,
+                        runs, arcpy_loaded in results
+                        if benchmark == "calibrate" and target not in measured)
+        rgplan.write_cost_model(cost_model, cost_model_filepath,
+                                {"host": platform.node(),
+                                 "python": sys.version.split()[0],
+                                 "rows": CALIBRATION_ROWS,
+                                 "geodatabase": gdb_path,
+                                 "measured": [name for name
+                                              in cost_model.costs
+                                              if name in measured],
+                                 "estimated": [name for name
+                                               in cost_model.costs
+                                               if name not in measured]})
+        logging.info(" cost model saved to {}".format(cost_model_filepath))
+    if results_filepath is not None:
+        write_results(results, results_filepath)
+        logging.info(" results appended to {}".format(results_filepath))
+    return 0
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main(*parse_args(sys.argv[1:])))
@@ -23,16 +23,48 @@
 #              the stream mouth.
 #          survey_data_filepath: full path location of csv file containing
 #              survey data, with x,y coordinates and optional notes added for
-#              some of the pools.
+#              some of the pools.  The file may be gzip or xz compressed.
 #          sdi_filepath: name of csv file where stream distance information
 #              will be written.
 #          --sync_lat_long: indicates whether x,y coordinates in
 #              survey_data_filepath are in Lat/Long (decimal degrees) or in
 #              the coordinates of the stream layer (default)
+#          --parse_workers: number of worker processes used to parse
+#              survey_data_filepath (default chosen by the planner; 1 reads
+#              it serially)
+#          --assign_missing_llid: assign rows with no LLID_num to the
+#              nearest stream, based on their x,y coordinates
+#          --max_snap_dist: maximum distance from x,y coordinates to the
+#              nearest stream for --assign_missing_llid
+#          --geom_cache_mb: memory budget, in megabytes, for stream
+#              geometries cached during the run
+#          --compress_sdi: write sdi_filepath compressed, as gzip or xz
+#              (xz requires lzma; backports.lzma on Python 2)
+#          --shard_dir: shared directory for a sharded run.  The survey
+#              data is split into shards of whole streams, and every
+#              process started with the same shard_dir, on this or another
+#              host, claims and processes shards until all are done; one
+#              then merges the shard results into sdi_filepath.  See
+#              RBA_shards.
+#          --num_shards: number of shards the survey data is split into
+#              (default 16)
+#          --lease_seconds: time after which a shard claimed by a process
+#              that stopped renewing its claim may be reclaimed (default 600)
+#          --strategy: how the run is executed: serial, batched (stream
+#              geometries preloaded in a few large queries) or parallel
+#              (batched, with parse workers); auto (default) chooses the
+#              fastest from a sample of the inputs.  See RBA_planner.
+#          --cost_model: cost model json file for --strategy auto, as
+#              written by benchmark_RBA_georef --calibrate (default
+#              RBA_cost_model.json next to the scripts, if it exists)
+#          --dry_run: check the arguments and log the planned run,
+#              without loading arcpy or reading or writing data
 #
 #       Output:
 #          Script returns 0 if it completes successfully, 1 if it does not.
-#          It creates or overwrites the csv file at sdi_filepath.
+#          It creates or overwrites the csv file at sdi_filepath.  In a
+#          sharded run, only the process that merges the shard results
+#          writes sdi_filepath.
 #
 #          Informational messages are logged to the console.  Debug-level
 #          logging is available.
@@ -57,36 +89,23 @@
 # ********** IMPORT STATEMENTS **********
 import sys
 import os
-import csv
 import argparse
-import arcpy
 from collections import namedtuple
 import logging
 import RBA_georef_util as rgutil
+from RBA_georef_util import arcpy  # imported on first use
+from RBA_georef_util import log  # logger of the calling session
+import RBA_parallel_csv as rgcsv
+import RBA_stream_network as rgnet
+import RBA_shards as rgshard
+import RBA_planner as rgplan
 
 
 # ********** GLOBAL CONSTANTS **********
 
-LLID = "LocationID"
-STREAMNAME = "Stream_Name"
-TRIB_TO = "Trib_To"
-BEGIN_ = "Begin_"
-END_ = "End_"
-X_COORD = "X_coord"
-Y_COORD = "Y_coord"
-XY_NOTE = "XY_Note"
-SURVEY_CUM_DISTANCE = "Survey_Cum_Dist"
-STREAMLINE_CUM_DISTANCE = "Streamline_Cum_Dist"
-SURVEY_COMMENT = "Comment"
-ADJ_FACTOR = "Adj_Factor"
-
-STREAMS_FC_NAME = "streams"
-
-DEFAULT_ADJ_FACTOR = 1.0  # use when adjustment factor cannot be computed
-DEFAULT_BEGIN_DIST = 0  # min cummulative distance for stream survey data
-DEFAULT_END_DIST = 999999  # max cummulative distance for stream survey data
-
-LAT_LONG_CRS = arcpy.SpatialReference(4326)
+# Field names and defaults shared with the other scripts are in
+# RBA_georef_util
+SDI_SHARD_SUFFIX = "_sdi.csv"  # stream distance info written per shard
 
 #LOG_LEVEL = logging.DEBUG
 LOG_LEVEL = logging.INFO
@@ -96,6 +115,15 @@ LOG_LEVEL = logging.INFO
 
 # See RBA_georef_utl
 
+# Options parsed from the command line, named as the parameters of main
+Options = namedtuple('Options',
+                     ['gdb_path', 'survey_data_filename', 'sdi_filepath',
+                      'sync_coords_in_lat_long', 'parse_workers',
+                      'assign_missing_llid', 'max_snap_dist', 'geom_cache_mb',
+                      'sdi_compression', 'shard_dir', 'num_shards',
+                      'lease_seconds', 'strategy', 'cost_model_filepath',
+                      'dry_run'])
+
 
 # ********** FUNCTIONS **********
 
@@ -103,20 +131,33 @@ def parse_args(argv):
     """
     Defines and parses input arguments.
     :param argv: Input arguments, excluding the script name.
-    :return: Argument values:
-        geodatabase: path to geodatabase containing stream polylines
-        csv_data_filepath: path to CSV file containing survey data with
+    :return: Options namedtuple of argument values:
+        gdb_path: path to geodatabase containing stream polylines
+        survey_data_filename: path to CSV file containing survey data with
             x,y coordinates for some pools
         sdi_filepath: path to possibly new CSV file where adjustment factors
             will be written
         sync_coords_in_lat_long: indicates whether x,y coordinates are in
             Lat/Long decimal degrees or in the coordinates of the stream
             layer (default)
+        parse_workers: number of worker processes for parsing the survey
+            data csv file, or None to let the planner choose
+        assign_missing_llid: indicates whether rows with no LLID are
+            assigned to the nearest stream
+        max_snap_dist: maximum snap distance for assigning missing LLIDs
+        geom_cache_mb: memory budget for cached stream geometries
+        sdi_compression: compression for the sdi file, or None
+        shard_dir: shared directory for a sharded run, or None
+        num_shards: number of shards in a sharded run
+        lease_seconds: lease timeout for shards in a sharded run
+        strategy: execution strategy, or auto to let the planner choose
+        cost_model_filepath: cost model file for the planner, or None
+        dry_run: indicates whether the run is only checked and reported
     """
     parser = argparse.ArgumentParser\
         (description="Create a table of distance adjustment factors for survey data.")
     # positional arguments
-    parser.add_argument("geodatabase", type=rgutil.valid_gdb,
+    parser.add_argument("geodatabase", type=rgutil.existing_path,
                         help="full path location of geodatabase containing streams")
     parser.add_argument("survey_data_filepath", type=rgutil.valid_file,
                         help="full path location of csv file containing survey data " +
@@ -126,15 +167,74 @@ def parse_args(argv):
     # optional arguments
     parser.add_argument("--sync_lat_long", dest="sync_coords_in_lat_long",
                         action='store_true')
-    parser.set_defaults(sync_coords_in_lat_long=False)
+    parser.add_argument("--parse_workers", dest="parse_workers", type=int,
+                        help="number of worker processes used to parse " +
+                             "large survey data files")
+    parser.add_argument("--assign_missing_llid", dest="assign_missing_llid",
+                        action='store_true',
+                        help="assign rows with no LLID to the nearest " +
+                             "stream, based on x,y coordinates")
+    parser.add_argument("--max_snap_dist", dest="max_snap_dist", type=float,
+                        help="maximum distance to nearest stream when " +
+                             "assigning missing LLIDs")
+    parser.add_argument("--geom_cache_mb", dest="geom_cache_mb", type=float,
+                        help="memory budget (MB) for cached stream geometries")
+    parser.add_argument("--compress_sdi", dest="sdi_compression",
+                        choices=rgutil.COMPRESSIONS,
+                        help="write stream distance information compressed")
+    parser.add_argument("--shard_dir", dest="shard_dir",
+                        help="shared directory through which processes on " +
+                             "one or more hosts split up the run")
+    parser.add_argument("--num_shards", dest="num_shards", type=int,
+                        help="number of shards in a sharded run")
+    parser.add_argument("--lease_seconds", dest="lease_seconds", type=float,
+                        help="time after which an unrenewed shard claim " +
+                             "expires")
+    parser.add_argument("--strategy", dest="strategy",
+                        choices=rgplan.STRATEGIES,
+                        help="execution strategy; auto chooses from a " +
+                             "sample of the inputs")
+    parser.add_argument("--cost_model", dest="cost_model_filepath",
+                        type=rgutil.valid_file,
+                        help="cost model file for choosing the strategy")
+    parser.add_argument("--dry_run", dest="dry_run", action='store_true',
+                        help="check arguments and report the planned run " +
+                             "without reading or writing data")
+    parser.set_defaults(sync_coords_in_lat_long=False, parse_workers=None,
+                        assign_missing_llid=False,
+                        max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST,
+                        geom_cache_mb=rgutil.DEFAULT_GEOM_CACHE_MB,
+                        sdi_compression=None, shard_dir=None,
+                        num_shards=rgshard.DEFAULT_NUM_SHARDS,
+                        lease_seconds=rgshard.DEFAULT_LEASE_SECONDS,
+                        strategy=rgplan.AUTO, cost_model_filepath=None,
+                        dry_run=False)
     args = parser.parse_args(argv)
-    return args.geodatabase, args.survey_data_filepath, args.sdi_filepath, \
-           args.sync_coords_in_lat_long
-
-
-def build_streamlength_adjustment_factor_dictionary(in_csv_filename,
-                                                    streams_pathname,
-                                                    sync_coords_in_lat_long):
+    if not args.dry_run:
+        # Validate geodatabase contents; a dry run does not load arcpy
+        try:
+            rgutil.valid_gdb(args.geodatabase)
+        except argparse.ArgumentTypeError as err:
+            parser.error(str(err))
+    return Options(gdb_path=args.geodatabase,
+                   survey_data_filename=args.survey_data_filepath,
+                   sdi_filepath=args.sdi_filepath,
+                   sync_coords_in_lat_long=args.sync_coords_in_lat_long,
+                   parse_workers=args.parse_workers,
+                   assign_missing_llid=args.assign_missing_llid,
+                   max_snap_dist=args.max_snap_dist,
+                   geom_cache_mb=args.geom_cache_mb,
+                   sdi_compression=args.sdi_compression,
+                   shard_dir=args.shard_dir, num_shards=args.num_shards,
+                   lease_seconds=args.lease_seconds, strategy=args.strategy,
+                   cost_model_filepath=args.cost_model_filepath,
+                   dry_run=args.dry_run)
+
+
+def build_streamlength_adjustment_factor_dictionary\
+        (in_csv_filename, streams_pathname, sync_coords_in_lat_long,
+         parse_workers=1, stream_index=None,
+         max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST, geom_cache=None):
     """
     Builds dictionary containing adjustment factors for stream segments,
     based on survey cumulative distance vs. stream polyline distance
@@ -148,10 +248,42 @@ def build_streamlength_adjustment_factor_dictionary(in_csv_filename,
     :param sync_coords_in_lat_long: True if XY data in in_csv_filename
         is in lat/long decimal degrees, False if XY data is in same reference
         system as streams_pathname
+    :param parse_workers: number of worker processes used to parse
+        in_csv_filename; 1 reads it serially
+    :param stream_index: StreamSegmentIndex used to assign an LLID to rows
+        with no LLID, from their x,y coordinates; if None, such rows are
+        skipped
+    :param max_snap_dist: maximum distance from x,y coordinates to the
+        stream assigned to a row with no LLID
+    :param geom_cache: StreamGeometryCache through which stream geometries
+        are fetched; if None, a cache with the default budget is used
     :return: dictionary of stream distance adjustment information, keyed on
         stream LLID.  Each value contains a sequence of tuples:
         (begining_SycnPoint, ending_SyncPoint, adjustment_factor)
     """
+    with rgcsv.open_survey_csv(in_csv_filename, parse_workers) \
+            as pts_file_reader:
+        return build_sdi_from_records(pts_file_reader, streams_pathname,
+                                      sync_coords_in_lat_long, stream_index,
+                                      max_snap_dist, geom_cache)
+
+
+def build_sdi_from_records(survey_records, streams_pathname,
+                           sync_coords_in_lat_long, stream_index=None,
+                           max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST,
+                           geom_cache=None):
+    """
+    Builds dictionary containing adjustment factors for stream segments from
+    survey data records already in memory or read by the caller.  See
+    build_streamlength_adjustment_factor_dictionary.
+    :param survey_records: iterable of survey csv records, as lists of
+        strings: the header row, then each data row, sorted by stream
+        location ID (LLID) and cumulative distance
+    :return: dictionary of stream distance adjustment information, keyed on
+        stream LLID; each value is a StreamDistanceInfo object.  A stream's
+        last adjustment factor ends at stream_end_sync_point if no x,y sync
+        point follows its begin point.
+    """
     # We need to create a dictionary covering all reported cumulative distances.
     # However, the input data will contain x,y points for only some of these.
     # In order to ensure the dictionary begin/end points cover the full range,
@@ -161,101 +293,201 @@ def build_streamlength_adjustment_factor_dictionary(in_csv_filename,
     stream_distance_info_dict = {}
     adj_factors = []
     prev_llid = ""
+    run_streamname = run_trib_to = ""
     need_adj_factor = False
     stream_geom = None
     end_sync_point = None
-    with open(in_csv_filename, 'rb') as pts_file:
-        # Read and process each row in csv file as namedtuple
-        pts_file_reader = csv.reader(pts_file)
-        headings = pts_file_reader.next()
-        Row = namedtuple('Row',headings)
-        for r in pts_file_reader:
-            row = Row(*r)
-            new_llid = str(row.LLID_num)
-            if new_llid == "":  # if LLID is not given, log this and continue
-                logging.warning(" No Location ID given for input data: " +
-                                "stream {}, trib to {}, pool {}. Skipping entry".
-                                format(row.STREAM, row.TRIB_TO, row.Pool_num))
+    if geom_cache is None:
+        geom_cache = rgutil.StreamGeometryCache(streams_pathname)
+    if stream_index is not None:
+        streams_spat_ref = rgutil.describe(streams_pathname).spatialReference
+    survey_records = iter(survey_records)
+    # Read and process each row as namedtuple
+    headings = next(survey_records)
+    Row = namedtuple('Row',headings)
+    for r in survey_records:
+        row = Row(*r)
+        new_llid = str(row.LLID_num)
+        if new_llid == "" and stream_index is not None:
+            # Use the nearest stream to the row's x,y coordinates
+            match = rgnet.assign_nearest_llid\
+                (stream_index, row, sync_coords_in_lat_long,
+                 streams_spat_ref, max_snap_dist)
+            if match is not None:
+                new_llid = match.llid
+                row = row._replace(LLID_num=new_llid)
+        if new_llid == "":  # if LLID is not given, log this and continue
+            log.warning(" No Location ID given for input data: " +
+                        "stream {}, trib to {}, pool {}. Skipping entry".
+                        format(row.STREAM, row.TRIB_TO, row.Pool_num))
+        else:
+            log.debug(" read row = {}".format(row))
+            pool_x_coord, pool_y_coord = get_pool_XY_coords(row)
+            pool_cum_dist = int(row.CUM_DIST)
+            xy_note = row.XY_Note
+            survey_comment = row.COMMENT
+            streamname = row.STREAM
+            trib_to = row.TRIB_TO
+
+            if new_llid != prev_llid:
+                # New Stream data
+                if prev_llid != "":
+                    # Wrap up adjustment factor processing for previous stream
+                    if need_adj_factor:
+                        # if we're here, previous end_point was None, so we
+                        # need an entry for the final adjustment factor
+                        adj_factor = compute_adj_factor(begin_sync_point, None)
+                        adj_factors.append((begin_sync_point, None, adj_factor))
+                        need_adj_factor = False
+                    # store all adj_factors for prev_llid
+                    store_stream_adj_factors(stream_distance_info_dict,
+                                             prev_llid, run_streamname,
+                                             run_trib_to, adj_factors)
+                # Reset stream variables for new stream
+                adj_factors = []
+                run_streamname = streamname
+                run_trib_to = trib_to
+
+                # Find geometry object for new stream
+                stream_geom = geom_cache.get(new_llid)
+
+                # Find begin sync point for new stream
+                if (pool_x_coord is None) | (pool_y_coord is None):
+                    begin_sync_point = new_syncpt_using_survey_dist\
+                            (pool_cum_dist, xy_note, survey_comment)
+                else:
+                    begin_sync_point = compute_xy_sync_point\
+                        (stream_geom, pool_x_coord, pool_y_coord,
+                         pool_cum_dist, xy_note, survey_comment,
+                         sync_coords_in_lat_long)
+                prev_llid = new_llid
+                end_sync_point = begin_sync_point  # in case there is only
+                                                   # one pool on this stream
+                need_adj_factor = True
             else:
-                logging.debug(" read row = {}".format(row))
-                pool_x_coord, pool_y_coord = get_pool_XY_coords(row)
-                pool_cum_dist = int(row.CUM_DIST)
-                xy_note = row.XY_Note
-                survey_comment = row.COMMENT
-                streamname = row.STREAM
-                trib_to = row.TRIB_TO
-
-                if new_llid != prev_llid:
-                    # New Stream data
-                    if prev_llid != "":
-                        # Wrap up adjustment factor processing for previous stream
-                        if need_adj_factor:
-                            # if we're here, previous end_point was None, so we
-                            # need an entry for the final adjustment factor
-                            adj_factor = compute_adj_factor(begin_sync_point, None)
-                            adj_factors.append((begin_sync_point, None, adj_factor))
-                            need_adj_factor = False
-                        # store all adj_factors for prev_llid
-                        rgutil.add_adj_factors_to_sdi(stream_distance_info_dict,
-                                                      prev_llid, adj_factors)
-                    # Reset stream variables and initialize dictionary entry
-                    # for new stream
-                    adj_factors = []
-                    stream_distance_info_dict[new_llid] = \
-                        rgutil.new_sdi_object(new_llid, streamname, trib_to,
-                                              adj_factors)
-
-                    # Find geometry object for new stream
-                    stream_geom = rgutil.get_stream_geom(streams_pathname,
-                                                         new_llid)
-
-                    # Find begin sync point for new stream
-                    if (pool_x_coord is None) | (pool_y_coord is None):
-                        begin_sync_point = new_syncpt_using_survey_dist\
-                                (pool_cum_dist, xy_note, survey_comment)
-                    else:
-                        begin_sync_point = compute_xy_sync_point\
-                            (stream_geom, pool_x_coord, pool_y_coord,
-                             pool_cum_dist, xy_note, survey_comment,
-                             sync_coords_in_lat_long)
-                    prev_llid = new_llid
-                    end_sync_point = begin_sync_point  # in case there is only
-                                                       # one pool on this stream
+                # Data for another pool on the same stream
+                if (pool_x_coord is None) | (pool_y_coord is None):
+                    # No xy coord given for this pool
+                    end_sync_point = None
                     need_adj_factor = True
                 else:
-                    # Data for another pool on the same stream
-                    if (pool_x_coord is None) | (pool_y_coord is None):
-                        # No xy coord given for this pool
-                        end_sync_point = None
-                        need_adj_factor = True
-                    else:
-                        end_sync_point = compute_xy_sync_point\
-                            (stream_geom, pool_x_coord, pool_y_coord,
-                             pool_cum_dist, xy_note, survey_comment,
-                             sync_coords_in_lat_long)
-                        # calculate adjustment factor
-                        adj_factor = compute_adj_factor(begin_sync_point,
-                                                        end_sync_point)
-                        # add adjustment factor to list for this stream
-                        adj_factors.append((begin_sync_point, end_sync_point,
-                                            adj_factor))
-                        # set begin sync point for next survey stream segment
-                        begin_sync_point = end_sync_point
-                        need_adj_factor = False  # not needed unless there is
-                                                 # another row of data
-
-        # End of file, no more rows
-        # Tie up processing for last stream
-        if need_adj_factor:
-            adj_factor = compute_adj_factor(begin_sync_point, None)
-            adj_factors.append((begin_sync_point, None, adj_factor))
-        rgutil.add_adj_factors_to_sdi(stream_distance_info_dict, prev_llid,
-                                      adj_factors)
-
-    pts_file.close()
+                    end_sync_point = compute_xy_sync_point\
+                        (stream_geom, pool_x_coord, pool_y_coord,
+                         pool_cum_dist, xy_note, survey_comment,
+                         sync_coords_in_lat_long)
+                    # calculate adjustment factor
+                    adj_factor = compute_adj_factor(begin_sync_point,
+                                                    end_sync_point)
+                    # add adjustment factor to list for this stream
+                    adj_factors.append((begin_sync_point, end_sync_point,
+                                        adj_factor))
+                    # set begin sync point for next survey stream segment
+                    begin_sync_point = end_sync_point
+                    need_adj_factor = False  # not needed unless there is
+                                             # another row of data
+
+    # No more rows
+    # Tie up processing for last stream
+    if need_adj_factor:
+        adj_factor = compute_adj_factor(begin_sync_point, None)
+        adj_factors.append((begin_sync_point, None, adj_factor))
+    if prev_llid != "":
+        store_stream_adj_factors(stream_distance_info_dict, prev_llid,
+                                 run_streamname, run_trib_to, adj_factors)
+
+    # End open adjustment factors as a stream distance info file does, so
+    # the dictionary can be used directly as if read back from the file
+    for sdi in stream_distance_info_dict.values():
+        sdi.adj_factors = [(begin_sync_point,
+                            rgutil.stream_end_sync_point()
+                            if end_sync_point is None else end_sync_point,
+                            adj_factor)
+                           for begin_sync_point, end_sync_point, adj_factor
+                           in sdi.adj_factors]
+
     return stream_distance_info_dict
 
 
+def store_stream_adj_factors(stream_distance_info_dict, llid, streamname,
+                             trib_to, adj_factors):
+    """
+    Stores the adjustment factors of one run of consecutive rows on a
+    stream.  A stream's rows are usually one run, but rows assigned to it
+    by --assign_missing_llid, or rows of the stream in another shard, make
+    further runs; those are merged with the factors already stored.
+    :param stream_distance_info_dict: dictionary of StreamDistanceInfo
+        objects keyed on LLID, modified by this function
+    :param llid: Location ID of the stream
+    :param streamname: stream name from the run's first row
+    :param trib_to: name of the stream this one flows into, from the run's
+        first row
+    :param adj_factors: sequence of (begin SyncPoint, end SyncPoint,
+        adj_factor) tuples for the run
+    :return: N/A
+    """
+    sdi = stream_distance_info_dict.get(llid)
+    if sdi is None:
+        stream_distance_info_dict[llid] = \
+            rgutil.new_sdi_object(llid, streamname, trib_to, adj_factors)
+        return
+    log.debug(" merging another run of rows for {} {}".
+              format(rgutil.LLID, llid))
+    sdi.adj_factors = merge_stream_adj_factors([sdi.adj_factors,
+                                                adj_factors])
+    # Rows assigned a stream may lack its names
+    sdi.name = sdi.name or streamname
+    sdi.trib_to = sdi.trib_to or trib_to
+
+
+def merge_stream_adj_factors(adj_factor_runs):
+    """
+    Combines the adjustment factors developed separately from runs of one
+    stream's rows into the factors all of its rows, sorted by cumulative
+    distance, would give.  Sync points with x,y coordinates are kept from
+    every run; a sync point taken from the survey distance alone is kept
+    only at the start of the stream.  The stream ends with an open
+    adjustment factor if any run does.
+    :param adj_factor_runs: sequences of (begin SyncPoint, end SyncPoint,
+        adj_factor) tuples, one per run.  An open end is None, or, as read
+        from a stream distance info file, a SyncPoint with no coordinates
+        at DEFAULT_END_DIST.
+    :return: list of (begin SyncPoint, end SyncPoint, adj_factor) tuples
+    """
+    first_points = []
+    xy_points = {}
+    open_end = False
+    for adj_factors in adj_factor_runs:
+        if not adj_factors:
+            continue
+        first_points.append(adj_factors[0][0])
+        for begin_sync_point, end_sync_point, adj_factor in adj_factors:
+            for sync_point in (begin_sync_point, end_sync_point):
+                if sync_point is not None and \
+                        sync_point.x_coord is not None:
+                    xy_points.setdefault(sync_point.survey_cum_dist,
+                                         sync_point)
+        end_sync_point = adj_factors[-1][1]
+        if end_sync_point is None or \
+                (end_sync_point.x_coord is None and
+                 end_sync_point.survey_cum_dist == rgutil.DEFAULT_END_DIST):
+            open_end = True
+    if not first_points:
+        return []
+
+    start_point = min(first_points, key=lambda point: point.survey_cum_dist)
+    sync_points = [start_point] + \
+        [xy_points[dist] for dist in sorted(xy_points)
+         if dist > start_point.survey_cum_dist]
+    merged = [(begin_sync_point, end_sync_point,
+               compute_adj_factor(begin_sync_point, end_sync_point))
+              for begin_sync_point, end_sync_point
+              in zip(sync_points, sync_points[1:])]
+    if open_end or not merged:
+        merged.append((sync_points[-1], None,
+                       compute_adj_factor(sync_points[-1], None)))
+    return merged
+
+
 def new_syncpt_using_survey_dist(pool_cum_dist, xy_note, survey_comment):
     """
     Create a new SyncPoint object with both survey and streamline
@@ -275,6 +507,7 @@ def new_syncpt_using_survey_dist(pool_cum_dist, xy_note, survey_comment):
     syncpt.y_coord = None
     syncpt.xy_note = xy_note
     syncpt.survey_comment = survey_comment
+    syncpt.snap_offset = None
     return syncpt
 
 
@@ -296,26 +529,26 @@ def compute_xy_sync_point(stream_geom, in_x_coord, in_y_coord, survey_cum_dist,
     :return: new SyncPoint object with all fields populated, including
         streamline_cum_dist based on stream distance to x and y coordinates
     """
-    logging.debug(" compute_xy_sync_point called " +
-                  "with point ({}, {}) and survey_cum_dist {}".
-                  format(in_x_coord, in_y_coord, survey_cum_dist))
+    log.debug(" compute_xy_sync_point called " +
+              "with point ({}, {}) and survey_cum_dist {}".
+              format(in_x_coord, in_y_coord, survey_cum_dist))
     xy_point = arcpy.Point(in_x_coord, in_y_coord)
     if sync_coords_in_lat_long:
-        xy_pt_geom = arcpy.PointGeometry(xy_point, LAT_LONG_CRS)
+        xy_pt_geom = arcpy.PointGeometry(xy_point, rgutil.lat_long_crs())
         xy_pt_geom = xy_pt_geom.projectAs(stream_geom.spatialReference)
     else:
         xy_pt_geom = arcpy.PointGeometry(xy_point)
         # assume same CRS as streams
-    logging.debug(" xy_pt_geom = ({}, {})".format(xy_pt_geom.firstPoint.X,
-                                                  xy_pt_geom.firstPoint.Y))
+    log.debug(" xy_pt_geom = ({}, {})".format(xy_pt_geom.firstPoint.X,
+                                              xy_pt_geom.firstPoint.Y))
 
     # Make point for coordinates snapped to stream, and get
     # cumulative distance, etc.
     snapped_in_point, streamline_cum_dist, offset_dist, side = \
         stream_geom.queryPointAndDistance(xy_pt_geom)
 
-    logging.debug(" calculated streamline_cum_dist = {}, offset_dist = {}".
-                  format(streamline_cum_dist, offset_dist))
+    log.debug(" calculated streamline_cum_dist = {}, offset_dist = {}".
+              format(streamline_cum_dist, offset_dist))
     syncpt = rgutil.SyncPoint()
     syncpt.survey_cum_dist = survey_cum_dist
     syncpt.streamline_cum_dist = streamline_cum_dist
@@ -323,6 +556,7 @@ def compute_xy_sync_point(stream_geom, in_x_coord, in_y_coord, survey_cum_dist,
     syncpt.y_coord = in_y_coord
     syncpt.xy_note = xy_note
     syncpt.survey_comment = survey_comment
+    syncpt.snap_offset = offset_dist
     return syncpt
 
 
@@ -347,9 +581,9 @@ def compute_adj_factor(begin_sync_point, end_sync_point):
                        begin_sync_point.survey_cum_dist)
     else:
         # estimate adjustment factor for end of stream
-        adj_factor = DEFAULT_ADJ_FACTOR
-    logging.debug(" adjustment factor {} calculated for {}, {}".
-                  format(adj_factor, begin_sync_point, end_sync_point))
+        adj_factor = rgutil.DEFAULT_ADJ_FACTOR
+    log.debug(" adjustment factor {} calculated for {}, {}".
+              format(adj_factor, begin_sync_point, end_sync_point))
     return adj_factor
 
 def get_pool_XY_coords(row):
@@ -374,32 +608,105 @@ def get_pool_XY_coords(row):
 # ********** MAIN **********
 
 def main(gdb_path, survey_data_filename, sdi_filepath,
-         sync_coords_in_lat_long):
+         sync_coords_in_lat_long, parse_workers=None,
+         assign_missing_llid=False,
+         max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST,
+         geom_cache_mb=rgutil.DEFAULT_GEOM_CACHE_MB, sdi_compression=None,
+         shard_dir=None, num_shards=rgshard.DEFAULT_NUM_SHARDS,
+         lease_seconds=rgshard.DEFAULT_LEASE_SECONDS, strategy=rgplan.AUTO,
+         cost_model_filepath=None, dry_run=False):
 
     # Initialize
     logging.basicConfig(level=LOG_LEVEL)
-    arcpy.env.overwriteOutput = True
-    arcpy.env.workspace = gdb_path
-
+    if dry_run:
+        rgutil.log_dry_run([("geodatabase", gdb_path),
+                            ("survey data", survey_data_filename),
+                            ("stream distance info output", sdi_filepath)],
+                           [("sync_lat_long", sync_coords_in_lat_long),
+                            ("parse_workers", parse_workers),
+                            ("assign_missing_llid", assign_missing_llid),
+                            ("max_snap_dist", max_snap_dist),
+                            ("geom_cache_mb", geom_cache_mb),
+                            ("compress_sdi", sdi_compression),
+                            ("shard_dir", shard_dir),
+                            ("num_shards", num_shards),
+                            ("lease_seconds", lease_seconds),
+                            ("strategy", strategy),
+                            ("cost_model", cost_model_filepath)])
+        return 0
     # Get streams feature class path
-    streams_pathname = rgutil.get_valid_polyline_pathname(gdb_path,
-                                                          STREAMS_FC_NAME)
+    streams_pathname = rgutil.get_valid_polyline_pathname\
+        (gdb_path, rgutil.STREAMS_FC_NAME)
+
+    # Index all streams, for assigning LLIDs to rows that have none
+    stream_index = None
+    if assign_missing_llid:
+        stream_index = rgnet.build_stream_segment_index(streams_pathname)
+
+    geom_cache = rgutil.StreamGeometryCache\
+        (streams_pathname, int(geom_cache_mb * 1024 * 1024))
+
+    if shard_dir is not None:
+        # Sharded run: develop adjustment factors for each claimed shard,
+        # then merge the shard csv files, if no other process does.  Rows
+        # assigned a stream by --assign_missing_llid can be in another
+        # shard than the stream's own rows, so a stream's factors from
+        # several shards are merged into one sequence
+        def process_shard(shard_csv_filename, shard_sdi_filepath):
+            shard_info = build_streamlength_adjustment_factor_dictionary\
+                (shard_csv_filename, streams_pathname,
+                 sync_coords_in_lat_long, 1, stream_index, max_snap_dist,
+                 geom_cache)
+            rgutil.write_sdi_to_csv_file(shard_info, shard_sdi_filepath)
+
+        def merge_outputs(shard_sdi_filepaths):
+            merged_info = {}
+            for shard_sdi_filepath in shard_sdi_filepaths:
+                shard_info = rgutil.read_sdi_from_csvfile(shard_sdi_filepath)
+                for llid, sdi in shard_info.items():
+                    store_stream_adj_factors(merged_info, llid, sdi.name,
+                                             sdi.trib_to, sdi.adj_factors)
+            rgutil.write_sdi_to_csv_file(merged_info, sdi_filepath,
+                                         sdi_compression)
+            log.info(" merged adjustment factors for {} streams, saved to {}".
+                     format(len(merged_info), sdi_filepath))
+
+        num_processed, merged = rgshard.run_sharded\
+            (shard_dir, survey_data_filename, process_shard, merge_outputs,
+             SDI_SHARD_SUFFIX, num_shards, parse_workers or 1, lease_seconds)
+        log.info(" processed {} shards{}".
+                 format(num_processed, ", merged results" if merged
+                        else ""))
+        log.info(" {}".format(geom_cache))
+        return 0
+
+    # Choose serial, batched or parallel execution from a sample of the
+    # inputs, unless given
+    plan = rgplan.plan_execution\
+        (rgplan.sample_input_stats(survey_data_filename, streams_pathname),
+         rgplan.load_cost_model(cost_model_filepath), False,
+         geom_cache.max_bytes, strategy, parse_workers)
+    if plan.preload:
+        geom_cache.preload(rgcsv.read_survey_llids(survey_data_filename,
+                                                   plan.parse_workers))
 
     # Build dictionary of stream distance information, including
     # adjustment factors for segments with x,y coordinates
     stream_distance_info = build_streamlength_adjustment_factor_dictionary\
-        (survey_data_filename, streams_pathname, sync_coords_in_lat_long)
+        (survey_data_filename, streams_pathname, sync_coords_in_lat_long,
+         plan.parse_workers, stream_index, max_snap_dist, geom_cache)
+    log.info(" {}".format(geom_cache))
 
     # Write stream distance info to named csv file
     rgutil.write_sdi_to_csv_file(stream_distance_info,
-                                sdi_filepath)
-    logging.info(" developed adjustment factors for {} streams, saved to {}".
-                 format(len(stream_distance_info.keys()),
-                        sdi_filepath))
+                                sdi_filepath, sdi_compression)
+    log.info(" developed adjustment factors for {} streams, saved to {}".
+             format(len(stream_distance_info.keys()),
+                    sdi_filepath))
     return 0
 
 
 # ********** MAIN CHECK **********
 
 if __name__ == '__main__':
-    sys.exit(main(*parse_args(sys.argv[1:])))
+    sys.exit(main(**parse_args(sys.argv[1:])._asdict()))
@@ -21,17 +21,117 @@
 #              the stream mouth.
 #          survey_data_filepath: full path location of csv file containing
 #              survey data, with x,y coordinates and optional notes added for
-#              some of the pools.
+#              some of the pools.  The file may be gzip or xz compressed.
 #          sdi_filepath: name of csv file containing stream distance
-#              information, including possibly modified adjustment factors.
+#              information, including possibly modified adjustment factors
+#              (may be gzip or xz compressed).
 #          survey_data_fc_name: name of feature class where survey data
 #              will be written (within geodatabase)
 #          survey_data_template: file with field definitions to use as
 #              template for survey data feature class
+#          --parse_workers: number of worker processes used to parse
+#              survey_data_filepath (default chosen by the planner; 1 reads
+#              it serially)
+#          --sync_lat_long: indicates whether x,y coordinates in
+#              survey_data_filepath are in Lat/Long (decimal degrees) or in
+#              the coordinates of the stream layer (default)
+#          --assign_missing_llid: assign rows with no LLID_num to the
+#              nearest stream, based on their x,y coordinates
+#          --max_snap_dist: maximum distance from x,y coordinates to the
+#              nearest stream for --assign_missing_llid
+#          --geom_cache_mb: memory budget, in megabytes, for stream
+#              geometries cached during the run
+#          --outlet_dist: add an Outlet_Dist field holding each point's
+#              river distance from the basin outlet, using Trib_To topology
+#          --river_index_cache: file where the stream network index for
+#              --outlet_dist is cached between runs (default: next to the
+#              geodatabase)
+#          --pipeline_queue_size: if greater than 0, csv reading,
+#              georeferencing and feature class writes run in overlapping
+#              stages, with up to this many rows queued between stages; 0
+#              runs them one after another (default chosen by the planner)
+#          --resume: continue an interrupted run, skipping the streams it
+#              finished, as long as the survey data, sdi, template and
+#              streams inputs, and the options deciding the output fields
+#              and values, are unchanged
+#          --journal: progress journal used by --resume (default: next to
+#              the geodatabase)
+#          --uncertainty_samples: if given, add a Pos_Spread field holding
+#              each point's positional spread, from this many Monte Carlo
+#              samples of sync point errors (requires numpy)
+#          --xy_error, --survey_dist_error: standard deviations of the sync
+#              point x,y coordinate and survey distance errors
+#          --uncertainty_seed: random seed, for repeatable spreads
+#          --packed_output: also write the points, sorted along a Hilbert
+#              curve, to this single file with a packed R-tree index, for
+#              fast bounding box queries when reviewing locations
+#          --scenario_sdi: another csv file of stream distance information
+#              to evaluate in the same run; may be repeated.  sdi_filepath is
+#              scenario 1 and these are scenarios 2, 3, ...  The survey data
+#              is read and stream geometries are loaded once for all
+#              scenarios.
+#          --stream_workers: with --uncertainty_samples or --scenario_sdi,
+#              the number of worker processes computing positional spreads
+#              and scenario values, several streams at once (default 1, in
+#              this process).  The workers share one copy of the needed
+#              streams' vertices (see RBA_vertex_store).  Each stream's
+#              errors are then drawn with its own seed, taken in stream
+#              order from --uncertainty_seed, so spreads are repeatable for
+#              any number of workers above 1 but differ from those of a
+#              single process.
+#          --scenario_output: "combined" (default) adds each point's
+#              location under every scenario (Scen<n>_X, Scen<n>_Y) and its
+#              displacement between scenarios (Scen_Mean_Disp and
+#              Scen_Max_Disp from scenario 1, Scen_Pair_Disp between any two
+#              scenarios) to the survey data feature class; "separate" also
+#              writes a feature class <survey_data_fc_name>_scen<n>, with
+#              the survey data fields only, for each scenario after the
+#              first.  --resume and --shard_dir require "combined".
+#          --shard_dir: shared directory for a sharded run.  The survey
+#              data is split into shards of whole streams, and every
+#              process started with the same shard_dir, on this or another
+#              host, claims and georeferences shards until all are done,
+#              each into its own file geodatabase in shard_dir; one then
+#              merges the shard points into the survey data feature class.
+#              See RBA_shards.  --resume does not apply to sharded runs.
+#          --num_shards: number of shards the survey data is split into
+#              (default 16)
+#          --lease_seconds: time after which a shard claimed by a process
+#              that stopped renewing its claim may be reclaimed (default 600)
+#          --pool_index: also write an index of the points by survey and
+#              adjusted distance along each stream, with their OIDs, for
+#              range and nearest-pool queries (see RBA_pool_index)
+#          --pool_index_file: file where the pool index is written
+#              (default: next to the geodatabase)
+#          --reach_lines: also write a line feature class
+#              <survey_data_fc_name>_reaches with each habitat unit's reach
+#              along its stream, from its adjusted distance to the adjusted
+#              distance of its survey distance plus LENGTH, with the same
+#              fields as the points
+#          --tiles: also write a tile pyramid of the points to this SQLite
+#              file (MBTiles layout), clustered at lower zoom levels, for
+#              reviewing locations.  If the file exists, only tiles of
+#              streams whose points changed are regenerated.
+#          --tile_workers: number of worker processes generating tiles
+#              (default 1)
+#          --strategy: how the run is executed: serial, batched (stream
+#              geometries preloaded in a few large queries, stages
+#              overlapping in a pipeline) or parallel (batched, with parse
+#              workers); auto (default) chooses the fastest from a sample
+#              of the inputs.  See RBA_planner.
+#          --cost_model: cost model json file for --strategy auto, as
+#              written by benchmark_RBA_georef --calibrate (default
+#              RBA_cost_model.json next to the scripts, if it exists)
+#          --dry_run: check the arguments and log the planned run,
+#              without loading arcpy or reading or writing data
 #
 #       Output:
 #          Script returns 0 if it completes successfully, 1 if it does not.
-#          It creates or overwrites the survey data feature class.
+#          It creates or overwrites the survey data feature class, or adds
+#          to it when resuming.  Points are committed one stream at a time,
+#          and each committed stream is recorded in the progress journal.
+#          In a sharded run, only the process that merges the shard points
+#          writes the survey data feature class and packed output.
 #
 #          Informational messages are logged to the console.  Debug-level
 #          logging is available.
@@ -50,39 +150,42 @@
 # ********** IMPORT STATEMENTS **********
 import sys
 import os
-import csv
 import argparse
-import arcpy
-from arcpy import env
-from collections import namedtuple
+import itertools
+from collections import namedtuple, deque
 import logging
 import RBA_georef_util as rgutil
+from RBA_georef_util import arcpy  # imported on first use
+from RBA_georef_util import log  # logger of the calling session
+import RBA_parallel_csv as rgcsv
+import RBA_stream_network as rgnet
+import RBA_pipeline as rgpipe
+import RBA_checkpoint as rgckpt
+import RBA_packed_rtree as rgrtree
+import RBA_shards as rgshard
+import RBA_pool_index as rgpidx
+import RBA_tiles as rgtile
+import RBA_planner as rgplan
+# Modules needing numpy, imported on first use by the options needing them
+rgunc = rgutil.LazyModule("RBA_uncertainty")  # --uncertainty_samples
+rgscen = rgutil.LazyModule("RBA_scenarios")  # --scenario_sdi
+rgvtx = rgutil.LazyModule("RBA_vertex_store")  # --stream_workers
 
 
 # ********** GLOBAL CONSTANTS **********
 
-STREAM_FC_LLID = "LocationID"
-
-STREAMNAME = "Stream_Name"
-TRIB_TO = "Trib_To"
-BEGIN_ = "Begin_"
-END_ = "End_"
-X_COORD = "X_coord"
-Y_COORD = "Y_coord"
-XY_NOTE = "XY_Note"
-SURVEY_CUM_DISTANCE = "Survey_Cum_Dist"
-STREAMLINE_CUM_DISTANCE = "Streamline_Cum_Dist"
-SURVEY_COMMENT = "Comment"
-ADJ_FACTOR = "Adj_Factor"
-
-STREAMS_FC_NAME = "streams"
+# Field names and defaults shared with the other scripts are in
+# RBA_georef_util
 EXCLUDED_NEW_FIELD_NAMES = [u'FID', u'OBJECTID', u'Shape']
-
-DEFAULT_ADJ_FACTOR = 1.0  # use when adjustment factor cannot be computed
-DEFAULT_BEGIN_DIST = 0  # min cummulative distance for stream survey data
-DEFAULT_END_DIST = 999999  # max cummulative distance for stream survey data
-
-LAT_LONG_CRS = arcpy.SpatialReference(4326)
+OUTLET_DIST_FIELD = "Outlet_Dist"
+POS_SPREAD_FIELD = "Pos_Spread"
+CUM_DIST_FIELD = "CUM_DIST"  # survey distance field of the survey data
+LENGTH_FIELD = "LENGTH"  # habitat unit length field of the survey data
+POOL_NUM_FIELD = "Pool_num"  # pool number field of the survey data
+REACH_FC_SUFFIX = "_reaches"
+RIVER_INDEX_CACHE_SUFFIX = "_river_index.pkl"
+GDB_SHARD_SUFFIX = ".gdb"  # file geodatabase written per shard
+STREAMS_PENDING_PER_WORKER = 2  # streams queued for each stream worker
 
 #LOG_LEVEL = logging.DEBUG
 LOG_LEVEL = logging.INFO
@@ -92,6 +195,22 @@ LOG_LEVEL = logging.INFO
 
 # See RBA_georef_utl
 
+# Options parsed from the command line, named as the parameters of main
+Options = namedtuple('Options',
+                     ['gdb_path', 'survey_data_filename', 'sdi_filepath',
+                      'survey_data_fc_name', 'survey_data_template',
+                      'parse_workers', 'sync_coords_in_lat_long',
+                      'assign_missing_llid', 'max_snap_dist', 'outlet_dist',
+                      'river_index_cache', 'pipeline_queue_size',
+                      'geom_cache_mb', 'resume', 'journal_filepath',
+                      'error_model', 'packed_filepath',
+                      'scenario_sdi_filepaths', 'scenario_output',
+                      'stream_workers', 'shard_dir',
+                      'num_shards', 'lease_seconds', 'pool_index',
+                      'pool_index_filepath', 'reach_lines', 'tiles_filepath',
+                      'tile_workers', 'strategy', 'cost_model_filepath',
+                      'dry_run'])
+
 
 # ********** FUNCTIONS **********
 
@@ -99,16 +218,55 @@ def parse_args(argv):
     """
     Defines and parses input arguments.
     :param argv: Input arguments, excluding the script name.
-    :return: Argument values:
-        geodatabase: path to geodatabase containing stream polylines
-        csv_data_filepath: path to CSV file containing survey data with x,y coordinates for some pools
+    :return: Options namedtuple of argument values:
+        gdb_path: path to geodatabase containing stream polylines
+        survey_data_filename: path to CSV file containing survey data with
+            x,y coordinates for some pools
         sdi_filepath: path to possibly new CSV file where adjustment factors will be written
         survey_data_fc_name: name of feature class where survey data will be stored (in gdb)
+        survey_data_template: file with field definitions for survey data
+        parse_workers: number of worker processes for parsing the survey
+            data csv file, or None to let the planner choose
+        sync_coords_in_lat_long: indicates whether x,y coordinates are in
+            Lat/Long decimal degrees or in the coordinates of the stream
+            layer (default)
+        assign_missing_llid: indicates whether rows with no LLID are
+            assigned to the nearest stream
+        max_snap_dist: maximum snap distance for assigning missing LLIDs
+        outlet_dist: indicates whether river distance from the basin
+            outlet is added to the survey data
+        river_index_cache: path to cached stream network index, or None
+        pipeline_queue_size: rows queued between overlapping stages, 0
+            to run stages one after another, or None to let the planner
+            choose
+        geom_cache_mb: memory budget for cached stream geometries
+        resume: indicates whether an interrupted run is continued
+        journal_filepath: path to progress journal, or None
+        error_model: RBA_uncertainty.ErrorModel for positional spreads, or
+            None
+        packed_filepath: path to packed point file to write, or None
+        scenario_sdi_filepaths: paths to csv files of stream distance
+            information for scenarios after the first, or None
+        scenario_output: COMBINED or SEPARATE scenario output, or None
+            for the default when scenarios are given
+        stream_workers: number of worker processes computing positional
+            spreads and scenario values
+        shard_dir: shared directory for a sharded run, or None
+        num_shards: number of shards in a sharded run
+        lease_seconds: lease timeout for shards in a sharded run
+        pool_index: indicates whether a pool index is written
+        pool_index_filepath: path to pool index file, or None for default
+        reach_lines: indicates whether habitat unit reach lines are written
+        tiles_filepath: path to tile pyramid file, or None
+        tile_workers: number of worker processes generating tiles
+        strategy: execution strategy, or auto to let the planner choose
+        cost_model_filepath: cost model file for the planner, or None
+        dry_run: indicates whether the run is only checked and reported
     """
     parser = argparse.ArgumentParser\
         (description="Create a table of distance adjustment factors for survey data.")
     # positional arguments
-    parser.add_argument("geodatabase", type=rgutil.valid_gdb,
+    parser.add_argument("geodatabase", type=rgutil.existing_path,
                         help="full path location of geodatabase containing streams")
     parser.add_argument("survey_data_filepath", type=rgutil.valid_file,
                         help="full path location of csv file containing survey data")
@@ -120,14 +278,185 @@ def parse_args(argv):
                              "be stored (within geodatabase)")
     parser.add_argument("survey_data_template", type=rgutil.valid_file,
                         help="file with field definitions to use as template for survey data feature class")
+    # optional arguments
+    parser.add_argument("--parse_workers", dest="parse_workers", type=int,
+                        help="number of worker processes used to parse " +
+                             "large survey data files")
+    parser.add_argument("--sync_lat_long", dest="sync_coords_in_lat_long",
+                        action='store_true')
+    parser.add_argument("--assign_missing_llid", dest="assign_missing_llid",
+                        action='store_true',
+                        help="assign rows with no LLID to the nearest " +
+                             "stream, based on x,y coordinates")
+    parser.add_argument("--max_snap_dist", dest="max_snap_dist", type=float,
+                        help="maximum distance to nearest stream when " +
+                             "assigning missing LLIDs")
+    parser.add_argument("--outlet_dist", dest="outlet_dist",
+                        action='store_true',
+                        help="add river distance from the basin outlet " +
+                             "to each point")
+    parser.add_argument("--river_index_cache", dest="river_index_cache",
+                        type=rgutil.valid_filedir,
+                        help="file where the stream network index is cached")
+    parser.add_argument("--pipeline_queue_size", dest="pipeline_queue_size",
+                        type=int,
+                        help="overlap reading, georeferencing and writing, " +
+                             "queueing up to this many rows between stages")
+    parser.add_argument("--geom_cache_mb", dest="geom_cache_mb", type=float,
+                        help="memory budget (MB) for cached stream geometries")
+    parser.add_argument("--resume", dest="resume", action='store_true',
+                        help="continue an interrupted run, skipping " +
+                             "streams already georeferenced")
+    parser.add_argument("--journal", dest="journal_filepath",
+                        type=rgutil.valid_filedir,
+                        help="file where progress of the run is recorded")
+    parser.add_argument("--uncertainty_samples", dest="uncertainty_samples",
+                        type=int,
+                        help="add positional spread of each point, from " +
+                             "this many samples of sync point errors")
+    parser.add_argument("--xy_error", dest="xy_error", type=float,
+                        help="standard deviation of sync point x and y " +
+                             "coordinate errors")
+    parser.add_argument("--survey_dist_error", dest="survey_dist_error",
+                        type=float,
+                        help="standard deviation of sync point survey " +
+                             "distance errors")
+    parser.add_argument("--uncertainty_seed", dest="uncertainty_seed",
+                        type=int, help="random seed for sync point errors")
+    parser.add_argument("--packed_output", dest="packed_filepath",
+                        type=rgutil.valid_filedir,
+                        help="file where points are also written in " +
+                             "Hilbert order with a packed R-tree index")
+    parser.add_argument("--scenario_sdi", dest="scenario_sdi_filepaths",
+                        type=rgutil.valid_file, action='append',
+                        help="csv file of stream distance information for " +
+                             "another scenario (may be repeated)")
+    parser.add_argument("--scenario_output", dest="scenario_output",
+                        help="combined: add scenario locations to the " +
+                             "survey data; separate: also write a feature " +
+                             "class per scenario")
+    parser.add_argument("--stream_workers", dest="stream_workers", type=int,
+                        help="number of worker processes computing " +
+                             "positional spreads and scenario values")
+    parser.add_argument("--shard_dir", dest="shard_dir",
+                        help="shared directory through which processes on " +
+                             "one or more hosts split up the run")
+    parser.add_argument("--num_shards", dest="num_shards", type=int,
+                        help="number of shards in a sharded run")
+    parser.add_argument("--lease_seconds", dest="lease_seconds", type=float,
+                        help="time after which an unrenewed shard claim " +
+                             "expires")
+    parser.add_argument("--pool_index", dest="pool_index",
+                        action='store_true',
+                        help="also write an index of points by distance " +
+                             "along each stream")
+    parser.add_argument("--pool_index_file", dest="pool_index_filepath",
+                        type=rgutil.valid_filedir,
+                        help="file where the pool index is written")
+    parser.add_argument("--reach_lines", dest="reach_lines",
+                        action='store_true',
+                        help="also write a line for each habitat unit's " +
+                             "reach along its stream")
+    parser.add_argument("--tiles", dest="tiles_filepath",
+                        type=rgutil.valid_filedir,
+                        help="SQLite file where a tile pyramid of the " +
+                             "points is written or updated")
+    parser.add_argument("--tile_workers", dest="tile_workers", type=int,
+                        help="number of worker processes generating tiles")
+    parser.add_argument("--strategy", dest="strategy",
+                        choices=rgplan.STRATEGIES,
+                        help="execution strategy; auto chooses from a " +
+                             "sample of the inputs")
+    parser.add_argument("--cost_model", dest="cost_model_filepath",
+                        type=rgutil.valid_file,
+                        help="cost model file for choosing the strategy")
+    parser.add_argument("--dry_run", dest="dry_run", action='store_true',
+                        help="check arguments and report the planned run " +
+                             "without reading or writing data")
+    parser.set_defaults(parse_workers=None, sync_coords_in_lat_long=False,
+                        assign_missing_llid=False,
+                        max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST,
+                        outlet_dist=False, river_index_cache=None,
+                        pipeline_queue_size=None,
+                        geom_cache_mb=rgutil.DEFAULT_GEOM_CACHE_MB,
+                        resume=False, journal_filepath=None,
+                        uncertainty_samples=0,
+                        xy_error=None, survey_dist_error=None,
+                        uncertainty_seed=None, packed_filepath=None,
+                        scenario_sdi_filepaths=None,
+                        scenario_output=None, stream_workers=1,
+                        shard_dir=None,
+                        num_shards=rgshard.DEFAULT_NUM_SHARDS,
+                        lease_seconds=rgshard.DEFAULT_LEASE_SECONDS,
+                        pool_index=False, pool_index_filepath=None,
+                        reach_lines=False, tiles_filepath=None,
+                        tile_workers=1, strategy=rgplan.AUTO,
+                        cost_model_filepath=None, dry_run=False)
     args = parser.parse_args(argv)
-    return args.geodatabase, args.survey_data_filepath, args.sdi_filepath, \
-           args.survey_data_fc_name, args.survey_data_template
+    if args.scenario_sdi_filepaths and args.scenario_output is not None \
+            and args.scenario_output not in rgscen.SCENARIO_OUTPUTS:
+        parser.error("--scenario_output must be one of {}".
+                     format(", ".join(rgscen.SCENARIO_OUTPUTS)))
+    if args.scenario_sdi_filepaths and \
+            args.scenario_output == rgscen.SEPARATE and \
+            (args.resume or args.shard_dir is not None):
+        parser.error("--resume and --shard_dir require combined " +
+                     "scenario output")
+    if not args.dry_run:
+        # Validate geodatabase contents; a dry run does not load arcpy
+        try:
+            rgutil.valid_gdb(args.geodatabase)
+        except argparse.ArgumentTypeError as err:
+            parser.error(str(err))
+    error_model = None
+    if args.uncertainty_samples > 0:
+        error_model = rgunc.ErrorModel\
+            (args.uncertainty_samples,
+             rgunc.DEFAULT_XY_ERROR if args.xy_error is None
+             else args.xy_error,
+             rgunc.DEFAULT_SURVEY_DIST_ERROR if args.survey_dist_error is None
+             else args.survey_dist_error,
+             args.uncertainty_seed)
+    return Options(gdb_path=args.geodatabase,
+                   survey_data_filename=args.survey_data_filepath,
+                   sdi_filepath=args.sdi_filepath,
+                   survey_data_fc_name=args.survey_data_fc_name,
+                   survey_data_template=args.survey_data_template,
+                   parse_workers=args.parse_workers,
+                   sync_coords_in_lat_long=args.sync_coords_in_lat_long,
+                   assign_missing_llid=args.assign_missing_llid,
+                   max_snap_dist=args.max_snap_dist,
+                   outlet_dist=args.outlet_dist,
+                   river_index_cache=args.river_index_cache,
+                   pipeline_queue_size=args.pipeline_queue_size,
+                   geom_cache_mb=args.geom_cache_mb, resume=args.resume,
+                   journal_filepath=args.journal_filepath,
+                   error_model=error_model,
+                   packed_filepath=args.packed_filepath,
+                   scenario_sdi_filepaths=args.scenario_sdi_filepaths,
+                   scenario_output=args.scenario_output,
+                   stream_workers=args.stream_workers,
+                   shard_dir=args.shard_dir, num_shards=args.num_shards,
+                   lease_seconds=args.lease_seconds,
+                   pool_index=args.pool_index,
+                   pool_index_filepath=args.pool_index_filepath,
+                   reach_lines=args.reach_lines,
+                   tiles_filepath=args.tiles_filepath,
+                   tile_workers=args.tile_workers, strategy=args.strategy,
+                   cost_model_filepath=args.cost_model_filepath,
+                   dry_run=args.dry_run)
 
 
 def georeference_survey_data(survey_data_filename, stream_dist_info_dict,
                              streams_pathname, survey_data_fc,
-                             survey_data_template):
+                             survey_data_template, parse_workers=1,
+                             stream_index=None, sync_coords_in_lat_long=False,
+                             max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST,
+                             river_index=None, pipeline_queue_size=0,
+                             geom_cache=None, journal=None,
+                             completed_groups=(), error_model=None,
+                             scenario_sdi_dicts=None, scenario_fcs=None,
+                             stream_workers=1):
     """
     Creates points in survey_data_fc for rows in survey_data_filename,
     with points located at calculated distances on streams in streams_pathname.
@@ -144,52 +473,494 @@ def georeference_survey_data(survey_data_filename, stream_dist_info_dict,
         added.
     :param survey_data_template: Feature class containing schema for fields
         in survey_data_filename
+    :param parse_workers: number of worker processes used to parse
+        survey_data_filename; 1 reads it serially
+    :param stream_index: StreamSegmentIndex used to assign an LLID to rows
+        with no LLID, from their x,y coordinates; if None, such rows are
+        skipped
+    :param sync_coords_in_lat_long: True if XY data in survey_data_filename
+        is in lat/long decimal degrees, False if XY data is in same reference
+        system as streams_pathname
+    :param max_snap_dist: maximum distance from x,y coordinates to the
+        stream assigned to a row with no LLID
+    :param river_index: RiverDistanceIndex used to populate the
+        OUTLET_DIST_FIELD field of survey_data_fc; if None, the field is not
+        populated
+    :param pipeline_queue_size: if greater than 0, reading, georeferencing
+        and writing run as overlapping stages with this many rows queued
+        between stages; if 0, they run one after another
+    :param geom_cache: StreamGeometryCache through which stream geometries
+        are fetched; if None, a cache with the default budget is used
+    :param journal: RunJournal in which each stream group is recorded once
+        its points are committed; if None, all points are committed together
+    :param completed_groups: stream group numbers already committed by an
+        earlier run; their rows are skipped
+    :param error_model: RBA_uncertainty.ErrorModel used to populate the
+        POS_SPREAD_FIELD field of survey_data_fc; if None, the field is not
+        populated
+    :param scenario_sdi_dicts: stream distance information dictionaries of
+        scenarios after the first, stream_dist_info_dict being the first;
+        if None, only stream_dist_info_dict is used
+    :param scenario_fcs: feature classes to which points for scenarios
+        after the first are added, with survey data fields only; if None,
+        scenario fields are populated in survey_data_fc instead
+    :param stream_workers: if greater than 1 and error_model or
+        scenario_sdi_dicts is given, this many worker processes compute the
+        positional spreads and scenario values, from a vertex store of the
+        streams in stream_dist_info_dict
     :return: N/A; survey_data_fc is update by this function.
     """
+    # List of fields added to survey_data_fc, based on survey_data_template
+    template_fields = survey_template_fields(survey_data_template)
+    insert_fields = [desc_field.name for desc_field in template_fields]
+    num_scenarios = 0
+    if scenario_sdi_dicts and scenario_fcs is None:
+        num_scenarios = len(scenario_sdi_dicts) + 1
+    insert_fields += extra_field_names(river_index is not None, error_model,
+                                       num_scenarios)
+    if geom_cache is None:
+        geom_cache = rgutil.StreamGeometryCache(streams_pathname)
+
+    survey_records = read_survey_records(survey_data_filename, parse_workers)
+    store_workers = None
+
+    def georeference(records):
+        return georeference_survey_records(records, stream_dist_info_dict,
+                                           streams_pathname, template_fields,
+                                           stream_index,
+                                           sync_coords_in_lat_long,
+                                           max_snap_dist, river_index,
+                                           geom_cache, completed_groups,
+                                           error_model, scenario_sdi_dicts,
+                                           store_workers)
+
+    def insert(point_rows):
+        if scenario_fcs is None:
+            insert_point_rows(survey_data_fc, insert_fields, point_rows,
+                              journal)
+        else:
+            insert_scenario_rows(survey_data_fc, scenario_fcs,
+                                 insert_fields, len(template_fields),
+                                 point_rows, rgutil.describe
+                                 (streams_pathname).spatialReference,
+                                 journal)
+
+    def run():
+        if pipeline_queue_size > 0:
+            # Reader and writer threads overlap file I/O with georeferencing
+            rgpipe.run_pipeline(survey_records, georeference, insert,
+                                pipeline_queue_size)
+        else:
+            insert(georeference(survey_records))
+
+    if stream_workers > 1 and (error_model is not None or
+                               scenario_sdi_dicts):
+        # Worker processes compute the stream-wide values, sharing one copy
+        # of the stream vertices
+        with rgvtx.vertex_store_workers(rgvtx.read_needed_stream_lines
+                                        (streams_pathname,
+                                         stream_dist_info_dict),
+                                        stream_workers) as store_workers:
+            run()
+    else:
+        run()
+
+
+def survey_template_fields(survey_data_template):
+    """
+    Lists the survey data fields of the survey data feature class: the
+    fields of survey_data_template, other than its ID and shape fields.
+    :param survey_data_template: file with field definitions for survey data
+    :return: list of arcpy Field objects
+    """
+    return [desc_field for
+            desc_field in rgutil.describe(survey_data_template).fields
+            if desc_field.name not in EXCLUDED_NEW_FIELD_NAMES]
+
+
+def read_survey_records(survey_data_filename, parse_workers=1):
+    """
+    Generates the records of the survey data csv file.
+    :param survey_data_filename: CSV file containing RBA data plus XY sync
+        point fields X, Y, and XY_Note.
+    :param parse_workers: number of worker processes used to parse
+        survey_data_filename; 1 reads it serially
+    :return: generator yielding the header row, then each data row, as lists
+        of strings
+    """
+    with rgcsv.open_survey_csv(survey_data_filename, parse_workers) \
+            as pts_file_reader:
+        for record in pts_file_reader:
+            yield record
+
+
+def insert_point_rows(survey_data_fc, insert_fields, point_rows,
+                      journal=None):
+    """
+    Inserts georeferenced survey data rows into survey_data_fc.
+    :param survey_data_fc: Feature class to which new survey data points are
+        added.
+    :param insert_fields: names of the survey data fields in survey_data_fc
+    :param point_rows: iterable of (group, llid, row) tuples, where row is a
+        point geometry followed by values for insert_fields, and group
+        numbers the runs of consecutive rows on the same stream
+    :param journal: RunJournal; if given, each stream group is inserted with
+        its own cursor, so it is committed when the cursor closes, and then
+        recorded in the journal.  If None, one cursor inserts all rows.
+    :return: N/A; survey_data_fc is updated by this function.
+    """
+    cursor_fields = ["SHAPE@"] + insert_fields
+    if journal is None:
+        # Create InsertCursor for adding new survey data points
+        with arcpy.da.InsertCursor (survey_data_fc, cursor_fields) \
+                as insertCursor:
+            for group, llid, point_row in point_rows:
+                insertCursor.insertRow(point_row)
+        return
+
+    for (group, llid), group_rows in \
+            itertools.groupby(point_rows, key=lambda item: item[:2]):
+        journal.begin_group(group, llid)
+        with arcpy.da.InsertCursor (survey_data_fc, cursor_fields) \
+                as insertCursor:
+            for item in group_rows:
+                insertCursor.insertRow(item[2])
+        journal.complete_group(group, llid)
+
+
+def insert_scenario_rows(survey_data_fc, scenario_fcs, insert_fields,
+                         num_survey_fields, point_rows, spatial_reference,
+                         journal=None):
+    """
+    Inserts georeferenced survey data rows into survey_data_fc, and the
+    same rows located per each later scenario into scenario_fcs.
+    :param survey_data_fc: Feature class to which points for the first
+        scenario are added
+    :param scenario_fcs: Feature classes to which points for the later
+        scenarios are added, with survey data fields only
+    :param insert_fields: names of the fields in survey_data_fc
+    :param num_survey_fields: number of survey data fields, which come
+        first in insert_fields
+    :param point_rows: iterable of (group, llid, row) tuples, where row is a
+        point geometry, values for insert_fields and then scenario values
+        (see RBA_scenarios.scenario_field_names)
+    :param spatial_reference: spatial reference of the points
+    :param journal: RunJournal; if given, each stream group is inserted with
+        its own cursors and then recorded in the journal, as in
+        insert_point_rows
+    :return: N/A; the feature classes are updated by this function.
+    """
+    scenario_start = 1 + len(insert_fields)
+    survey_fields = insert_fields[:num_survey_fields]
+
+    def insert_rows(rows):
+        cursors = [arcpy.da.InsertCursor(survey_data_fc,
+                                         ["SHAPE@"] + insert_fields)]
+        try:
+            for scenario_fc in scenario_fcs:
+                cursors.append(arcpy.da.InsertCursor
+                               (scenario_fc, ["SHAPE@"] + survey_fields))
+            for group, llid, point_row in rows:
+                cursors[0].insertRow(point_row[:scenario_start])
+                survey_values = point_row[1:1 + num_survey_fields]
+                for scenario, cursor in enumerate(cursors[1:], 1):
+                    x, y = point_row[scenario_start + 2 * scenario:
+                                     scenario_start + 2 * scenario + 2]
+                    pt_geom = arcpy.PointGeometry(arcpy.Point(x, y),
+                                                  spatial_reference)
+                    cursor.insertRow([pt_geom] + survey_values)
+        finally:
+            # Deleting the cursors commits their rows
+            del cursors[:]
+
+    if journal is None:
+        insert_rows(point_rows)
+        return
+    for (group, llid), group_rows in \
+            itertools.groupby(point_rows, key=lambda item: item[:2]):
+        journal.begin_group(group, llid)
+        insert_rows(group_rows)
+        journal.complete_group(group, llid)
+
+
+def georeference_survey_records(survey_records, stream_dist_info_dict,
+                                streams_pathname, template_fields,
+                                stream_index=None,
+                                sync_coords_in_lat_long=False,
+                                max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST,
+                                river_index=None, geom_cache=None,
+                                completed_groups=(), error_model=None,
+                                scenario_sdi_dicts=None, store_workers=None):
+    """
+    Georeferences survey data records, locating each at its adjusted
+    distance upstream along its stream.
+    :param survey_records: iterable of survey csv records: the header row,
+        then each data row
+    :param stream_dist_info_dict: Dictionary of stream distance information
+        keyed on stream LLID.
+    :param streams_pathname: stream polyline feature class, containing one
+        polyline per stream, identified by location ID (LLID)
+    :param template_fields: arcpy Field objects for the survey data fields
+        of the survey data feature class, from survey_data_template
+    :param stream_index: StreamSegmentIndex used to assign an LLID to rows
+        with no LLID; if None, such rows are skipped
+    :param sync_coords_in_lat_long: True if XY data is in lat/long decimal
+        degrees, False if XY data is in same reference system as
+        streams_pathname
+    :param max_snap_dist: maximum distance from x,y coordinates to the
+        stream assigned to a row with no LLID
+    :param river_index: RiverDistanceIndex used to add distance from the
+        basin outlet to each row; if None, it is not added
+    :param geom_cache: StreamGeometryCache through which stream geometries
+        are fetched; if None, a cache with the default budget is used
+    :param completed_groups: stream group numbers whose rows are skipped,
+        because an earlier run already committed them
+    :param error_model: RBA_uncertainty.ErrorModel used to add the
+        positional spread of each row; if None, it is not added.  Rows of a
+        stream are then held until the stream ends, so spreads for all of
+        its pools are computed together.
+    :param scenario_sdi_dicts: stream distance information dictionaries of
+        scenarios after the first, stream_dist_info_dict being the first; if
+        given, each row's location under every scenario and displacement
+        statistics are added, computed for all pools of a stream together.
+        A stream missing from a scenario's dictionary uses the first
+        scenario's adjustment factors.
+    :param store_workers: RBA_vertex_store.StoreWorkers whose workers
+        compute the positional spreads and scenario values, each stream's
+        spreads with its own seed; if None, they are computed in this
+        process.  Rows are still yielded in order.
+    :return: generator yielding a tuple (group, llid, row) for each record,
+        where row is a row for the survey data feature class (point geometry
+        followed by field values), and group numbers the runs of
+        consecutive records on the same stream, starting at 1
+    """
     stream_geom = None
+    uncertainty = None
+    stream_scenarios = None
+    stream_task = None  # arguments of stream_values_task for the stream
+    pending_streams = deque()  # streams awaiting values from store_workers
     prev_llid = ""
-    # List of fields added to survey_data_fc, based on survey_data_template
-    insert_fields = [desc_field.name for
-                     desc_field in arcpy.Describe(survey_data_template).fields
-                     if desc_field.name not in EXCLUDED_NEW_FIELD_NAMES]
-    # Create InsertCursor for adding new survey data points
-    with arcpy.da.InsertCursor (survey_data_fc, ["SHAPE@"] + insert_fields) \
-            as insertCursor:
-        with open(survey_data_filename, 'rb') as pts_file:
-            # Read and process each row in csv file as namedtuple
-            pts_file_reader = csv.reader(pts_file)
-            headings = pts_file_reader.next()
-            Row = namedtuple('Row',headings)
-            for r in pts_file_reader:
-                row = Row(*r)
-                logging.debug(" read row = {}".format(row))
-                new_llid = str(row.LLID_num)
-                streamname = str(row.STREAM)
-                trib_to = str(row.TRIB_TO)
-                pool_cum_dist = int(row.CUM_DIST)
-
-                if new_llid == "":  # if LLID is not given, log this and continue
-                    logging.warning(" No Location ID given for input data: " +
-                                    "stream {}, trib to {}, pool {}. Skipping entry".
-                                    format(streamname, trib_to, row.Pool_num))
-                else:
-                    if new_llid != prev_llid:
-                        # New Stream
-                        logging.info(" Georeferencing data for {} trib to {}".
-                                     format(streamname, trib_to))
-                        stream_adj_factors = \
-                            stream_dist_info_dict[new_llid].adj_factors
-                        # get stream geometry object
-                        stream_geom = rgutil.get_stream_geom(streams_pathname,
-                                                             new_llid)
-                        prev_llid = new_llid
-
-                    # Compute adjusted distance for this row
-                    adjusted_distance = \
-                        adjust_stream_distance(pool_cum_dist, stream_adj_factors)
-                    # Georeference the survey data for this row
-                    create_point_upstream(stream_geom, adjusted_distance,
-                                          row, insertCursor)
+    group = 0
+    skipping = False
+    if geom_cache is None:
+        geom_cache = rgutil.StreamGeometryCache(streams_pathname)
+    if stream_index is not None:
+        streams_spat_ref = rgutil.describe(streams_pathname).spatialReference
+    extra_values = []
+    stream_rows = []  # rows of current stream awaiting stream-wide values
+    hold_stream_rows = error_model is not None or bool(scenario_sdi_dicts)
+    if error_model is not None:
+        random_state = rgunc.new_random_state(error_model)
+
+    def finish_stream(stream_rows):
+        # Rows whose stream-wide values are done, once all of a stream's
+        # rows are read
+        if store_workers is None:
+            return complete_stream_rows(stream_rows, uncertainty,
+                                        stream_scenarios)
+        if stream_rows:
+            survey_dists = [survey_dist for item, survey_dist in stream_rows]
+            pending_streams.append((stream_rows,
+                                    store_workers.pool.apply_async
+                                    (stream_values_task,
+                                     stream_task + (survey_dists,))))
+        return complete_pending_streams(pending_streams,
+                                        STREAMS_PENDING_PER_WORKER *
+                                        store_workers.processes)
+
+    survey_records = iter(survey_records)
+    # Read and process each row in csv file as namedtuple
+    headings = next(survey_records)
+    Row = namedtuple('Row',headings)
+    transformer = rgutil.SurveyRowTransformer(template_fields, headings)
+    log.debug(" {}".format(transformer))
+    for r in survey_records:
+        row = Row(*r)
+        log.debug(" read row = {}".format(row))
+        new_llid = str(row.LLID_num)
+        streamname = str(row.STREAM)
+        trib_to = str(row.TRIB_TO)
+        pool_cum_dist = int(row.CUM_DIST)
+
+        if new_llid == "" and stream_index is not None:
+            # Use the nearest stream to the row's x,y coordinates
+            match = rgnet.assign_nearest_llid\
+                (stream_index, row, sync_coords_in_lat_long,
+                 streams_spat_ref, max_snap_dist)
+            if match is None:
+                pass
+            elif match.llid not in stream_dist_info_dict:
+                log.warning(" No stream distance information " +
+                            "for assigned {} {}".
+                            format(rgutil.LLID, match.llid))
+            else:
+                new_llid = match.llid
+                row = row._replace(LLID_num=new_llid)
+
+        if new_llid == "":  # if LLID is not given, log this and continue
+            log.warning(" No Location ID given for input data: " +
+                        "stream {}, trib to {}, pool {}. Skipping entry".
+                        format(streamname, trib_to, row.Pool_num))
+        else:
+            if new_llid != prev_llid:
+                # New Stream
+                for stream_row in finish_stream(stream_rows):
+                    yield stream_row
+                stream_rows = []
+                group += 1
+                prev_llid = new_llid
+                skipping = group in completed_groups
+                if skipping:
+                    log.info(" Skipping data already georeferenced " +
+                             "for {} trib to {}".
+                             format(streamname, trib_to))
+                    continue
+                log.info(" Georeferencing data for {} trib to {}".
+                         format(streamname, trib_to))
+                stream_adj_factors = \
+                    stream_dist_info_dict[new_llid].adj_factors
+                # get stream geometry object
+                stream_geom = geom_cache.get(new_llid)
+                scenario_adj_factors = None
+                if scenario_sdi_dicts:
+                    scenario_adj_factors = \
+                        [stream_adj_factors] + \
+                        [sdi_dict[new_llid].adj_factors
+                         if new_llid in sdi_dict else stream_adj_factors
+                         for sdi_dict in scenario_sdi_dicts]
+                if hold_stream_rows and store_workers is not None:
+                    stream_task = \
+                        (store_workers.store_filepath, new_llid,
+                         stream_adj_factors,
+                         rgunc.stream_error_model(error_model, random_state)
+                         if error_model is not None else None,
+                         scenario_adj_factors)
+                elif hold_stream_rows:
+                    stream_line = rgnet.stream_line_from_geometry\
+                        (new_llid, stream_geom)
+                    if error_model is not None:
+                        uncertainty = rgunc.StreamUncertainty\
+                            (stream_line, stream_adj_factors, error_model,
+                             random_state)
+                    if scenario_adj_factors:
+                        stream_scenarios = rgscen.StreamScenarios\
+                            (stream_line, scenario_adj_factors)
+            elif skipping:
+                continue
+
+            # Compute adjusted distance for this row
+            adjusted_distance = \
+                adjust_stream_distance(pool_cum_dist, stream_adj_factors)
+            if river_index is not None:
+                extra_values = [river_index.distance_from_outlet
+                                (new_llid, adjusted_distance)]
+            # Georeference the survey data for this row
+            point_row = create_point_upstream(stream_geom, adjusted_distance,
+                                              row, transformer, extra_values)
+            if not hold_stream_rows:
+                yield group, new_llid, point_row
+            else:
+                stream_rows.append(((group, new_llid, point_row),
+                                    pool_cum_dist))
+
+    for stream_row in finish_stream(stream_rows):
+        yield stream_row
+    for stream_row in complete_pending_streams(pending_streams):
+        yield stream_row
+
+
+def complete_stream_rows(stream_rows, uncertainty=None,
+                         stream_scenarios=None):
+    """
+    Appends the values computed for all rows of a stream together to each
+    row: the positional spread of each pool, then its scenario values.
+    :param stream_rows: list of ((group, llid, row), survey distance)
+        tuples for one stream
+    :param uncertainty: StreamUncertainty for the stream, or None
+    :param stream_scenarios: StreamScenarios for the stream, or None
+    :return: list of (group, llid, row) tuples
+    """
+    if not stream_rows:
+        return []
+    survey_dists = [survey_dist for item, survey_dist in stream_rows]
+    for (item, survey_dist), row_values in \
+            zip(stream_rows, stream_values(survey_dists, uncertainty,
+                                           stream_scenarios)):
+        item[2].extend(row_values)
+    return [item for item, survey_dist in stream_rows]
+
+
+def stream_values(survey_dists, uncertainty=None, stream_scenarios=None):
+    """
+    Computes the values of the pools of a stream that are computed for all
+    of them together.
+    :param survey_dists: survey distances of the pools
+    :param uncertainty: StreamUncertainty for the stream, or None
+    :param stream_scenarios: StreamScenarios for the stream, or None
+    :return: list with, for each pool, a list of its positional spread,
+        then its scenario values
+    """
+    values = [[] for survey_dist in survey_dists]
+    if uncertainty is not None:
+        spreads = uncertainty.positional_spread(survey_dists)
+        for row_values, spread in zip(values, spreads):
+            row_values.append(float(spread))
+    if stream_scenarios is not None:
+        scenario_values = stream_scenarios.scenario_values(survey_dists)
+        for row_values, pool_values in zip(values, scenario_values):
+            row_values.extend(float(value) for value in pool_values)
+    return values
+
+
+def stream_values_task(store_filepath, llid, stream_adj_factors,
+                       error_model, scenario_adj_factors, survey_dists):
+    """
+    Computes stream_values in a worker process started by
+    RBA_vertex_store.vertex_store_workers, on the stream's vertices in the
+    shared vertex store.
+    :param store_filepath: full path to the vertex store
+    :param llid: Location ID for stream
+    :param stream_adj_factors: adjustment factors for the stream
+    :param error_model: RBA_uncertainty.ErrorModel for the stream, with its
+        own seed, or None
+    :param scenario_adj_factors: list of the stream's adjustment factors
+        under each scenario, or None
+    :param survey_dists: survey distances of the pools
+    :return: list of values for each pool, as for stream_values
+    """
+    stream_line = rgvtx.attach_vertex_store(store_filepath).stream_line(llid)
+    uncertainty = None
+    stream_scenarios = None
+    if error_model is not None:
+        uncertainty = rgunc.StreamUncertainty\
+            (stream_line, stream_adj_factors, error_model,
+             rgunc.new_random_state(error_model))
+    if scenario_adj_factors:
+        stream_scenarios = rgscen.StreamScenarios(stream_line,
+                                                  scenario_adj_factors)
+    return stream_values(survey_dists, uncertainty, stream_scenarios)
+
+
+def complete_pending_streams(pending_streams, max_pending=0):
+    """
+    Appends values computed by worker processes to the rows of streams, in
+    the order the streams were queued, until no more than max_pending
+    streams are left waiting.
+    :param pending_streams: deque of (stream_rows, AsyncResult) tuples,
+        where stream_rows is as for complete_stream_rows and the result is
+        that of stream_values_task; completed streams are removed
+    :param max_pending: number of streams that may be left waiting
+    :return: list of (group, llid, row) tuples
+    """
+    completed = []
+    while len(pending_streams) > max_pending:
+        stream_rows, result = pending_streams.popleft()
+        for (item, survey_dist), row_values in zip(stream_rows,
+                                                   result.get()):
+            item[2].extend(row_values)
+            completed.append(item)
+    return completed
+
 
 def adjust_stream_distance(survey_dist, stream_adj_factors):
     """
@@ -218,89 +989,524 @@ def adjust_stream_distance(survey_dist, stream_adj_factors):
             break
     new_dist = begin_streamline_pt_dist + \
                ((survey_dist - begin_sync_pt_dist) * adj_factor)
-    logging.debug(" for survey_dist {}, ".format(survey_dist) +
-                  "computed adjusted distance as " +
-                  " {} + ({} - {}) * {}, yielding {}".
-                  format(begin_streamline_pt_dist, survey_dist,
-                         begin_sync_pt_dist, adj_factor, new_dist))
+    log.debug(" for survey_dist {}, ".format(survey_dist) +
+              "computed adjusted distance as " +
+              " {} + ({} - {}) * {}, yielding {}".
+              format(begin_streamline_pt_dist, survey_dist,
+                     begin_sync_pt_dist, adj_factor, new_dist))
     return new_dist
 
 
-def create_point_upstream(line_geom, distance, data_row, insertCursor):
+def applicable_adj_factor(survey_dist, stream_adj_factors):
+    """
+    Finds the adjustment factor adjust_stream_distance applies to
+    survey_dist.
+    :param survey_dist: input survey distance, in feet
+    :param stream_adj_factors: sequence of tuples with adjustment factors
+        for this stream, as for adjust_stream_distance
+    :return: adjustment factor, or DEFAULT_ADJ_FACTOR if no segment of the
+        stream includes survey_dist
+    """
+    for begin_sync_pt, end_sync_pt, adj_factor in stream_adj_factors:
+        if begin_sync_pt.survey_cum_dist <= survey_dist <= \
+                end_sync_pt.survey_cum_dist:
+            return adj_factor
+    return rgutil.DEFAULT_ADJ_FACTOR
+
+
+def create_point_upstream(line_geom, distance, data_row, transformer,
+                          extra_values=()):
     """
     Creates a new Point geometry object, located at the given distance
-    upstream along line_geom. Inserts a row for this point, with fields
-    from data_row.  Fields in data_row are assumed to contain RBA data
-    plus XY sync point fields in the following order:
-    ENTRY, YEAR, DATE, BASIN, TRIB_TO, STREAM, LLID_num, s_GUID,
-    Channel_Type, Pool_num, s_Lineage, RAND, TYPE, LENGTH, WIDTH, VIS, COMP,
-    DIST, CUM_DIST, COHO, Zero_plus, STHD, CUT, CHIN, RES_RB, CUL, KNOT, LONG,
-    BEAVER_DAMS, Num_BEAVER_DAMS, GRAVEL_COUNT, COMMENT, XY_Text, X, Y, XY_Note
-    Column numbers corresponding to these are hardcoded in this function.
+    upstream along line_geom. Returns a row for this point, with fields
+    from data_row converted by transformer.
     :param line_geom: Polyline Geometry object for stream
     :param distance: Distance from mouth of stream to locate new point
-    :param data_row: namedtuple containing fields listed above
-    :param insertCursor: cursor for inserting new Point Geometry
-    :return: N/A, insertCursor is updated as a result of this function.
+    :param data_row: namedtuple containing the survey data csv fields
+    :param transformer: SurveyRowTransformer built from the survey data
+        template fields and the csv header
+    :param extra_values: values for fields following the survey data
+        fields in the output feature class, e.g. OUTLET_DIST_FIELD
+    :return: row for an InsertCursor: the new Point Geometry, followed by
+        the survey data field values and extra_values
     """
 
     # Create new point at given distance along line_geom
     pt_geom = line_geom.positionAlongLine(distance)
 
-    # Prepare data fields for use with insertCursor.
+    # Row for new point geometry and fields
+    point_row = transformer.transform(data_row, pt_geom, extra_values)
+    log.debug(" point_row= {}".format(point_row))
+    return point_row
 
-    # Remove sync_point xy fields, retaining original survey data
-    data_row_survey_fields = list(data_row)[:-5]
-    data_row_survey_fields.append(data_row.COMMENT)
 
-    # Change blank fish counts to 0 (columms 19:24)
-    for i in range(19, 25):
-        if data_row_survey_fields[i] == '':
-            data_row_survey_fields[i] = '0'
+def extra_field_names(outlet_dist=False, error_model=None, num_scenarios=0):
+    """
+    Names the fields that follow the survey data fields in the survey data
+    feature class, in order; all hold doubles.
+    :param outlet_dist: if True, includes OUTLET_DIST_FIELD
+    :param error_model: if not None, includes POS_SPREAD_FIELD
+    :param num_scenarios: if greater than 0, includes the scenario fields
+        for this many scenarios
+    :return: list of field names
+    """
+    names = []
+    if outlet_dist:
+        names.append(OUTLET_DIST_FIELD)
+    if error_model is not None:
+        names.append(POS_SPREAD_FIELD)
+    if num_scenarios > 0:
+        names += rgscen.scenario_field_names(num_scenarios)
+    return names
 
-    # Limit comments (last column) to 254 chars.  Note this
-    # limitation can be removed by using a fileGDB template
-    # for the fields, instead of a shapefile.
-    comment = data_row_survey_fields[-1]
-    if len(comment) > 254:
-        data_row_survey_fields[-1] = comment[:252] + '..'
-    logging.debug(" data_row_survey_fields= {}".format(data_row_survey_fields))
 
-    # Add row for new point geometry and fields to insertCursor
-    insertCursor.insertRow([pt_geom] + list(data_row_survey_fields))
+def create_survey_data_fc(gdb_path, survey_data_fc_name, survey_data_template,
+                          spatial_reference, extra_fields=(),
+                          geometry_type="POINT"):
+    """
+    Creates the survey data feature class, replacing any existing one, with
+    the fields of survey_data_template followed by any extra fields.
+    :param gdb_path: geodatabase where the feature class is created
+    :param survey_data_fc_name: name of feature class
+    :param survey_data_template: file with field definitions for survey data
+    :param spatial_reference: spatial reference of the streams
+    :param extra_fields: names of double fields added after the survey data
+        fields (see extra_field_names)
+    :param geometry_type: "POINT", or "POLYLINE" for habitat unit reaches
+    :return: path of new feature class
+    """
+    survey_data_fc = os.path.join(gdb_path, survey_data_fc_name)
+    if arcpy.Exists(survey_data_fc):
+        arcpy.Delete_management(survey_data_fc)
+    arcpy.CreateFeatureclass_management(gdb_path, survey_data_fc_name,
+                                        geometry_type, survey_data_template,
+                                        spatial_reference=spatial_reference)
+    for field_name in extra_fields:
+        arcpy.AddField_management(survey_data_fc, field_name, "DOUBLE")
+    return survey_data_fc
+
+
+def create_shard_gdb(shard_gdb_path):
+    """
+    Creates a file geodatabase for a shard's points, replacing one left
+    partially written by a worker that stopped.
+    :param shard_gdb_path: full path of file geodatabase
+    :return: N/A
+    """
+    if arcpy.Exists(shard_gdb_path):
+        arcpy.Delete_management(shard_gdb_path)
+    arcpy.CreateFileGDB_management(os.path.dirname(shard_gdb_path),
+                                   os.path.basename(shard_gdb_path))
+
+
+def write_packed_output(survey_data_fc, packed_filepath, spatial_reference):
+    """
+    Writes the points of survey_data_fc to a packed point file, sorted along
+    a Hilbert curve, with a packed R-tree index.
+    :param survey_data_fc: survey data point feature class
+    :param packed_filepath: path of packed point file to write
+    :param spatial_reference: spatial reference of survey_data_fc
+    :return: N/A
+    """
+    field_names = [field.name for field in arcpy.ListFields(survey_data_fc)
+                   if field.type not in ("OID", "Geometry")]
+    with arcpy.da.SearchCursor(survey_data_fc, ["SHAPE@XY"] + field_names) \
+            as cursor:
+        points = [(row[0][0], row[0][1], row[1:]) for row in cursor]
+    rgrtree.write_packed_points(packed_filepath, field_names, points,
+                                spatial_reference=
+                                spatial_reference.exportToString())
+
+
+def write_pool_index_output(survey_data_fc, stream_dist_info_dict,
+                            index_filepath):
+    """
+    Writes an index of the points of survey_data_fc by survey distance and
+    adjusted distance along each stream.  Adjusted distances are recomputed
+    from the stream distance information, so the index covers every point
+    of the feature class, including those of resumed and sharded runs.
+    :param survey_data_fc: survey data point feature class
+    :param stream_dist_info_dict: Dictionary of stream distance information
+        keyed on stream LLID, used to georeference the points
+    :param index_filepath: path of pool index file to write
+    :return: N/A
+    """
+    def indexed_pools():
+        with arcpy.da.SearchCursor(survey_data_fc,
+                                   ["OID@", rgcsv.SURVEY_LLID,
+                                    CUM_DIST_FIELD]) as cursor:
+            for oid, llid, survey_dist in cursor:
+                llid = str(llid)
+                if llid not in stream_dist_info_dict or survey_dist is None:
+                    continue
+                yield llid, survey_dist, adjust_stream_distance\
+                    (survey_dist,
+                     stream_dist_info_dict[llid].adj_factors), oid
+
+    rgpidx.write_pool_index(index_filepath, indexed_pools(), survey_data_fc)
+
+
+def write_reach_lines(survey_data_fc, reach_fc, stream_dist_info_dict,
+                      geom_cache, spatial_reference):
+    """
+    Writes a line for each point of survey_data_fc along its stream, over
+    the habitat unit's reach: from its adjusted distance to the adjusted
+    distance of its survey distance plus LENGTH, so the length is scaled
+    by the adjustment factors.  Points are read one stream at a time, and
+    each stream's vertices are converted once, so each line costs a binary
+    search of the stream's cumulative distances rather than a geometry
+    operation.
+    :param survey_data_fc: survey data point feature class
+    :param reach_fc: line feature class with the fields of survey_data_fc
+    :param stream_dist_info_dict: Dictionary of stream distance information
+        keyed on stream LLID, used to georeference the points
+    :param geom_cache: StreamGeometryCache through which stream geometries
+        are fetched
+    :param spatial_reference: spatial reference of the streams
+    :return: N/A; reach_fc is updated by this function.
+    """
+    field_names = [field.name for field in arcpy.ListFields(survey_data_fc)
+                   if field.type not in ("OID", "Geometry")]
+    if LENGTH_FIELD not in field_names:
+        log.error(" {} has no {} field; no reach lines written".
+                  format(survey_data_fc, LENGTH_FIELD))
+        return
+    llid_pos = field_names.index(rgcsv.SURVEY_LLID)
+    dist_pos = field_names.index(CUM_DIST_FIELD)
+    length_pos = field_names.index(LENGTH_FIELD)
+    stream_line = None
+    num_lines = 0
+    num_skipped = 0
+    with arcpy.da.SearchCursor(survey_data_fc, field_names,
+                               sql_clause=(None, "ORDER BY {}".
+                                           format(rgcsv.SURVEY_LLID))) \
+            as search_cursor, \
+            arcpy.da.InsertCursor(reach_fc, ["SHAPE@"] + field_names) \
+            as insert_cursor:
+        for row in search_cursor:
+            llid = str(row[llid_pos])
+            survey_dist = row[dist_pos]
+            length = row[length_pos]
+            if llid not in stream_dist_info_dict or survey_dist is None or \
+                    not length or length <= 0:
+                num_skipped += 1
+                continue
+            if stream_line is None or stream_line.llid != llid:
+                stream_line = rgnet.stream_line_from_geometry\
+                    (llid, geom_cache.get(llid))
+            adj_factors = stream_dist_info_dict[llid].adj_factors
+            parts = stream_line.sub_line\
+                (adjust_stream_distance(survey_dist, adj_factors),
+                 adjust_stream_distance(survey_dist + length, adj_factors))
+            if not parts:
+                num_skipped += 1
+                continue
+            line_geom = arcpy.Polyline\
+                (arcpy.Array([arcpy.Array([arcpy.Point(x, y)
+                                           for x, y in part])
+                              for part in parts]), spatial_reference)
+            insert_cursor.insertRow([line_geom] + list(row))
+            num_lines += 1
+    log.info(" wrote {} reach lines to {}; {} points had no reach".
+             format(num_lines, reach_fc, num_skipped))
+
+
+def write_tile_output(survey_data_fc, stream_dist_info_dict, tiles_filepath,
+                      tile_workers=1):
+    """
+    Writes or updates the tile pyramid of the points of survey_data_fc,
+    with each point's LLID, pool number and adjustment factor.
+    :param survey_data_fc: survey data point feature class
+    :param stream_dist_info_dict: Dictionary of stream distance information
+        keyed on stream LLID, used to georeference the points
+    :param tiles_filepath: path of SQLite tiles file to write or update
+    :param tile_workers: number of worker processes generating tiles
+    :return: N/A
+    """
+    field_names = [field.name for field in arcpy.ListFields(survey_data_fc)]
+    pool_num_field = POOL_NUM_FIELD if POOL_NUM_FIELD in field_names \
+        else "OID@"
+    points = []
+    with arcpy.da.SearchCursor(survey_data_fc,
+                               ["SHAPE@XY", rgcsv.SURVEY_LLID,
+                                CUM_DIST_FIELD, pool_num_field],
+                               spatial_reference=rgutil.lat_long_crs()) \
+            as cursor:
+        for (lon, lat), llid, survey_dist, pool_num in cursor:
+            llid = str(llid)
+            adj_factor = None
+            if llid in stream_dist_info_dict and survey_dist is not None:
+                adj_factor = applicable_adj_factor\
+                    (survey_dist, stream_dist_info_dict[llid].adj_factors)
+            points.append(rgtile.TilePoint(llid, lon, lat, pool_num,
+                                           adj_factor))
+    rgtile.write_tile_pyramid(tiles_filepath, points, workers=tile_workers,
+                              name=os.path.basename(survey_data_fc))
 
 
 # ********** MAIN **********
 
 def main(gdb_path, survey_data_filename, sdi_filepath,
-         survey_data_fc_name, survey_data_template):
+         survey_data_fc_name, survey_data_template, parse_workers=None,
+         sync_coords_in_lat_long=False, assign_missing_llid=False,
+         max_snap_dist=rgnet.DEFAULT_MAX_SNAP_DIST, outlet_dist=False,
+         river_index_cache=None, pipeline_queue_size=None,
+         geom_cache_mb=rgutil.DEFAULT_GEOM_CACHE_MB, resume=False,
+         journal_filepath=None, error_model=None, packed_filepath=None,
+         scenario_sdi_filepaths=None, scenario_output=None,
+         stream_workers=1, shard_dir=None,
+         num_shards=rgshard.DEFAULT_NUM_SHARDS,
+         lease_seconds=rgshard.DEFAULT_LEASE_SECONDS, pool_index=False,
+         pool_index_filepath=None, reach_lines=False, tiles_filepath=None,
+         tile_workers=1, strategy=rgplan.AUTO, cost_model_filepath=None,
+         dry_run=False):
 
     # Initialize
     logging.basicConfig(level=LOG_LEVEL)
-    arcpy.env.overwriteOutput = True
-    arcpy.env.workspace = gdb_path
-
+    if dry_run:
+        rgutil.log_dry_run([("geodatabase", gdb_path),
+                            ("survey data", survey_data_filename),
+                            ("stream distance info", sdi_filepath),
+                            ("survey data template", survey_data_template)],
+                           [("survey_data_fc_name", survey_data_fc_name),
+                            ("parse_workers", parse_workers),
+                            ("sync_lat_long", sync_coords_in_lat_long),
+                            ("assign_missing_llid", assign_missing_llid),
+                            ("max_snap_dist", max_snap_dist),
+                            ("outlet_dist", outlet_dist),
+                            ("pipeline_queue_size", pipeline_queue_size),
+                            ("geom_cache_mb", geom_cache_mb),
+                            ("resume", resume),
+                            ("uncertainty", error_model),
+                            ("packed_output", packed_filepath),
+                            ("scenario_sdi", scenario_sdi_filepaths),
+                            ("scenario_output", scenario_output),
+                            ("stream_workers", stream_workers),
+                            ("shard_dir", shard_dir),
+                            ("num_shards", num_shards),
+                            ("lease_seconds", lease_seconds),
+                            ("pool_index", pool_index),
+                            ("pool_index_file", pool_index_filepath),
+                            ("reach_lines", reach_lines),
+                            ("tiles", tiles_filepath),
+                            ("tile_workers", tile_workers),
+                            ("strategy", strategy),
+                            ("cost_model", cost_model_filepath)])
+        return 0
     # Get streams feature class
     streams_pathname = rgutil.get_valid_polyline_pathname\
-        (gdb_path, STREAMS_FC_NAME)
-    streams_spat_ref = arcpy.Describe(streams_pathname).SpatialReference
-
-    # Create new feature class for survey data
-    if arcpy.Exists(survey_data_fc_name):
-        arcpy.Delete_management(survey_data_fc_name)
-    survey_data_fc = arcpy.CreateFeatureclass_management\
-        (gdb_path, survey_data_fc_name, "POINT",
-         survey_data_template,
-         spatial_reference=streams_spat_ref)
+        (gdb_path, rgutil.STREAMS_FC_NAME)
+    streams_spat_ref = rgutil.describe(streams_pathname).spatialReference
 
     # Populate dictionary of stream distance adjustment factors
     stream_dist_info_dict = rgutil.read_sdi_from_csvfile(sdi_filepath)
-    logging.debug(" stream_dist_info_dict = {}".format(stream_dist_info_dict))
+    log.debug(" stream_dist_info_dict = {}".format(stream_dist_info_dict))
+
+    # Stream distance information of other scenarios
+    scenario_sdi_filepaths = scenario_sdi_filepaths or []
+    scenario_sdi_dicts = [rgutil.read_sdi_from_csvfile(scenario_sdi_filepath)
+                          for scenario_sdi_filepath in scenario_sdi_filepaths]
+    num_scenarios = 0
+    if scenario_sdi_dicts:
+        scenario_output = scenario_output or rgscen.COMBINED
+        log.info(" evaluating {} scenarios, {} output".
+                 format(len(scenario_sdi_dicts) + 1, scenario_output))
+        if scenario_output == rgscen.COMBINED:
+            num_scenarios = len(scenario_sdi_dicts) + 1
+
+    # Index all streams, for assigning LLIDs to rows that have none
+    stream_index = None
+    if assign_missing_llid:
+        stream_index = rgnet.build_stream_segment_index(streams_pathname)
+
+    # Load or build stream network index for distance from basin outlet
+    river_index = None
+    if outlet_dist:
+        if river_index_cache is None:
+            river_index_cache = os.path.splitext(gdb_path)[0] + \
+                RIVER_INDEX_CACHE_SUFFIX
+        stream_names = dict((llid, (sdi.name, sdi.trib_to)) for llid, sdi
+                            in stream_dist_info_dict.items())
+        river_index = rgnet.load_or_build_river_distance_index\
+            (streams_pathname, river_index_cache, stream_names)
+
+    # Positional spread from sync point errors
+    if error_model is not None:
+        log.info(" computing positional spread using {}".
+                 format(error_model))
+
+    geom_cache = rgutil.StreamGeometryCache\
+        (streams_pathname, int(geom_cache_mb * 1024 * 1024))
+    if pool_index and pool_index_filepath is None:
+        pool_index_filepath = rgpidx.default_pool_index_filepath\
+            (gdb_path, survey_data_fc_name)
+    extra_fields = extra_field_names(outlet_dist, error_model, num_scenarios)
+
+    def reach_fc():
+        return create_survey_data_fc\
+            (gdb_path, survey_data_fc_name + REACH_FC_SUFFIX,
+             survey_data_template, streams_spat_ref, extra_fields, "POLYLINE")
+
+    if shard_dir is not None:
+        # Sharded run: georeference each claimed shard into its own file
+        # geodatabase, then append the shard points, in shard order, to the
+        # survey data feature class if no other process does
+        if resume:
+            log.warning(" --resume does not apply to sharded runs; " +
+                        "shard progress is kept in {}".format(shard_dir))
+
+        def process_shard(shard_csv_filename, shard_gdb_path):
+            create_shard_gdb(shard_gdb_path)
+            shard_fc = create_survey_data_fc\
+                (shard_gdb_path, survey_data_fc_name, survey_data_template,
+                 streams_spat_ref, extra_fields)
+            georeference_survey_data(shard_csv_filename,
+                                     stream_dist_info_dict, streams_pathname,
+                                     shard_fc, survey_data_template, 1,
+                                     stream_index, sync_coords_in_lat_long,
+                                     max_snap_dist, river_index,
+                                     pipeline_queue_size or 0, geom_cache,
+                                     error_model=error_model,
+                                     scenario_sdi_dicts=scenario_sdi_dicts,
+                                     stream_workers=stream_workers)
+
+        def merge_outputs(shard_gdb_paths):
+            survey_data_fc = create_survey_data_fc\
+                (gdb_path, survey_data_fc_name, survey_data_template,
+                 streams_spat_ref, extra_fields)
+            arcpy.Append_management([os.path.join(shard_gdb_path,
+                                                  survey_data_fc_name)
+                                     for shard_gdb_path in shard_gdb_paths],
+                                    survey_data_fc, "TEST")
+            log.info(" merged {} shards into {}".
+                     format(len(shard_gdb_paths), survey_data_fc))
+            if packed_filepath is not None:
+                write_packed_output(survey_data_fc, packed_filepath,
+                                    streams_spat_ref)
+            if pool_index:
+                write_pool_index_output(survey_data_fc,
+                                        stream_dist_info_dict,
+                                        pool_index_filepath)
+            if reach_lines:
+                write_reach_lines(survey_data_fc, reach_fc(),
+                                  stream_dist_info_dict, geom_cache,
+                                  streams_spat_ref)
+            if tiles_filepath is not None:
+                write_tile_output(survey_data_fc, stream_dist_info_dict,
+                                  tiles_filepath, tile_workers)
+
+        num_processed, merged = rgshard.run_sharded\
+            (shard_dir, survey_data_filename, process_shard, merge_outputs,
+             GDB_SHARD_SUFFIX, num_shards, parse_workers or 1, lease_seconds)
+        log.info(" processed {} shards{}".
+                 format(num_processed, ", merged results" if merged
+                        else ""))
+        log.info(" {}".format(geom_cache))
+        return 0
+
+    # Look for an interrupted run of the same inputs to continue
+    if journal_filepath is None:
+        journal_filepath = rgckpt.default_journal_filepath\
+            (gdb_path, survey_data_fc_name)
+    journal = rgckpt.RunJournal(journal_filepath, rgckpt.hash_inputs
+                                (survey_data_filename, sdi_filepath,
+                                 streams_pathname,
+                                 scenario_sdi_filepaths +
+                                 [survey_data_template],
+                                 [("sync_lat_long", sync_coords_in_lat_long),
+                                  ("assign_missing_llid",
+                                   assign_missing_llid),
+                                  ("max_snap_dist", max_snap_dist),
+                                  ("outlet_dist", outlet_dist),
+                                  ("uncertainty", error_model),
+                                  ("scenario_output", scenario_output)]))
+    resume_state = None
+    if resume:
+        resume_state = journal.load()
+        if resume_state is None or \
+                not arcpy.Exists(os.path.join(gdb_path, survey_data_fc_name)):
+            log.warning(" No resumable run found in {}; ".
+                        format(journal_filepath) +
+                        "inputs are missing or changed. Starting over.")
+            resume_state = None
+
+    completed_groups = {}
+    if resume_state is not None:
+        # Continue adding to existing feature class for survey data
+        completed_groups, partial_llid = resume_state
+        survey_data_fc = os.path.join(gdb_path, survey_data_fc_name)
+        if partial_llid is not None:
+            # Stream being written when the run stopped is redone entirely,
+            # including its other groups: rows assigned to it by
+            # --assign_missing_llid form groups of their own
+            rgckpt.delete_llid_rows(survey_data_fc, rgcsv.SURVEY_LLID,
+                                    partial_llid)
+            completed_groups = dict((group, llid) for group, llid
+                                    in completed_groups.items()
+                                    if llid != partial_llid)
+        log.info(" Resuming run: {} stream groups already committed".
+                 format(len(completed_groups)))
+        journal.resume()
+    else:
+        # Create new feature class for survey data
+        survey_data_fc = create_survey_data_fc\
+            (gdb_path, survey_data_fc_name, survey_data_template,
+             streams_spat_ref, extra_fields)
+        journal.start()
+
+    # Feature classes for scenarios after the first
+    scenario_fcs = None
+    if scenario_sdi_dicts and scenario_output == rgscen.SEPARATE:
+        scenario_fcs = [create_survey_data_fc
+                        (gdb_path, rgscen.scenario_fc_name
+                         (survey_data_fc_name, scenario_num),
+                         survey_data_template, streams_spat_ref)
+                        for scenario_num in
+                        range(2, len(scenario_sdi_dicts) + 2)]
+
+    # Choose serial, batched or parallel execution from a sample of the
+    # inputs, unless given
+    plan = rgplan.plan_execution\
+        (rgplan.sample_input_stats(survey_data_filename, streams_pathname),
+         rgplan.load_cost_model(cost_model_filepath), True,
+         geom_cache.max_bytes, strategy, parse_workers, pipeline_queue_size)
+    if plan.preload:
+        completed_llids = set(completed_groups.values())
+        geom_cache.preload(sorted(llid for llid in stream_dist_info_dict
+                                  if llid not in completed_llids))
 
     # Create points for survey data
     georeference_survey_data(survey_data_filename, stream_dist_info_dict,
                              streams_pathname, survey_data_fc,
-                             survey_data_template)
+                             survey_data_template, plan.parse_workers,
+                             stream_index, sync_coords_in_lat_long,
+                             max_snap_dist, river_index,
+                             plan.pipeline_queue_size, geom_cache, journal,
+                             completed_groups, error_model,
+                             scenario_sdi_dicts, scenario_fcs,
+                             stream_workers)
+    journal.close()
+    log.info(" {}".format(geom_cache))
+
+    # Spatially ordered copy of the points, for review
+    if packed_filepath is not None:
+        write_packed_output(survey_data_fc, packed_filepath,
+                            streams_spat_ref)
+
+    # Index of points by distance along each stream, for range queries
+    if pool_index:
+        write_pool_index_output(survey_data_fc, stream_dist_info_dict,
+                                pool_index_filepath)
+
+    # Habitat unit reaches along the streams
+    if reach_lines:
+        write_reach_lines(survey_data_fc, reach_fc(), stream_dist_info_dict,
+                          geom_cache, streams_spat_ref)
+
+    # Pre-rendered tiles, for reviewing locations
+    if tiles_filepath is not None:
+        write_tile_output(survey_data_fc, stream_dist_info_dict,
+                          tiles_filepath, tile_workers)
 
     return 0
 
@@ -308,4 +1514,4 @@ def main(gdb_path, survey_data_filename, sdi_filepath,
 # ********** MAIN CHECK **********
 
 if __name__ == '__main__':
-   sys.exit(main(*parse_args(sys.argv[1:])))
\ No newline at end of file
+   sys.exit(main(**parse_args(sys.argv[1:])._asdict()))
\ No newline at end of file
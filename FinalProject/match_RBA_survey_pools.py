@@ -0,0 +1,324 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION: This script matches the pools of Rapid Bio_Assessment (RBA)
+# surveys of the same streams in different years.  Each pool's survey
+# distance is adjusted with the stream distance information (SDI) of its
+# survey, as georef_RBA_survey_data.py does, so pools of different surveys
+# are compared by their distance along the stream.  Pools of each stream
+# (LLID) are sorted by adjusted distance, and the two sorted lists are
+# swept together, matching pools within a tolerance of each other; no
+# geometry is needed.  Each survey is matched with the survey given after
+# it.
+#
+# INSTRUCTIONS:
+#       Run the script at the command line. Use "-h" to view the input
+#       arguments.
+#
+#       Input:
+#          matches_filepath: name of csv file where matched pairs of pools
+#              will be written
+#          --survey: survey data csv file and the sdi csv file defined for
+#              it (by define_RBA_dist_adj_factors.py), in that order; give
+#              once per survey, in year order, at least twice.  Files may
+#              be gzip or xz compressed.
+#          --tolerance: largest difference in adjusted distance between
+#              matched pools (default 50)
+#          --unmatched_filepath: csv file where unmatched pools will be
+#              written (default: matches_filepath with "_unmatched" added)
+#          --parse_workers: number of worker processes used to parse each
+#              survey data file (default 1, read serially)
+#
+#       Output:
+#          Script returns 0 if it completes successfully, 1 if it does not.
+#          It creates or overwrites the matches and unmatched csv files.
+#          Each row of the matches file is a pair of pools from consecutive
+#          surveys; each row of the unmatched file is a pool with no match
+#          in the survey it was compared with.
+#
+#          Informational messages are logged to the console.  Debug-level
+#          logging is available.
+#
+#       Exceptions:
+#          Problem locating given files are handled and reported.
+#          Other exceptions are not handled.
+#
+# SOURCE(S): https://docs.python.org/
+#            https://en.wikipedia.org/wiki/Sort-merge_join
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import os
+import csv
+import argparse
+import logging
+from collections import namedtuple
+import RBA_georef_util as rgutil
+import RBA_parallel_csv as rgcsv
+from georef_RBA_survey_data import adjust_stream_distance
+
+
+# ********** GLOBAL CONSTANTS **********
+
+DEFAULT_TOLERANCE = 50.0  # survey distance units
+UNMATCHED_SUFFIX = "_unmatched"
+
+MATCH_FIELDNAMES = [rgutil.LLID, "Survey_A", "Pool_A", "Survey_Dist_A",
+                    "Adj_Dist_A", "Survey_B", "Pool_B", "Survey_Dist_B",
+                    "Adj_Dist_B", "Adj_Dist_Diff"]
+UNMATCHED_FIELDNAMES = [rgutil.LLID, "Survey", "Pool", "Survey_Dist",
+                        "Adj_Dist", "Compared_With"]
+
+#LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = logging.INFO
+
+
+# ********** CLASSES **********
+
+# Pool of one survey, located by adjusted distance along its stream
+SurveyPool = namedtuple('SurveyPool', ['adj_dist', 'survey_dist', 'pool_num'])
+
+
+# ********** FUNCTIONS **********
+
+def parse_args(argv):
+    """
+    Defines and parses input arguments.
+    :param argv: Input arguments, excluding the script name.
+    :return: Argument values:
+        matches_filepath: path to possibly new CSV file where matched pairs
+            will be written
+        surveys: list of (survey data csv path, sdi csv path) tuples, in
+            year order
+        tolerance: largest adjusted distance difference of matched pools
+        unmatched_filepath: path to possibly new CSV file where unmatched
+            pools will be written
+        parse_workers: number of worker processes for parsing each survey
+            data csv file
+    """
+    parser = argparse.ArgumentParser\
+        (description="Match pools of surveys of the same streams in different years.")
+    # positional arguments
+    parser.add_argument("matches_filepath", type=rgutil.valid_filedir,
+                        help="matched pairs of pools will be saved in this file")
+    # optional arguments
+    parser.add_argument("--survey", dest="surveys", nargs=2,
+                        action='append', type=rgutil.valid_file,
+                        metavar=("SURVEY_DATA_FILEPATH", "SDI_FILEPATH"),
+                        help="survey data csv file and its stream distance " +
+                             "information csv file; give once per survey")
+    parser.add_argument("--tolerance", dest="tolerance", type=float,
+                        help="largest difference in adjusted distance " +
+                             "between matched pools")
+    parser.add_argument("--unmatched_filepath", dest="unmatched_filepath",
+                        type=rgutil.valid_filedir,
+                        help="unmatched pools will be saved in this file")
+    parser.add_argument("--parse_workers", dest="parse_workers", type=int,
+                        help="number of worker processes used to parse " +
+                             "large survey data files")
+    parser.set_defaults(surveys=[], tolerance=DEFAULT_TOLERANCE,
+                        unmatched_filepath=None, parse_workers=1)
+    args = parser.parse_args(argv)
+    if len(args.surveys) < 2:
+        parser.error("at least two --survey arguments are required")
+    unmatched_filepath = args.unmatched_filepath
+    if unmatched_filepath is None:
+        root, ext = os.path.splitext(args.matches_filepath)
+        unmatched_filepath = root + UNMATCHED_SUFFIX + (ext or ".csv")
+    return args.matches_filepath, [tuple(survey) for survey in args.surveys], \
+           args.tolerance, unmatched_filepath, args.parse_workers
+
+
+def survey_label(survey_data_filename):
+    """
+    Names a survey in the output files, by its survey data file name.
+    """
+    label = os.path.basename(survey_data_filename)
+    for ext in (".gz", ".xz", ".csv"):
+        if label.lower().endswith(ext):
+            label = label[:-len(ext)]
+    return label
+
+
+def read_survey_pools(survey_data_filename, stream_dist_info_dict,
+                      parse_workers=1):
+    """
+    Reads the pools of a survey and computes their adjusted distances.
+    :param survey_data_filename: survey data csv file
+    :param stream_dist_info_dict: dictionary of stream distance information
+        for the survey, keyed on stream LLID
+    :param parse_workers: number of worker processes used to parse
+        survey_data_filename; 1 reads it serially
+    :return: dictionary of lists of SurveyPool, keyed on stream LLID, each
+        sorted by adjusted distance
+    """
+    stream_pools = {}
+    skipped_llids = set()
+    num_skipped = 0
+    with rgcsv.open_survey_csv(survey_data_filename, parse_workers) \
+            as pts_file_reader:
+        headings = next(pts_file_reader)
+        Row = namedtuple('Row', headings)
+        for r in pts_file_reader:
+            row = Row(*r)
+            llid = str(row.LLID_num).replace("'", "")
+            if llid not in stream_dist_info_dict:
+                # No LLID, or no stream distance information for it
+                if llid not in skipped_llids:
+                    logging.warning(" No stream distance information for " +
+                                    "{} '{}' in {}; skipping its pools".
+                                    format(rgcsv.SURVEY_LLID, llid,
+                                           survey_data_filename))
+                    skipped_llids.add(llid)
+                num_skipped += 1
+                continue
+            survey_dist = int(row.CUM_DIST)
+            adj_dist = adjust_stream_distance\
+                (survey_dist, stream_dist_info_dict[llid].adj_factors)
+            stream_pools.setdefault(llid, []).append\
+                (SurveyPool(adj_dist, survey_dist, row.Pool_num))
+    for pools in stream_pools.values():
+        pools.sort()
+    logging.info(" read {} pools on {} streams from {} ({} skipped)".
+                 format(sum(len(pools) for pools in stream_pools.values()),
+                        len(stream_pools), survey_data_filename, num_skipped))
+    return stream_pools
+
+
+def match_sorted_pools(pools_a, pools_b, tolerance):
+    """
+    Matches the pools of one stream in two surveys, sweeping both lists in
+    order of adjusted distance.  Each pool is matched at most once; when a
+    pool is within tolerance of the other survey's current pool but nearer
+    to the next one, the pair is skipped in favor of the nearer match.
+    :param pools_a: list of SurveyPool for the stream in the first survey,
+        sorted by adjusted distance
+    :param pools_b: the same, for the second survey
+    :param tolerance: largest adjusted distance difference of a match
+    :return: tuple of (list of (pool a, pool b) matched pairs, list of
+        unmatched pools a, list of unmatched pools b)
+    """
+    matches = []
+    unmatched_a = []
+    unmatched_b = []
+    i = 0
+    j = 0
+    while i < len(pools_a) and j < len(pools_b):
+        dist_a = pools_a[i].adj_dist
+        dist_b = pools_b[j].adj_dist
+        diff = abs(dist_a - dist_b)
+        if dist_a < dist_b - tolerance:
+            unmatched_a.append(pools_a[i])
+            i += 1
+        elif dist_b < dist_a - tolerance:
+            unmatched_b.append(pools_b[j])
+            j += 1
+        elif j + 1 < len(pools_b) and \
+                abs(dist_a - pools_b[j + 1].adj_dist) < diff:
+            unmatched_b.append(pools_b[j])
+            j += 1
+        elif i + 1 < len(pools_a) and \
+                abs(pools_a[i + 1].adj_dist - dist_b) < diff:
+            unmatched_a.append(pools_a[i])
+            i += 1
+        else:
+            matches.append((pools_a[i], pools_b[j]))
+            i += 1
+            j += 1
+    unmatched_a.extend(pools_a[i:])
+    unmatched_b.extend(pools_b[j:])
+    return matches, unmatched_a, unmatched_b
+
+
+def match_surveys(stream_pools_a, stream_pools_b, tolerance):
+    """
+    Matches the pools of two surveys, stream by stream.
+    :param stream_pools_a: dictionary of sorted SurveyPool lists keyed on
+        LLID, for the first survey
+    :param stream_pools_b: the same, for the second survey
+    :param tolerance: largest adjusted distance difference of a match
+    :return: tuple of (list of (llid, pool a, pool b) matched pairs, list of
+        (llid, pool) unmatched in the first survey, list of (llid, pool)
+        unmatched in the second survey), in LLID order
+    """
+    matches = []
+    unmatched_a = []
+    unmatched_b = []
+    for llid in sorted(set(stream_pools_a) | set(stream_pools_b)):
+        stream_matches, stream_unmatched_a, stream_unmatched_b = \
+            match_sorted_pools(stream_pools_a.get(llid, []),
+                               stream_pools_b.get(llid, []), tolerance)
+        matches.extend((llid, pool_a, pool_b)
+                       for pool_a, pool_b in stream_matches)
+        unmatched_a.extend((llid, pool) for pool in stream_unmatched_a)
+        unmatched_b.extend((llid, pool) for pool in stream_unmatched_b)
+    return matches, unmatched_a, unmatched_b
+
+
+# ********** MAIN **********
+
+def main(matches_filepath, surveys, tolerance=DEFAULT_TOLERANCE,
+         unmatched_filepath=None, parse_workers=1):
+
+    # Initialize
+    logging.basicConfig(level=LOG_LEVEL)
+    if unmatched_filepath is None:
+        root, ext = os.path.splitext(matches_filepath)
+        unmatched_filepath = root + UNMATCHED_SUFFIX + (ext or ".csv")
+
+    # Adjusted distances of every survey's pools
+    labels = [survey_label(survey_data_filename)
+              for survey_data_filename, sdi_filepath in surveys]
+    survey_pools = []
+    for survey_data_filename, sdi_filepath in surveys:
+        stream_dist_info_dict = rgutil.read_sdi_from_csvfile(sdi_filepath)
+        survey_pools.append(read_survey_pools(survey_data_filename,
+                                              stream_dist_info_dict,
+                                              parse_workers))
+
+    # Match each survey with the next
+    with open(matches_filepath, 'wb') as matches_file, \
+            open(unmatched_filepath, 'wb') as unmatched_file:
+        matches_writer = csv.writer(matches_file)
+        matches_writer.writerow(MATCH_FIELDNAMES)
+        unmatched_writer = csv.writer(unmatched_file)
+        unmatched_writer.writerow(UNMATCHED_FIELDNAMES)
+        for survey_num in range(len(surveys) - 1):
+            label_a = labels[survey_num]
+            label_b = labels[survey_num + 1]
+            matches, unmatched_a, unmatched_b = match_surveys\
+                (survey_pools[survey_num], survey_pools[survey_num + 1],
+                 tolerance)
+            for llid, pool_a, pool_b in matches:
+                # need to force LLID to be text (vs sci notation)
+                matches_writer.writerow(["'{}'".format(llid),
+                                         label_a, pool_a.pool_num,
+                                         pool_a.survey_dist, pool_a.adj_dist,
+                                         label_b, pool_b.pool_num,
+                                         pool_b.survey_dist, pool_b.adj_dist,
+                                         pool_b.adj_dist - pool_a.adj_dist])
+            for label, other_label, unmatched in \
+                    ((label_a, label_b, unmatched_a),
+                     (label_b, label_a, unmatched_b)):
+                for llid, pool in unmatched:
+                    unmatched_writer.writerow(["'{}'".format(llid), label,
+                                               pool.pool_num, pool.survey_dist,
+                                               pool.adj_dist, other_label])
+            logging.info(" {} vs {}: {} matched pairs, {} and {} unmatched".
+                         format(label_a, label_b, len(matches),
+                                len(unmatched_a), len(unmatched_b)))
+    logging.info(" matches saved to {}, unmatched pools to {}".
+                 format(matches_filepath, unmatched_filepath))
+    return 0
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main(*parse_args(sys.argv[1:])))
@@ -0,0 +1,371 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION: This script reviews the stream distance information (SDI)
+# created by define_RBA_dist_adj_factors.py, before it is used to
+# georeference survey data.  Every adjustment factor in the SDI file is
+# checked at once, using numpy array operations, and the problems found are
+# written to a CSV report ranked from most to least severe.  Checks:
+#       Adj_Factor outside configurable bounds
+#       survey distance not increasing between sync points (adjustment
+#           factor would divide by zero or be negative)
+#       streamline distance decreasing between sync points
+#       large snap offsets between sync point x,y and the stream
+#       long unsynced stream ends, which use DEFAULT_ADJ_FACTOR
+#
+# INSTRUCTIONS:
+#       Run the script at the command line. Use "-h" to view the input
+#       arguments.
+#
+#       Input:
+#          sdi_filepath: full path location of csv file containing stream
+#              distance information.
+#          report_filepath: name of csv file where the ranked report will
+#              be written.
+#          --min_factor, --max_factor: bounds for acceptable adjustment
+#              factors
+#          --max_snap_offset: largest acceptable distance from sync point
+#              x,y coordinates to the stream
+#          --max_unsynced_length: longest acceptable survey distance past
+#              the last sync point on a stream
+#          --survey_data_filepath: survey data csv file, used to find the
+#              survey length of each stream for --max_unsynced_length
+#
+#       Output:
+#          Script returns 0 if it completes successfully, 1 if it does not.
+#          It creates or overwrites the csv file at report_filepath.
+#
+#          A summary and the most severe problems are logged to the console.
+#
+#       Exceptions:
+#          Problem locating given files are handled and reported.
+#          Other exceptions are not handled.
+#
+# SOURCE(S): https://docs.python.org/
+#            http://docs.scipy.org/doc/numpy/reference/
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import sys
+import csv
+import argparse
+import logging
+import numpy as np
+import RBA_georef_util as rgutil
+import RBA_parallel_csv as rgcsv
+
+
+# ********** GLOBAL CONSTANTS **********
+
+DEFAULT_MIN_FACTOR = 0.5
+DEFAULT_MAX_FACTOR = 2.0
+DEFAULT_MAX_SNAP_OFFSET = 100.0
+DEFAULT_MAX_UNSYNCED_LENGTH = 2000.0
+
+# Problems that make the adjustment factor meaningless rank above all
+# threshold checks, whose scores are the ratio of value to limit
+ERROR_SCORE = 1000.0
+
+CHECK_FACTOR_BOUNDS = "factor_out_of_bounds"
+CHECK_SURVEY_NOT_INCREASING = "survey_dist_not_increasing"
+CHECK_STREAMLINE_BACKWARD = "streamline_dist_backward"
+CHECK_SNAP_OFFSET = "large_snap_offset"
+CHECK_UNSYNCED_END = "long_unsynced_end"
+
+REPORT_FIELDNAMES = ["Rank", "Score", "Check", rgutil.LLID,
+                     rgutil.STREAMNAME,
+                     rgutil.BEGIN_ + rgutil.SURVEY_CUM_DISTANCE,
+                     rgutil.END_ + rgutil.SURVEY_CUM_DISTANCE,
+                     rgutil.ADJ_FACTOR, "Value", "Limit"]
+
+NUM_LOGGED_PROBLEMS = 10
+
+#LOG_LEVEL = logging.DEBUG
+LOG_LEVEL = logging.INFO
+
+
+# ********** CLASSES **********
+
+# See RBA_georef_utl
+
+
+# ********** FUNCTIONS **********
+
+def parse_args(argv):
+    """
+    Defines and parses input arguments.
+    :param argv: Input arguments, excluding the script name.
+    :return: Argument values:
+        sdi_filepath: path to CSV file containing stream distance information
+        report_filepath: path to possibly new CSV file where the report
+            will be written
+        min_factor, max_factor: bounds for acceptable adjustment factors
+        max_snap_offset: largest acceptable sync point snap offset
+        max_unsynced_length: longest acceptable unsynced stream end
+        survey_data_filepath: path to survey data CSV file, or None
+    """
+    parser = argparse.ArgumentParser\
+        (description="Review stream distance adjustment factors.")
+    # positional arguments
+    parser.add_argument("sdi_filepath", type=rgutil.valid_file,
+                        help="full path location of csv file containing " +
+                             "stream distance information")
+    parser.add_argument("report_filepath", type=rgutil.valid_filedir,
+                        help="ranked list of problems will be saved in this file")
+    # optional arguments
+    parser.add_argument("--min_factor", dest="min_factor", type=float,
+                        help="smallest acceptable adjustment factor")
+    parser.add_argument("--max_factor", dest="max_factor", type=float,
+                        help="largest acceptable adjustment factor")
+    parser.add_argument("--max_snap_offset", dest="max_snap_offset",
+                        type=float,
+                        help="largest acceptable distance from sync point " +
+                             "x,y to stream")
+    parser.add_argument("--max_unsynced_length", dest="max_unsynced_length",
+                        type=float,
+                        help="longest acceptable survey distance after the " +
+                             "last sync point")
+    parser.add_argument("--survey_data_filepath", dest="survey_data_filepath",
+                        type=rgutil.valid_file,
+                        help="survey data csv file, for unsynced end lengths")
+    parser.set_defaults(min_factor=DEFAULT_MIN_FACTOR,
+                        max_factor=DEFAULT_MAX_FACTOR,
+                        max_snap_offset=DEFAULT_MAX_SNAP_OFFSET,
+                        max_unsynced_length=DEFAULT_MAX_UNSYNCED_LENGTH,
+                        survey_data_filepath=None)
+    args = parser.parse_args(argv)
+    return args.sdi_filepath, args.report_filepath, args.min_factor, \
+           args.max_factor, args.max_snap_offset, args.max_unsynced_length, \
+           args.survey_data_filepath
+
+
+def read_sdi_columns(sdi_filepath):
+    """
+    Reads the stream distance information csv file into column arrays,
+    one array per heading.  Numeric columns are float arrays, with NaN for
+    empty values; text columns are string arrays.
+    :param sdi_filepath: full path to csv file containing stream distance
+        information
+    :return: dictionary of numpy arrays keyed on column heading
+    """
+    with rgutil.open_csv_file(sdi_filepath) as sdi_file:
+        sdi_file_reader = csv.reader(sdi_file)
+        headings = sdi_file_reader.next()
+        rows = list(sdi_file_reader)
+
+    columns = {}
+    for col_num, heading in enumerate(headings):
+        values = [r[col_num] if col_num < len(r) else "" for r in rows]
+        try:
+            columns[heading] = np.array([float(v) if v != "" else np.nan
+                                         for v in values])
+        except ValueError:
+            columns[heading] = np.array(values)
+    # LLIDs are written with quotes to force them to be text
+    columns[rgutil.LLID] = np.char.replace(columns[rgutil.LLID].astype(str),
+                                           "'", "")
+    return columns
+
+
+def read_survey_lengths(survey_data_filepath):
+    """
+    Finds the largest survey cumulative distance for each stream.
+    :param survey_data_filepath: full path to survey data csv file
+    :return: dictionary of maximum CUM_DIST keyed on LLID
+    """
+    with rgcsv.open_survey_csv(survey_data_filepath) as pts_file_reader:
+        headings = pts_file_reader.next()
+        llid_col = headings.index(rgcsv.SURVEY_LLID)
+        dist_col = headings.index("CUM_DIST")
+        llids = []
+        dists = []
+        for r in pts_file_reader:
+            if r[llid_col] != "" and r[dist_col] != "":
+                llids.append(r[llid_col])
+                dists.append(float(r[dist_col]))
+    if not llids:
+        return {}
+    llids = np.array(llids)
+    dists = np.array(dists)
+    # Group by LLID and take the maximum of each group
+    order = np.argsort(llids, kind='mergesort')
+    llids = llids[order]
+    dists = dists[order]
+    group_starts = np.concatenate(([0],
+                                   np.nonzero(llids[1:] != llids[:-1])[0] + 1))
+    return dict(zip(llids[group_starts],
+                    np.maximum.reduceat(dists, group_starts)))
+
+
+def check_adj_factors(columns, min_factor, max_factor, max_snap_offset,
+                      max_unsynced_length, survey_lengths=None):
+    """
+    Checks all adjustment factors in the SDI columns for problems.
+    :param columns: dictionary of SDI column arrays, from read_sdi_columns
+    :param min_factor: smallest acceptable adjustment factor
+    :param max_factor: largest acceptable adjustment factor
+    :param max_snap_offset: largest acceptable sync point snap offset
+    :param max_unsynced_length: longest acceptable unsynced stream end
+    :param survey_lengths: dictionary of stream survey length keyed on LLID,
+        or None to skip the unsynced end check
+    :return: list of (check name, row indexes, values, limits, scores)
+        tuples, one per check, each holding arrays over the problem rows
+    """
+    begin_survey = columns[rgutil.BEGIN_ + rgutil.SURVEY_CUM_DISTANCE]
+    end_survey = columns[rgutil.END_ + rgutil.SURVEY_CUM_DISTANCE]
+    begin_streamline = columns[rgutil.BEGIN_ + rgutil.STREAMLINE_CUM_DISTANCE]
+    end_streamline = columns[rgutil.END_ + rgutil.STREAMLINE_CUM_DISTANCE]
+    adj_factor = columns[rgutil.ADJ_FACTOR]
+    num_rows = len(adj_factor)
+    # An end sync point at the default end distance is not a sync point;
+    # the segment runs to the end of the stream with DEFAULT_ADJ_FACTOR
+    end_synced = end_survey != rgutil.DEFAULT_END_DIST
+
+    checks = []
+
+    def add_check(name, mask, values, limits, scores):
+        rows = np.nonzero(mask)[0]
+        limits = np.zeros(num_rows) + limits
+        checks.append((name, rows, values[rows], limits[rows], scores[rows]))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Factors out of bounds, scored by how far out they are
+        out_of_bounds = (adj_factor < min_factor) | (adj_factor > max_factor)
+        limits = np.where(adj_factor < min_factor, min_factor, max_factor)
+        scores = np.maximum(adj_factor / max_factor, min_factor / adj_factor)
+        scores = np.where(np.isfinite(scores) & (adj_factor > 0),
+                          scores, ERROR_SCORE)
+        add_check(CHECK_FACTOR_BOUNDS, out_of_bounds, adj_factor, limits,
+                  scores)
+
+        # Survey distance must increase between sync points
+        survey_diff = end_survey - begin_survey
+        add_check(CHECK_SURVEY_NOT_INCREASING, end_synced & (survey_diff <= 0),
+                  survey_diff, 0.0,
+                  ERROR_SCORE - survey_diff)
+
+        # Streamline distance must not go backward
+        streamline_diff = end_streamline - begin_streamline
+        add_check(CHECK_STREAMLINE_BACKWARD,
+                  end_synced & (streamline_diff < 0),
+                  streamline_diff, 0.0,
+                  ERROR_SCORE - streamline_diff)
+
+        # Snap offsets, when the SDI file has them
+        snap_column = rgutil.END_ + rgutil.SNAP_OFFSET
+        begin_snap_column = rgutil.BEGIN_ + rgutil.SNAP_OFFSET
+        if snap_column in columns and \
+                columns[snap_column].dtype.kind == 'f':
+            snap = np.fmax(columns[snap_column],
+                           columns[begin_snap_column]
+                           if columns[begin_snap_column].dtype.kind == 'f'
+                           else np.nan)
+            add_check(CHECK_SNAP_OFFSET, snap > max_snap_offset, snap,
+                      max_snap_offset, snap / max_snap_offset)
+        else:
+            logging.info(" SDI file has no {} columns; ".
+                         format(rgutil.SNAP_OFFSET) +
+                         "skipping snap offset check")
+
+        # Unsynced stream ends, measured against the stream survey length
+        if survey_lengths is not None:
+            stream_length = np.array([survey_lengths.get(llid, np.nan)
+                                      for llid in columns[rgutil.LLID]])
+            unsynced = stream_length - begin_survey
+            add_check(CHECK_UNSYNCED_END,
+                      ~end_synced & (unsynced > max_unsynced_length),
+                      unsynced, max_unsynced_length,
+                      unsynced / max_unsynced_length)
+
+    return checks
+
+
+def rank_problems(checks):
+    """
+    Combines the problems from all checks and ranks them by score.
+    :param checks: list of check results, from check_adj_factors
+    :return: tuple of (check names, row indexes, values, limits, scores)
+        arrays, most severe problem first
+    """
+    names = np.concatenate([np.repeat(name, len(rows))
+                            for name, rows, values, limits, scores in checks])
+    rows = np.concatenate([c[1] for c in checks])
+    values = np.concatenate([c[2] for c in checks])
+    limits = np.concatenate([c[3] for c in checks])
+    scores = np.concatenate([c[4] for c in checks])
+    order = np.argsort(-scores, kind='mergesort')
+    return names[order], rows[order], values[order], limits[order], \
+        scores[order]
+
+
+def write_report(columns, ranked, report_filepath):
+    """
+    Writes the ranked problems to a csv file.
+    :param columns: dictionary of SDI column arrays
+    :param ranked: ranked problems, from rank_problems
+    :param report_filepath: full path to csv file where report is written
+    :return: N/A, file at report_filepath is created and populated
+    """
+    names, rows, values, limits, scores = ranked
+    with open(report_filepath, 'wb') as report_file:
+        report_writer = csv.writer(report_file)
+        report_writer.writerow(REPORT_FIELDNAMES)
+        for rank in range(len(rows)):
+            row = rows[rank]
+            report_writer.writerow\
+                ([rank + 1, round(scores[rank], 3), names[rank],
+                  "'{}'".format(columns[rgutil.LLID][row]),
+                  columns[rgutil.STREAMNAME][row],
+                  columns[rgutil.BEGIN_ + rgutil.SURVEY_CUM_DISTANCE][row],
+                  columns[rgutil.END_ + rgutil.SURVEY_CUM_DISTANCE][row],
+                  columns[rgutil.ADJ_FACTOR][row],
+                  values[rank], limits[rank]])
+
+
+# ********** MAIN **********
+
+def main(sdi_filepath, report_filepath, min_factor=DEFAULT_MIN_FACTOR,
+         max_factor=DEFAULT_MAX_FACTOR,
+         max_snap_offset=DEFAULT_MAX_SNAP_OFFSET,
+         max_unsynced_length=DEFAULT_MAX_UNSYNCED_LENGTH,
+         survey_data_filepath=None):
+
+    # Initialize
+    logging.basicConfig(level=LOG_LEVEL)
+
+    columns = read_sdi_columns(sdi_filepath)
+    survey_lengths = None
+    if survey_data_filepath is not None:
+        survey_lengths = read_survey_lengths(survey_data_filepath)
+
+    checks = check_adj_factors(columns, min_factor, max_factor,
+                               max_snap_offset, max_unsynced_length,
+                               survey_lengths)
+    ranked = rank_problems(checks)
+    write_report(columns, ranked, report_filepath)
+
+    for name, rows, values, limits, scores in checks:
+        logging.info(" {}: {} problems".format(name, len(rows)))
+    names, rows, values, limits, scores = ranked
+    for rank in range(min(NUM_LOGGED_PROBLEMS, len(rows))):
+        logging.info(" {}. {} {} at survey dist {}: {} = {} (limit {})".
+                     format(rank + 1, rgutil.LLID,
+                            columns[rgutil.LLID][rows[rank]],
+                            columns[rgutil.BEGIN_ +
+                                    rgutil.SURVEY_CUM_DISTANCE][rows[rank]],
+                            names[rank], values[rank], limits[rank]))
+    logging.info(" reviewed {} adjustment factors, {} problems saved to {}".
+                 format(len(columns[rgutil.ADJ_FACTOR]), len(rows),
+                        report_filepath))
+    return 0
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    sys.exit(main(*parse_args(sys.argv[1:])))
@@ -0,0 +1,191 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Tests that stream distance information developed in memory
+# (GeorefSession.define_adj_factors, define_RBA_dist_adj_factors.
+# build_sdi_from_records) can be used directly to georeference survey
+# data, as if it had been written to and read back from a csv file.
+# Tests needing arcpy or numpy are skipped where those are not installed.
+#
+#   Run from the FinalProject directory:
+#       python -m unittest discover -p "test_*.py"
+#
+# SOURCE(S): https://docs.python.org/2/library/unittest.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import os
+import shutil
+import tempfile
+import unittest
+import RBA_georef_util as rgutil
+import RBA_stream_network as rgnet
+import define_RBA_dist_adj_factors as rgdefine
+import georef_RBA_survey_data as rggeoref
+import RBA_session as rgsess
+
+try:
+    import numpy
+    import RBA_uncertainty as rgunc
+    import RBA_scenarios as rgscen
+except ImportError:
+    numpy = None
+
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+
+# ********** GLOBAL CONSTANTS **********
+
+SURVEY_HEADINGS = ["LLID_num", "STREAM", "TRIB_TO", "Pool_num", "CUM_DIST",
+                   "X", "Y", "XY_Note", "COMMENT"]
+STREAM_LENGTH = 1000.0
+STREAMS_WKID = 26910  # NAD83 / UTM zone 10N
+
+
+# ********** CLASSES **********
+
+class NoStreamGeometries(object):
+    """
+    Stands in for a StreamGeometryCache when no row has x,y coordinates,
+    so no stream geometry is used.
+    """
+
+    def get(self, llid):
+        return None
+
+
+class InMemorySdiTest(unittest.TestCase):
+    """
+    Adjustment factors from build_sdi_from_records, for streams with no x,y
+    sync points, used without a csv round trip.
+    """
+
+    def setUp(self):
+        self.records = [SURVEY_HEADINGS,
+                        ["1", "Creek", "River", "1", "0", "", "", "", ""],
+                        ["1", "Creek", "River", "2", "100", "", "", "", ""],
+                        ["1", "Creek", "River", "3", "250", "", "", "", ""],
+                        ["2", "Brook", "Creek", "1", "40", "", "", "", ""]]
+        self.sdi_dict = rgdefine.build_sdi_from_records\
+            (self.records, rgutil.STREAMS_FC_NAME, False,
+             geom_cache=NoStreamGeometries())
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_open_ends_are_sync_points(self):
+        for sdi in self.sdi_dict.values():
+            for begin_sync_pt, end_sync_pt, adj_factor in sdi.adj_factors:
+                self.assertIsNotNone(end_sync_pt)
+                self.assertEqual(end_sync_pt.survey_cum_dist,
+                                 rgutil.DEFAULT_END_DIST)
+
+    def test_adjusted_distances_match_csv_round_trip(self):
+        sdi_filepath = os.path.join(self.temp_dir, "sdi.csv")
+        rgutil.write_sdi_to_csv_file(self.sdi_dict, sdi_filepath)
+        read_dict = rgutil.read_sdi_from_csvfile(sdi_filepath)
+        self.assertEqual(sorted(read_dict), sorted(self.sdi_dict))
+        for llid, survey_dist in (("1", 0), ("1", 100), ("1", 250),
+                                  ("1", 5000), ("2", 40)):
+            adjusted = rggeoref.adjust_stream_distance\
+                (survey_dist, self.sdi_dict[llid].adj_factors)
+            self.assertEqual(adjusted, rggeoref.adjust_stream_distance
+                             (survey_dist, read_dict[llid].adj_factors))
+            self.assertEqual(rggeoref.applicable_adj_factor
+                             (survey_dist, self.sdi_dict[llid].adj_factors),
+                             rgutil.DEFAULT_ADJ_FACTOR)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_uncertainty_and_scenarios(self):
+        stream_line = rgnet.StreamLine("1", [0.0, 0.0],
+                                       [0.0, STREAM_LENGTH])
+        adj_factors = self.sdi_dict["1"].adj_factors
+        pool_dists = [0, 100, 250]
+        error_model = rgunc.ErrorModel(20, 15.0, 10.0, 1)
+        uncertainty = rgunc.StreamUncertainty\
+            (stream_line, adj_factors, error_model,
+             rgunc.new_random_state(error_model))
+        self.assertEqual(len(uncertainty.positional_spread(pool_dists)),
+                         len(pool_dists))
+        scenarios = rgscen.StreamScenarios(stream_line,
+                                           [adj_factors, adj_factors])
+        self.assertEqual(scenarios.adjusted_distances(pool_dists).tolist(),
+                         [[0.0, 100.0, 250.0]] * 2)
+
+
+@unittest.skipIf(arcpy is None, "arcpy is not installed")
+class GeorefSessionTest(unittest.TestCase):
+    """
+    GeorefSession.define_adj_factors then georeference_records, on a
+    scratch geodatabase with one straight stream.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        arcpy.CreateFileGDB_management(self.temp_dir, "test.gdb")
+        self.gdb_path = os.path.join(self.temp_dir, "test.gdb")
+        spatial_ref = arcpy.SpatialReference(STREAMS_WKID)
+        arcpy.CreateFeatureclass_management\
+            (self.gdb_path, rgutil.STREAMS_FC_NAME, "POLYLINE",
+             spatial_reference=spatial_ref)
+        streams_pathname = os.path.join(self.gdb_path,
+                                        rgutil.STREAMS_FC_NAME)
+        arcpy.AddField_management(streams_pathname, rgutil.LLID, "TEXT")
+        with arcpy.da.InsertCursor(streams_pathname,
+                                   ["SHAPE@", rgutil.LLID]) as cursor:
+            cursor.insertRow([arcpy.Polyline
+                              (arcpy.Array([arcpy.Point(0.0, 0.0),
+                                            arcpy.Point(0.0, STREAM_LENGTH)]),
+                               spatial_ref), "1"])
+        arcpy.CreateTable_management(self.gdb_path, "template")
+        self.template = os.path.join(self.gdb_path, "template")
+        arcpy.AddField_management(self.template, "Pool_num", "LONG")
+        arcpy.AddField_management(self.template, "CUM_DIST", "LONG")
+
+    def tearDown(self):
+        arcpy.ClearWorkspaceCache_management()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_define_then_georeference(self):
+        # Pool 2 is synced 120 along the stream; pool 3 is past the last
+        # sync point
+        records = [SURVEY_HEADINGS,
+                   ["1", "Creek", "River", "1", "0", "", "", "", ""],
+                   ["1", "Creek", "River", "2", "100", "0", "120", "", ""],
+                   ["1", "Creek", "River", "3", "200", "", "", "", ""]]
+        with rgsess.GeorefSession(self.gdb_path) as session:
+            sdi_dict = session.define_adj_factors(records)
+            points = session.georeference_records(records, sdi_dict,
+                                                  self.template)
+        self.assertEqual(points.fields[:3], ["SHAPE@", "Pool_num",
+                                             "CUM_DIST"])
+        located = [(row[1], row[0].firstPoint.Y) for row in points.rows]
+        self.assertEqual([pool for pool, y in located], [1, 2, 3])
+        for (pool, y), expected_y in zip(located, [0.0, 120.0, 220.0]):
+            self.assertAlmostEqual(y, expected_y, places=3)
+
+
+# ********** FUNCTIONS **********
+
+# See the test cases
+
+
+# ********** MAIN **********
+
+def main():
+    unittest.main()
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    main()
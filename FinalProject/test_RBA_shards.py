@@ -0,0 +1,262 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Tests of sharded runs with several local worker processes
+# standing in for worker hosts: an expired lease is reclaimed by exactly
+# one of the workers racing for it, and a run in which a worker is killed
+# in the middle of a shard merges the same output as a single-process run.
+# The shard work is a per-stream row count and distance total, so the
+# tests need neither arcpy nor a geodatabase.
+#
+#   Run from the FinalProject directory:
+#       python -m unittest discover -p "test_*.py"
+#
+# SOURCE(S): https://docs.python.org/2/library/unittest.html
+#            https://docs.python.org/2/library/multiprocessing.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import os
+import csv
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import RBA_shards as rgshard
+import RBA_parallel_csv as rgcsv
+
+
+# ********** GLOBAL CONSTANTS **********
+
+LEASE_SECONDS = 1.0
+POLL_SECONDS = 0.05  # replaces rgshard.POLL_SECONDS in the workers
+SHARD_SECONDS = 0.2  # time each worker spends on a shard
+NUM_WORKERS = 4
+NUM_SHARDS = 8
+NUM_STREAMS = 40
+RECLAIM_ROUNDS = 20
+WAIT_SECONDS = 60.0  # longest a test waits for its workers
+
+
+# ********** CLASSES **********
+
+class ReclaimTest(unittest.TestCase):
+    """
+    Workers racing to reclaim one expired lease.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.lease_path = os.path.join(self.temp_dir, "shard" +
+                                       rgshard.LEASE_SUFFIX)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_one_worker_reclaims_expired_lease(self):
+        lease_path = self.lease_path
+        for round_num in range(RECLAIM_ROUNDS):
+            write_expired_lease(lease_path)
+            start = multiprocessing.Event()
+            results = multiprocessing.Queue()
+            workers = [multiprocessing.Process
+                       (target=reclaim_worker,
+                        args=(lease_path, start, results))
+                       for i in range(NUM_WORKERS)]
+            for worker in workers:
+                worker.start()
+            start.set()
+            acquired = [results.get(timeout=WAIT_SECONDS)
+                        for worker in workers]
+            for worker in workers:
+                worker.join()
+            self.assertEqual(acquired.count(True), 1, round_num)
+            self.assertNotEqual(rgshard.lease_owner(lease_path),
+                                "stopped-worker:1")
+            self.assertFalse(os.path.exists(lease_path +
+                                            rgshard.RECLAIM_SUFFIX))
+            os.remove(lease_path)
+
+    def test_reclaimed_lease_is_not_reclaimed_again(self):
+        # This worker sees the lease expired, then another worker reclaims
+        # it before this one acts on what it saw
+        lease_path = self.lease_path
+        write_expired_lease(lease_path)
+        check_lease_age = rgshard.lease_age
+        reclaimed = []
+
+        def lease_age_then_reclaim(path):
+            age = check_lease_age(path)
+            if path == lease_path and not reclaimed:
+                reclaimed.append(True)
+                start = multiprocessing.Event()
+                start.set()
+                results = multiprocessing.Queue()
+                other = multiprocessing.Process(target=reclaim_worker,
+                                                args=(lease_path, start,
+                                                      results))
+                other.start()
+                reclaimed.append(results.get(timeout=WAIT_SECONDS))
+                other.join()
+            return age
+
+        rgshard.lease_age = lease_age_then_reclaim
+        try:
+            acquired = rgshard.acquire_lease(lease_path, LEASE_SECONDS)
+        finally:
+            rgshard.lease_age = check_lease_age
+        self.assertEqual(reclaimed, [True, True])
+        self.assertFalse(acquired)
+        self.assertNotIn(rgshard.lease_owner(lease_path),
+                         (rgshard.worker_id(), "stopped-worker:1"))
+
+
+class KilledWorkerTest(unittest.TestCase):
+    """
+    Sharded run with a worker killed while it holds a shard's lease.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.survey_path = os.path.join(self.temp_dir, "survey.csv")
+        write_survey_csv(self.survey_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_killed_worker_shard_is_redone(self):
+        # Single-process run, for the expected output
+        single_dir = os.path.join(self.temp_dir, "single")
+        run_worker(single_dir, self.survey_path)
+        with open(os.path.join(single_dir, "merged.csv")) as merged_file:
+            expected = merged_file.read()
+
+        # The first worker stops in the middle of its first shard, and is
+        # killed there; the others reclaim its shard once the lease expires
+        shard_dir = os.path.join(self.temp_dir, "sharded")
+        hang_path = os.path.join(self.temp_dir, "hanging")
+        doomed = multiprocessing.Process(target=run_worker,
+                                         args=(shard_dir, self.survey_path,
+                                               hang_path))
+        doomed.start()
+        wait_for(lambda: os.path.exists(hang_path))
+        workers = [multiprocessing.Process(target=run_worker,
+                                           args=(shard_dir,
+                                                 self.survey_path))
+                   for i in range(NUM_WORKERS - 1)]
+        for worker in workers:
+            worker.start()
+        doomed.terminate()
+        doomed.join()
+        for worker in workers:
+            worker.join(WAIT_SECONDS)
+            self.assertEqual(worker.exitcode, 0)
+
+        with open(os.path.join(shard_dir, "merged.csv")) as merged_file:
+            self.assertEqual(merged_file.read(), expected)
+        self.assertTrue(os.path.exists(os.path.join(shard_dir,
+                                                    rgshard.MERGED_NAME)))
+        self.assertEqual(os.listdir(os.path.join(shard_dir,
+                                                 rgshard.LEASES_DIR)), [])
+
+
+# ********** FUNCTIONS **********
+
+def wait_for(condition):
+    """
+    Waits until condition() is true, failing after WAIT_SECONDS.
+    """
+    deadline = time.time() + WAIT_SECONDS
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out waiting for workers")
+        time.sleep(POLL_SECONDS)
+
+
+def write_expired_lease(lease_path):
+    """
+    Writes a lease last touched well over LEASE_SECONDS ago.
+    """
+    rgshard.create_exclusive(lease_path, "stopped-worker:1")
+    expired_time = time.time() - 10 * LEASE_SECONDS
+    os.utime(lease_path, (expired_time, expired_time))
+
+
+def write_survey_csv(survey_path):
+    """
+    Writes survey data for NUM_STREAMS streams, with some rows lacking an
+    LLID, which stay with the stream before them.
+    """
+    with open(survey_path, 'wb') as survey_file:
+        survey_writer = csv.writer(survey_file)
+        survey_writer.writerow([rgcsv.SURVEY_LLID, "CUM_DIST"])
+        for stream_num in range(NUM_STREAMS):
+            for pool_num in range(1 + stream_num % 7):
+                llid = "" if pool_num == 3 else str(1000 + stream_num)
+                survey_writer.writerow([llid, 50 * pool_num + stream_num])
+
+
+def reclaim_worker(lease_path, start, results):
+    """
+    Tries to take an expired lease as soon as start is set.
+    """
+    start.wait()
+    results.put(rgshard.acquire_lease(lease_path, LEASE_SECONDS))
+
+
+def run_worker(shard_dir, survey_path, hang_path=None):
+    """
+    Runs one worker of a sharded run whose shard output is the rows and
+    total survey distance of each stream.  If hang_path is given, the worker
+    creates it in its first shard and then stops there until killed.
+    """
+    rgshard.POLL_SECONDS = POLL_SECONDS
+
+    def process_shard(shard_csv_path, shard_output_path):
+        if hang_path is not None:
+            rgshard.create_exclusive(hang_path)
+            while True:
+                time.sleep(POLL_SECONDS)
+        time.sleep(SHARD_SECONDS)
+        stream_totals = {}
+        with rgcsv.open_survey_csv(shard_csv_path) as shard_reader:
+            next(shard_reader)
+            llid = ""
+            for llid_value, survey_dist in shard_reader:
+                llid = llid_value or llid
+                rows, total = stream_totals.get(llid, (0, 0))
+                stream_totals[llid] = (rows + 1, total + int(survey_dist))
+        with open(shard_output_path, 'wb') as output_file:
+            csv.writer(output_file).writerows\
+                ([llid, rows, total] for llid, (rows, total)
+                 in sorted(stream_totals.items()))
+
+    def merge_outputs(shard_output_paths):
+        merged_rows = []
+        for shard_output_path in shard_output_paths:
+            with open(shard_output_path, 'rb') as shard_file:
+                merged_rows.extend(csv.reader(shard_file))
+        with open(os.path.join(shard_dir, "merged.csv"), 'wb') \
+                as merged_file:
+            csv.writer(merged_file).writerows(sorted(merged_rows))
+
+    rgshard.run_sharded(shard_dir, survey_path, process_shard,
+                        merge_outputs, ".csv", NUM_SHARDS, 1, LEASE_SECONDS)
+
+
+# ********** MAIN **********
+
+def main():
+    unittest.main()
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    main()
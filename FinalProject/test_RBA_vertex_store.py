@@ -0,0 +1,215 @@
+# **********************************************************************
+#
+# NAME: Marilyn Daum
+# DATE: 15 Mar 2015
+# CLASS: GEOG510
+# ASSIGNMENT: Final Project
+#
+# DESCRIPTION:  Tests of the shared stream vertex store: streams read back
+# from a store give the same positions and snapped distances as the
+# StreamLines stored, a store is removed when its owner is done or fails,
+# and a store left by an owner that was killed is removed the next time a
+# store is created in the same directory.  The positional spreads and
+# scenario values computed by store workers (georef_RBA_survey_data
+# --stream_workers) match those computed in one process.  Skipped where
+# numpy is not installed.
+#
+#   Run from the FinalProject directory:
+#       python -m unittest discover -p "test_*.py"
+#
+# SOURCE(S): https://docs.python.org/2/library/unittest.html
+#            https://docs.python.org/2/library/multiprocessing.html
+#
+# **********************************************************************
+
+# ********** IMPORT STATEMENTS **********
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import RBA_georef_util as rgutil
+import RBA_stream_network as rgnet
+import georef_RBA_survey_data as rggeoref
+
+try:
+    import numpy
+    import RBA_uncertainty as rgunc
+    import RBA_scenarios as rgscen
+    import RBA_vertex_store as rgvtx
+except ImportError:
+    numpy = None
+
+
+# ********** GLOBAL CONSTANTS **********
+
+NUM_WORKERS = 2
+WAIT_SECONDS = 60.0  # longest a test waits for another process
+POLL_SECONDS = 0.05
+
+
+# ********** CLASSES **********
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class VertexStoreTest(unittest.TestCase):
+    """
+    Streams written to a store and read back, and the store's removal.
+    """
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.stream_lines = example_stream_lines()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_shared_stream_lines_match_stream_lines(self):
+        with rgvtx.shared_vertex_store(self.stream_lines, self.store_dir) \
+                as store_filepath:
+            with rgvtx.VertexStore(store_filepath) as store:
+                self.assertEqual(store.llids(), ["1", "2"])
+                self.assertIsNone(store.stream_line("3"))
+                for stream_line in self.stream_lines:
+                    shared_line = store.stream_line(stream_line.llid)
+                    self.assertEqual(shared_line.part_starts,
+                                     stream_line.part_starts)
+                    self.assertEqual(list(shared_line.cum_dists),
+                                     list(stream_line.cum_dists))
+                    for distance in (-5.0, 0.0, 55.0, 150.0, 1000.0):
+                        self.assertEqual(shared_line.position_along_line
+                                         (distance),
+                                         stream_line.position_along_line
+                                         (distance))
+                    for x, y in ((3.0, 40.0), (-20.0, 130.0), (60.0, 0.0)):
+                        for shared_value, value in \
+                                zip(shared_line.query_point_and_distance(x, y),
+                                    stream_line.query_point_and_distance
+                                    (x, y)):
+                            numpy.testing.assert_allclose(shared_value, value)
+
+    def test_store_is_removed_after_failure(self):
+        with self.assertRaises(ValueError):
+            with rgvtx.vertex_store_workers(self.stream_lines, NUM_WORKERS,
+                                            self.store_dir):
+                raise ValueError("failed while workers were running")
+        self.assertEqual(os.listdir(self.store_dir), [])
+
+    def test_killed_owner_store_is_removed(self):
+        # A store of a running owner is kept; once the owner is killed, it
+        # is removed by the next process creating a store
+        ready = multiprocessing.Queue()
+        owner = multiprocessing.Process(target=hold_store,
+                                        args=(self.stream_lines,
+                                              self.store_dir, ready))
+        owner.start()
+        owner_store = ready.get(timeout=WAIT_SECONDS)
+        try:
+            with rgvtx.shared_vertex_store(self.stream_lines,
+                                           self.store_dir):
+                self.assertTrue(os.path.exists(owner_store))
+        finally:
+            owner.terminate()
+            owner.join()
+        self.assertTrue(os.path.exists(owner_store))
+        with rgvtx.shared_vertex_store(self.stream_lines, self.store_dir) \
+                as store_filepath:
+            self.assertFalse(os.path.exists(owner_store))
+            self.assertEqual(os.listdir(self.store_dir),
+                             [os.path.basename(store_filepath)])
+        self.assertEqual(os.listdir(self.store_dir), [])
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class StoreWorkersTest(unittest.TestCase):
+    """
+    Stream-wide values computed by store workers and in one process.
+    """
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.stream_lines = example_stream_lines()
+        self.error_model = rgunc.ErrorModel(50, 15.0, 10.0, 7)
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_worker_values_match_serial_values(self):
+        survey_dists = [0, 50, 100, 150, 190]
+        random_state = rgunc.new_random_state(self.error_model)
+        tasks = []
+        for stream_line in self.stream_lines:
+            adj_factors = example_adj_factors()
+            tasks.append((stream_line, adj_factors,
+                          rgunc.stream_error_model(self.error_model,
+                                                   random_state),
+                          [adj_factors, adj_factors[:1]]))
+        with rgvtx.vertex_store_workers(self.stream_lines, NUM_WORKERS,
+                                        self.store_dir) as workers:
+            results = [workers.pool.apply_async
+                       (rggeoref.stream_values_task,
+                        (workers.store_filepath, stream_line.llid,
+                         adj_factors, error_model, scenario_adj_factors,
+                         survey_dists))
+                       for stream_line, adj_factors, error_model,
+                       scenario_adj_factors in tasks]
+            worker_values = [result.get(WAIT_SECONDS) for result in results]
+        self.assertEqual(os.listdir(self.store_dir), [])
+
+        for (stream_line, adj_factors, error_model, scenario_adj_factors), \
+                values in zip(tasks, worker_values):
+            expected = rggeoref.stream_values\
+                (survey_dists,
+                 rgunc.StreamUncertainty(stream_line, adj_factors,
+                                         error_model,
+                                         rgunc.new_random_state
+                                         (error_model)),
+                 rgscen.StreamScenarios(stream_line, scenario_adj_factors))
+            self.assertEqual(len(values), len(survey_dists))
+            numpy.testing.assert_allclose(values, expected)
+
+
+# ********** FUNCTIONS **********
+
+def example_stream_lines():
+    """
+    Creates a straight stream and a two-part stream.
+    """
+    return [rgnet.StreamLine("1", [0.0, 0.0, 10.0], [0.0, 100.0, 200.0]),
+            rgnet.StreamLine("2", [0.0, 0.0, 50.0, 50.0, 100.0],
+                             [0.0, 100.0, 100.0, 150.0, 150.0], [0, 2])]
+
+
+def example_adj_factors():
+    """
+    Creates adjustment factors for a stream synced by x,y coordinates at
+    survey distance 100.
+    """
+    begin_pt = rgutil.create_syncpoint(None, None, "", 0, 0.0, "")
+    sync_pt = rgutil.create_syncpoint(0.0, 90.0, "", 100, 90.0, "")
+    return [(begin_pt, sync_pt, 0.9),
+            (sync_pt, rgutil.stream_end_sync_point(),
+             rgutil.DEFAULT_ADJ_FACTOR)]
+
+
+def hold_store(stream_lines, store_dir, ready):
+    """
+    Creates a store, reports its path, and keeps it until killed.
+    """
+    with rgvtx.shared_vertex_store(stream_lines, store_dir) \
+            as store_filepath:
+        ready.put(store_filepath)
+        while True:
+            time.sleep(POLL_SECONDS)
+
+
+# ********** MAIN **********
+
+def main():
+    unittest.main()
+
+
+# ********** MAIN CHECK **********
+
+if __name__ == '__main__':
+    main()